@@ -0,0 +1,103 @@
+################################################################################
+# Batch frame benchmark.                                                       #
+#                                                                              #
+# Small file-join requests per second at batch sizes 1, 16 and 256, sent as    #
+# batch frames and as the same number of single frames in one send. The        #
+# batch frames are run against FileJoinService, which implements               #
+# process_batch, and against a copy without it that is called per item.        #
+################################################################################
+
+import os, sys, time, socket, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECTORS
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+from service_client import ServiceConnection
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BASE_PORT = 50500
+
+DURATION = 2.0
+BATCH_SIZES = [1, 16, 256]
+
+REQUEST_BODY = (1).to_bytes(4, byteorder='little') * 2 + b'ab'
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class PerItemFileJoinService:
+    # FileJoinService without process_batch.
+    def __init__(self):
+        self.service = FileJoinService()
+    
+    def process(self, request):
+        return self.service.process(request)
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(service, port):
+    services = ServiceRegistry()
+    services.register(type(service).__name__, service)
+    handler_factory = ClientHandlerFactory(services, max_in_flight=max(BATCH_SIZES), ordered_responses=False)
+    
+    TcpServer('bench-server', ENGINE_SELECTORS).run(port, handler_factory)
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def bench(port, batch_size, batched):
+    connection = ServiceConnection('127.0.0.1', port)
+    bodies = [REQUEST_BODY] * batch_size
+    
+    count = 0
+    deadline = time.perf_counter() + DURATION
+    while time.perf_counter() < deadline:
+        if batched:
+            connection.call_batch(bodies)
+        else:
+            connection.call_many(bodies)
+        count += batch_size
+    
+    connection.close()
+    return count / DURATION
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+print(f'duration = {DURATION} sec')
+print(f'{"service":>22} {"frames":>7} {"batch":>6} {"req/s":>10}')
+
+for i, (service_name, service, runs) in enumerate([
+    ('FileJoinService', FileJoinService(), [('single', False), ('batch', True)]),
+    ('per item', PerItemFileJoinService(), [('batch', True)])
+]):
+    port = BASE_PORT + i
+    process = multiprocessing.Process(target=run_server, args=(service, port), daemon=True)
+    process.start()
+    wait_for_server(port)
+    
+    for frames, batched in runs:
+        for batch_size in BATCH_SIZES:
+            throughput = bench(port, batch_size, batched)
+            print(f'{service_name:>22} {frames:>7} {batch_size:6} {throughput:10.0f}')
+    
+    process.terminate()
+    process.join()
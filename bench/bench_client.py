@@ -0,0 +1,153 @@
+################################################################################
+# Client library benchmark.                                                    #
+#                                                                              #
+# Compares TcpClient with the service_client connection pool: sequential       #
+# calls, many threads sharing one pool, asyncio calls and send_many batches,   #
+# against the inline file-join service.                                        #
+################################################################################
+
+import os, sys, time, socket, asyncio, threading, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECTORS
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+from tcp_client import TcpClient
+from service_client import ConnectionPool, AsyncConnectionPool
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BASE_PORT = 50400
+
+DURATION = 2.0
+THREAD_COUNT = 8
+TASK_COUNT = 64
+BATCH_SIZE = 64
+POOL_SIZE = 2
+
+REQUEST_BODY = (1).to_bytes(4, byteorder='little') * 2 + b'ab'
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(port):
+    services = ServiceRegistry(max_in_flight=100000)
+    services.register('file-join', FileJoinService)
+    handler_factory = ClientHandlerFactory(services, max_in_flight=BATCH_SIZE, ordered_responses=False)
+    
+    TcpServer('bench-server', ENGINE_SELECTORS).run(port, handler_factory)
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def bench_tcp_client(port):
+    client = TcpClient('127.0.0.1', port)
+    count = 0
+    deadline = time.perf_counter() + DURATION
+    while time.perf_counter() < deadline:
+        client.send(REQUEST_BODY)
+        client.recv()
+        count += 1
+    
+    client.close()
+    return count
+
+def bench_pool_call(port):
+    pool = ConnectionPool('127.0.0.1', port, size=1)
+    count = 0
+    deadline = time.perf_counter() + DURATION
+    while time.perf_counter() < deadline:
+        pool.call(REQUEST_BODY)
+        count += 1
+    
+    pool.close()
+    return count
+
+def bench_pool_threads(port):
+    pool = ConnectionPool('127.0.0.1', port, size=POOL_SIZE)
+    counts = []
+    deadline = time.perf_counter() + DURATION
+    
+    def call_loop():
+        count = 0
+        while time.perf_counter() < deadline:
+            pool.call(REQUEST_BODY)
+            count += 1
+        counts.append(count)
+    
+    threads = [threading.Thread(target=call_loop) for i in range(THREAD_COUNT)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    pool.close()
+    return sum(counts)
+
+def bench_pool_send_many(port):
+    pool = ConnectionPool('127.0.0.1', port, size=1)
+    count = 0
+    deadline = time.perf_counter() + DURATION
+    while time.perf_counter() < deadline:
+        pool.call_many([REQUEST_BODY] * BATCH_SIZE)
+        count += BATCH_SIZE
+    
+    pool.close()
+    return count
+
+def bench_async_pool(port):
+    async def run():
+        pool = AsyncConnectionPool('127.0.0.1', port, size=POOL_SIZE)
+        counts = []
+        deadline = time.perf_counter() + DURATION
+        
+        async def call_loop():
+            count = 0
+            while time.perf_counter() < deadline:
+                await pool.call(REQUEST_BODY)
+                count += 1
+            counts.append(count)
+        
+        await asyncio.gather(*[call_loop() for i in range(TASK_COUNT)])
+        pool.close()
+        return sum(counts)
+    
+    return asyncio.run(run())
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+port = BASE_PORT
+process = multiprocessing.Process(target=run_server, args=(port,), daemon=True)
+process.start()
+wait_for_server(port)
+
+print(f'duration = {DURATION} sec, threads = {THREAD_COUNT}, tasks = {TASK_COUNT}, batch = {BATCH_SIZE}')
+print(f'{"client":>22} {"req/s":>10}')
+
+for name, function in [
+    ('TcpClient', bench_tcp_client),
+    ('pool call', bench_pool_call),
+    ('pool call, threads', bench_pool_threads),
+    ('pool call_many', bench_pool_send_many),
+    ('async pool, tasks', bench_async_pool)
+]:
+    count = function(port)
+    print(f'{name:>22} {count / DURATION:10.0f}')
+
+process.terminate()
+process.join()
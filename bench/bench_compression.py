@@ -0,0 +1,90 @@
+################################################################################
+# Body compression benchmark.                                                  #
+#                                                                              #
+# For text like the join payloads and for incompressible data, reports the     #
+# compression ratio, the compress and decode speed, and the link speed below   #
+# which compression pays off: the bytes saved divided by the CPU time spent    #
+# compressing and decoding them.                                               #
+################################################################################
+
+import os, sys, time, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.body_encoding import ENCODING_ZLIB, ENCODING_LZMA, encode_body, decode_body, lzma
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+PAYLOAD_SIZES = [1024, 64 * 1024, 1024 * 1024]
+
+MIN_DURATION = 0.5
+
+WORDS = ['join', 'file', 'record', 'server', 'client', 'request', 'response', 'status',
+    'alpha', 'beta', 'gamma', 'delta', 'epsilon', 'customer', 'order', 'item', 'price',
+    'quantity', 'region', 'north', 'south', 'east', 'west', '2024-01-01', 'true', 'false']
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def text_payload(size):
+    rng = random.Random(size)
+    lines = []
+    length = 0
+    while length < size:
+        line = f'{rng.randint(1, 999999)}\t' + ' '.join(rng.choice(WORDS) for i in range(rng.randint(4, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines).encode('utf-8')[:size]
+
+def random_payload(size):
+    return random.Random(size).randbytes(size)
+
+def time_per_call(function):
+    count = 0
+    start_time = time.perf_counter()
+    while True:
+        function()
+        count += 1
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= MIN_DURATION:
+            return elapsed / count
+
+def bench(data, encoding, level):
+    encoding_used, encoded_data = encode_body(data, encoding, level)
+    
+    encode_time = time_per_call(lambda: encode_body(data, encoding, level))
+    if encoding_used != encoding:
+        # Sent uncompressed, the CPU time of the attempt is lost.
+        return 1.0, len(data) / encode_time, None, 0.0
+    
+    decode_time = time_per_call(lambda: decode_body(encoded_data, encoding_used, len(data)))
+    
+    saved = len(data) - len(encoded_data)
+    break_even = saved / (encode_time + decode_time)
+    
+    return len(encoded_data) / len(data), len(data) / encode_time, len(data) / decode_time, break_even
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+MB = 1024 * 1024
+
+configurations = [('zlib', ENCODING_ZLIB, 1), ('zlib', ENCODING_ZLIB, 6)]
+if lzma:
+    configurations.append(('lzma', ENCODING_LZMA, 1))
+
+print(f'{"payload":>8} {"size":>8} {"encoding":>9} {"ratio":>6} {"enc MB/s":>9} {"dec MB/s":>9} {"break-even MB/s":>16}')
+
+for payload_name, make_payload in [('text', text_payload), ('random', random_payload)]:
+    for size in PAYLOAD_SIZES:
+        data = make_payload(size)
+        
+        for name, encoding, level in configurations:
+            ratio, encode_speed, decode_speed, break_even = bench(data, encoding, level)
+            decode_text = f'{decode_speed / MB:9.1f}' if decode_speed else f'{"-":>9}'
+            print(f'{payload_name:>8} {size:8} {f"{name}-{level}":>9} {ratio:6.3f} '
+                f'{encode_speed / MB:9.1f} {decode_text} {break_even / MB:16.1f}')
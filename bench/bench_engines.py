@@ -0,0 +1,134 @@
+################################################################################
+# Server engine benchmark.                                                     #
+#                                                                              #
+# Runs the file-join service on each engine (select, selectors, asyncio) in a  #
+# separate process and drives it with closed-loop client threads. Reports      #
+# throughput and latency percentiles side by side.                             #
+################################################################################
+
+import os, sys, time, socket, threading, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECT, ENGINE_SELECTORS
+from asyncio_server import AsyncioTcpServer, ENGINE_ASYNCIO
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BASE_PORT = 50100
+
+CONNECTION_COUNT = 16
+DURATION = 3.0
+PAYLOAD_SIZES = [64, 64 * 1024]
+
+ENGINES = [ENGINE_SELECT, ENGINE_SELECTORS, ENGINE_ASYNCIO]
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(engine, port):
+    if engine == ENGINE_ASYNCIO:
+        tcp_server = AsyncioTcpServer('bench-server')
+    else:
+        tcp_server = TcpServer('bench-server', engine)
+    
+    services = ServiceRegistry()
+    services.register('file-join', FileJoinService)
+    tcp_server.run(port, ClientHandlerFactory(services))
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def build_request(request_id, payload_size):
+    half = b'a' * (payload_size // 2)
+    body = len(half).to_bytes(4, byteorder='little') * 2 + half + half
+    
+    return (
+        b'TRRQ' +
+        request_id.to_bytes(4, byteorder='little') +
+        len(body).to_bytes(4, byteorder='little') +
+        bytes(4) +
+        body
+    )
+
+def recv_exact(connection, length):
+    data = bytearray(length)
+    view = memoryview(data)
+    offset = 0
+    while offset < length:
+        count = connection.recv_into(view[offset:])
+        if count == 0:
+            raise ConnectionError('Connection closed')
+        offset += count
+    
+    return data
+
+def client_loop(port, payload_size, deadline, latencies):
+    connection = socket.create_connection(('127.0.0.1', port))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    request = build_request(1, payload_size)
+    
+    while time.perf_counter() < deadline:
+        start_time = time.perf_counter()
+        connection.sendall(request)
+        header = recv_exact(connection, 16)
+        recv_exact(connection, int.from_bytes(header[8:12], byteorder='little'))
+        latencies.append(time.perf_counter() - start_time)
+    
+    connection.close()
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def bench_engine(engine, port, payload_size):
+    latencies = []
+    deadline = time.perf_counter() + DURATION
+    
+    threads = [
+        threading.Thread(target=client_loop, args=(port, payload_size, deadline, latencies))
+        for i in range(CONNECTION_COUNT)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    latencies.sort()
+    
+    return len(latencies) / DURATION, latencies
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+print(f'connections = {CONNECTION_COUNT}, duration = {DURATION} sec')
+print(f'{"engine":>10} {"payload":>8} {"req/s":>10} {"p50 ms":>8} {"p99 ms":>8}')
+
+for i, engine in enumerate(ENGINES):
+    port = BASE_PORT + i
+    process = multiprocessing.Process(target=run_server, args=(engine, port), daemon=True)
+    process.start()
+    wait_for_server(port)
+    
+    for payload_size in PAYLOAD_SIZES:
+        throughput, latencies = bench_engine(engine, port, payload_size)
+        print(f'{engine:>10} {payload_size:8} {throughput:10.0f} {percentile(latencies, 0.5) * 1000:8.3f} {percentile(latencies, 0.99) * 1000:8.3f}')
+    
+    process.terminate()
+    process.join()
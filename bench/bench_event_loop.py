@@ -0,0 +1,113 @@
+################################################################################
+# Event loop wakeup cost benchmark.                                            #
+#                                                                              #
+# Registers N idle connections plus one active connection and measures the     #
+# cost of one wakeup (poll + dispatch of the single ready socket) for the      #
+# select and selectors engines. With selectors the cost should stay flat as N  #
+# grows; with select it grows linearly and stops at FD_SETSIZE.                #
+################################################################################
+
+import time, socket, select, selectors
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+CONNECTION_COUNTS = [100, 400, 1000, 5000, 10000, 20000]
+WAKEUP_COUNT = 2000
+
+FD_SETSIZE = 1024
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def raise_fd_limit():
+    if resource is None:
+        return None
+    
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    
+    return hard
+
+def create_connections(count):
+    pairs = []
+    for i in range(count):
+        a, b = socket.socketpair()
+        a.setblocking(0)
+        pairs.append((a, b))
+    
+    return pairs
+
+def close_connections(pairs):
+    for a, b in pairs:
+        a.close()
+        b.close()
+
+def bench_select(idle_pairs, active_pair):
+    rlist = [a for a, b in idle_pairs]
+    rlist.append(active_pair[0])
+    
+    start_time = time.perf_counter()
+    
+    for i in range(WAKEUP_COUNT):
+        active_pair[1].send(b'x')
+        readable, writable, exceptional = select.select(rlist, [], rlist, 1)
+        for s in readable:
+            s.recv(1)
+    
+    return (time.perf_counter() - start_time) / WAKEUP_COUNT
+
+def bench_selectors(idle_pairs, active_pair):
+    sel = selectors.DefaultSelector()
+    for a, b in idle_pairs:
+        sel.register(a, selectors.EVENT_READ)
+    sel.register(active_pair[0], selectors.EVENT_READ)
+    
+    start_time = time.perf_counter()
+    
+    for i in range(WAKEUP_COUNT):
+        active_pair[1].send(b'x')
+        for key, events in sel.select(1):
+            key.fileobj.recv(1)
+    
+    elapsed_time = (time.perf_counter() - start_time) / WAKEUP_COUNT
+    sel.close()
+    
+    return elapsed_time
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+fd_limit = raise_fd_limit()
+
+print(f'selector = {selectors.DefaultSelector.__name__}, wakeups per run = {WAKEUP_COUNT}')
+print(f'{"connections":>12} {"select (us)":>12} {"selectors (us)":>15}')
+
+for count in CONNECTION_COUNTS:
+    # Two descriptors per socketpair plus some headroom.
+    if fd_limit is not None and count * 2 + 64 > fd_limit:
+        print(f'{count:12} skipped: needs {count * 2 + 64} descriptors, limit is {fd_limit}')
+        continue
+    
+    idle_pairs = create_connections(count)
+    active_pair = create_connections(1)[0]
+    
+    if active_pair[1].fileno() < FD_SETSIZE:
+        select_text = f'{bench_select(idle_pairs, active_pair) * 1e6:12.2f}'
+    else:
+        select_text = f'{"n/a":>12}'
+    
+    selectors_text = f'{bench_selectors(idle_pairs, active_pair) * 1e6:15.2f}'
+    
+    print(f'{count:12} {select_text} {selectors_text}')
+    
+    close_connections(idle_pairs + [active_pair])
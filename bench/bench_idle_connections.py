@@ -0,0 +1,155 @@
+################################################################################
+# Idle connection memory benchmark.                                            #
+#                                                                              #
+# Opens N connections that never send anything and reports how much the        #
+# resident set size (VmRSS) of the server process grows per connection. The    #
+# kernel socket buffers are not part of the RSS, so this is the cost of the    #
+# server's own connection state. Counts above the open file limit of this      #
+# host are skipped.                                                            #
+################################################################################
+
+import os, sys, time, socket, multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECTORS
+from asyncio_server import AsyncioTcpServer, ENGINE_ASYNCIO
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+CONNECTION_COUNTS = [10000, 50000, 100000]
+
+ENGINES = [ENGINE_SELECTORS, ENGINE_ASYNCIO]
+
+BASE_PORT = 30600
+
+# The connections are opened faster than the server accepts them.
+BACKLOG = 4096
+
+# Each destination address has its own range of ephemeral ports.
+CONNECTIONS_PER_ADDRESS = 20000
+
+# Connections opened and left idle before the baseline, so that one-time
+# allocations are not counted.
+WARMUP_COUNT = 100
+
+# File descriptors used besides the connections.
+RESERVED_FDS = 100
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def raise_fd_limit():
+    if resource is None:
+        return 1024
+    
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    
+    return hard
+
+def run_server(engine, port):
+    if engine == ENGINE_ASYNCIO:
+        tcp_server = AsyncioTcpServer('bench-server', backlog=BACKLOG)
+    else:
+        tcp_server = TcpServer('bench-server', engine, backlog=BACKLOG)
+    
+    services = ServiceRegistry()
+    services.register('file-join', FileJoinService)
+    tcp_server.run(port, ClientHandlerFactory(services))
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def read_rss(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    
+    return 0
+
+def count_fds(pid):
+    return len(os.listdir(f'/proc/{pid}/fd'))
+
+def open_connections(port, first, count):
+    connections = []
+    for i in range(first, first + count):
+        address = f'127.0.0.{2 + i // CONNECTIONS_PER_ADDRESS}'
+        connections.append(socket.create_connection((address, port)))
+    
+    return connections
+
+def wait_for_accept(pid, fd_count):
+    # Waits until the server holds fd_count descriptors and its RSS stopped
+    # changing.
+    deadline = time.monotonic() + 60
+    while count_fds(pid) < fd_count and time.monotonic() < deadline:
+        time.sleep(0.1)
+    
+    rss = read_rss(pid)
+    while time.monotonic() < deadline:
+        time.sleep(0.5)
+        current = read_rss(pid)
+        if current == rss:
+            return rss
+        rss = current
+    
+    return rss
+
+def bench_engine(engine, port, count):
+    process = multiprocessing.Process(target=run_server, args=(engine, port), daemon=True)
+    process.start()
+    wait_for_server(port)
+    
+    fd_count = count_fds(process.pid) + WARMUP_COUNT
+    warmup = open_connections(port, 0, WARMUP_COUNT)
+    baseline = wait_for_accept(process.pid, fd_count)
+    
+    connections = open_connections(port, WARMUP_COUNT, count)
+    rss = wait_for_accept(process.pid, fd_count + count)
+    
+    # The server closes first, so that the TIME-WAIT sockets are not left
+    # on the ephemeral ports of the clients.
+    process.terminate()
+    process.join()
+    for connection in warmup + connections:
+        connection.close()
+    
+    return (rss - baseline) / count
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+fd_limit = raise_fd_limit()
+
+print(f'{"engine":>10} {"connections":>12} {"RSS bytes/conn":>15}')
+
+for i, engine in enumerate(ENGINES):
+    for j, count in enumerate(CONNECTION_COUNTS):
+        if count + WARMUP_COUNT + RESERVED_FDS > fd_limit:
+            print(f'{engine:>10} {count:12} {"skipped":>15}  (open file limit {fd_limit})')
+            continue
+        
+        per_connection = bench_engine(engine, BASE_PORT + i * len(CONNECTION_COUNTS) + j, count)
+        print(f'{engine:>10} {count:12} {per_connection:15.0f}')
@@ -0,0 +1,95 @@
+################################################################################
+# Logging cost benchmark.                                                      #
+#                                                                              #
+# Measures the time the logging thread spends in one logger.info call for a    #
+# per-connection message, with the file handler called directly and behind     #
+# the queue of the logging pipeline. The file handler stalls now and then,     #
+# like a disk under load or a log rotation; only the direct handler passes     #
+# the stall on to the caller.                                                  #
+################################################################################
+
+import os, sys, time, logging, logging.handlers, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from log_pipeline import QueueLogHandler, RateLimitFilter
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+MESSAGE_COUNT = 20000
+
+# The file handler stalls for STALL_TIME every STALL_INTERVAL records.
+STALL_INTERVAL = 1000
+STALL_TIME = 0.01
+
+# Messages are logged at this rate, about what a server with high connection
+# churn logs.
+MESSAGES_PER_SECOND = 20000
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class StallingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, file_name):
+        super().__init__(file_name, maxBytes=10 * 1024 * 1024, backupCount=1)
+        self.record_count = 0
+    
+    def emit(self, record):
+        self.record_count += 1
+        if self.record_count % STALL_INTERVAL == 0:
+            time.sleep(STALL_TIME)
+        super().emit(record)
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def create_handler(name, file_name):
+    file_handler = StallingFileHandler(file_name)
+    file_handler.setFormatter(logging.Formatter('<%(asctime)s> <%(levelname)s> <%(filename)s:%(lineno)s> <%(message)s>'))
+    if name == 'direct':
+        return file_handler
+    
+    handler = QueueLogHandler([file_handler])
+    if name == 'queue+limit':
+        handler.addFilter(RateLimitFilter())
+    return handler
+
+def bench(name, file_name):
+    logger = logging.getLogger(f'bench.{name}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = create_handler(name, file_name)
+    logger.addHandler(handler)
+    
+    durations = []
+    next_time = time.perf_counter()
+    for i in range(MESSAGE_COUNT):
+        address = ('127.0.0.1', 10000 + i % 50000)
+        start_time = time.perf_counter()
+        logger.info('new client %s', address)
+        durations.append(time.perf_counter() - start_time)
+        
+        next_time += 1 / MESSAGES_PER_SECOND
+        while time.perf_counter() < next_time:
+            pass
+    
+    logger.removeHandler(handler)
+    handler.close()
+    
+    durations.sort()
+    return sum(durations) / len(durations), durations[int(len(durations) * 0.99)], durations[-1]
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+print(f'{"handler":>12} {"mean us":>8} {"p99 us":>8} {"max us":>9}')
+
+with tempfile.TemporaryDirectory() as dir_path:
+    for name in ['direct', 'queue', 'queue+limit']:
+        mean, p99, longest = bench(name, os.path.join(dir_path, f'{name}.log'))
+        print(f'{name:>12} {mean * 1e6:8.1f} {p99 * 1e6:8.1f} {longest * 1e6:9.1f}')
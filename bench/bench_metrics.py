@@ -0,0 +1,66 @@
+################################################################################
+# Metrics recording benchmark.                                                 #
+#                                                                              #
+# Measures the cost per request of what the server records: the two clock      #
+# reads for the duration, and the histogram and status counter update.         #
+################################################################################
+
+import os, sys, time, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metrics import Metrics
+from tcp_server import STATUS_OK
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+REQUEST_COUNT = 1000000
+
+SERVICE_NAME = 'FileJoinService'
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def read_clock(metrics, durations):
+    for duration in durations:
+        start_time = time.perf_counter()
+        duration += time.perf_counter() - start_time
+
+def record_responses(metrics, durations):
+    service_metrics = metrics.service(SERVICE_NAME)
+    for duration in durations:
+        service_metrics.observe_response(STATUS_OK, duration)
+
+def empty_loop(metrics, durations):
+    for duration in durations:
+        pass
+
+def measure(function, durations):
+    metrics = Metrics()
+    start_time = time.perf_counter()
+    function(metrics, durations)
+    return time.perf_counter() - start_time
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+# Service times spread over the whole histogram range.
+durations = [10 ** random.uniform(-5, 1) for i in range(REQUEST_COUNT)]
+
+loop_time = measure(empty_loop, durations)
+
+print(f'{"step":>10} {"ns/request":>11}')
+for name, function in [('clock', read_clock), ('record', record_responses)]:
+    elapsed = measure(function, durations) - loop_time
+    print(f'{name:>10} {elapsed * 1e9 / REQUEST_COUNT:11.0f}')
+
+metrics = Metrics()
+record_responses(metrics, durations[:10000])
+render_start = time.perf_counter()
+metrics.render()
+print(f'render: {(time.perf_counter() - render_start) * 1000:.2f} ms')
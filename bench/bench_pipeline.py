@@ -0,0 +1,147 @@
+################################################################################
+# Request pipelining benchmark.                                                #
+#                                                                              #
+# Keeps a fixed number of requests outstanding on each connection and reports  #
+# requests/sec at pipeline depths 1, 8 and 64, for the inline file-join        #
+# service and for a coroutine service that waits 1 ms per request.             #
+################################################################################
+
+import os, sys, time, socket, threading, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECTORS
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+from services.async_delay_service import AsyncDelayService
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BASE_PORT = 50200
+
+CONNECTION_COUNT = 4
+DURATION = 3.0
+PIPELINE_DEPTHS = [1, 8, 64]
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(service_name, port):
+    if service_name == 'file-join':
+        service = FileJoinService()
+    else:
+        service = AsyncDelayService()
+    
+    services = ServiceRegistry(max_in_flight=100000)
+    services.register(service_name, service)
+    handler_factory = ClientHandlerFactory(services, max_in_flight=max(PIPELINE_DEPTHS), ordered_responses=False)
+    
+    TcpServer('bench-server', ENGINE_SELECTORS).run(port, handler_factory)
+
+def request_body(service_name):
+    if service_name == 'file-join':
+        return (1).to_bytes(4, byteorder='little') * 2 + b'ab'
+    else:
+        # 1 ms delay
+        return (1).to_bytes(4, byteorder='little') + b'echo'
+
+def build_request(request_id, body):
+    return (
+        b'TRRQ' +
+        request_id.to_bytes(4, byteorder='little') +
+        len(body).to_bytes(4, byteorder='little') +
+        bytes(4) +
+        body
+    )
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def recv_exact(connection, length):
+    data = bytearray(length)
+    view = memoryview(data)
+    offset = 0
+    while offset < length:
+        count = connection.recv_into(view[offset:])
+        if count == 0:
+            raise ConnectionError('Connection closed')
+        offset += count
+    
+    return data
+
+def client_loop(port, body, depth, deadline, counts):
+    connection = socket.create_connection(('127.0.0.1', port))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    request_id = 0
+    outstanding = set()
+    completed = 0
+    
+    while True:
+        sending = time.perf_counter() < deadline
+        
+        if sending:
+            batch = []
+            while len(outstanding) < depth:
+                request_id += 1
+                outstanding.add(request_id)
+                batch.append(build_request(request_id, body))
+            if batch:
+                connection.sendall(b''.join(batch))
+        
+        if not outstanding:
+            break
+        
+        header = recv_exact(connection, 16)
+        recv_exact(connection, int.from_bytes(header[8:12], byteorder='little'))
+        outstanding.remove(int.from_bytes(header[4:8], byteorder='little'))
+        completed += 1
+    
+    connection.close()
+    counts.append(completed)
+
+def bench(port, body, depth):
+    counts = []
+    deadline = time.perf_counter() + DURATION
+    
+    threads = [
+        threading.Thread(target=client_loop, args=(port, body, depth, deadline, counts))
+        for i in range(CONNECTION_COUNT)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    return sum(counts) / DURATION
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+print(f'connections = {CONNECTION_COUNT}, duration = {DURATION} sec')
+print(f'{"service":>12} {"depth":>6} {"req/s":>10}')
+
+for i, service_name in enumerate(['file-join', 'async-delay']):
+    port = BASE_PORT + i
+    process = multiprocessing.Process(target=run_server, args=(service_name, port), daemon=True)
+    process.start()
+    wait_for_server(port)
+    
+    for depth in PIPELINE_DEPTHS:
+        throughput = bench(port, request_body(service_name), depth)
+        print(f'{service_name:>12} {depth:6} {throughput:10.0f}')
+    
+    process.terminate()
+    process.join()
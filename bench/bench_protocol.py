@@ -0,0 +1,164 @@
+################################################################################
+# Wire protocol codec benchmark.                                               #
+#                                                                              #
+# Nanoseconds per encode and decode of the former byte slicing and             #
+# int.from_bytes code against the precompiled struct codecs of protocol.py:    #
+# request header parse in the server, response header build, TcpClient         #
+# request build and response parse, and file-join request body parse and       #
+# build.                                                                       #
+################################################################################
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import FrameReader, RequestMessage, STATUS_OK
+from common.protocol import REQUEST_MAGIC_NUMBER, RESPONSE_MAGIC_NUMBER, MESSAGE_HEADER_LENGTH, FLAG_BATCH, ENCODING_MASK
+from common.protocol import build_request_message, build_response_message, unpack_response_header
+from common.service_bodies import FILE_JOIN_REQUEST
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+# Each case is timed REPEAT times over NUMBER calls and the best is reported.
+NUMBER = 200000
+REPEAT = 5
+
+BODY_DATA = b'x' * 64
+
+FILE_A_DATA = 'Hello'.encode('utf-8') * 20
+FILE_B_DATA = 'World'.encode('utf-8') * 20
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def old_parse_header(data):
+    # The former FrameReader.parse_header, given a memoryview of the header.
+    magic_number = data[0:4]
+    if magic_number != REQUEST_MAGIC_NUMBER:
+        raise ValueError(f'Illegal magic number: {magic_number.hex()}')
+    
+    request_id = int.from_bytes(data[4:8], byteorder='little')
+    
+    body_length = int.from_bytes(data[8:12], byteorder='little')
+    
+    encoding = data[12] & ENCODING_MASK
+    batch = (data[12] & FLAG_BATCH) != 0
+    accept_encodings = data[13]
+    service_id = int.from_bytes(data[14:16], byteorder='little')
+    
+    return RequestMessage(request_id, body_length, encoding, accept_encodings, batch, service_id)
+
+def old_peek_header(buffer, start):
+    with memoryview(buffer) as view:
+        return old_parse_header(view[start:start + MESSAGE_HEADER_LENGTH])
+
+def old_build_response_header(request_id, status, result_length, encoding):
+    # The former ResponseMessage.build_header.
+    send_request_id = request_id.to_bytes(4, byteorder='little')
+    send_result_length = result_length.to_bytes(4, byteorder='little')
+    status = status.to_bytes(1, byteorder='little')
+    reserved_area = bytes([encoding, 0, 0])
+    
+    return RESPONSE_MAGIC_NUMBER + send_request_id + send_result_length + status + reserved_area
+
+def old_build_request(request_id, data):
+    # The former TcpClient.send.
+    request_id = request_id.to_bytes(4, byteorder='little')
+    body_length = len(data).to_bytes(4, byteorder='little')
+    reserved_area = bytes([0, 0, 0, 0])
+    
+    return REQUEST_MAGIC_NUMBER + request_id + body_length + reserved_area + data
+
+def old_parse_response(data):
+    # The former TcpClient.parse_response_message.
+    magic_number = data[0:4]
+    if magic_number != RESPONSE_MAGIC_NUMBER:
+        raise ValueError(f'Illegal magic number: {magic_number.hex()}')
+    
+    request_id = int.from_bytes(data[4:8], byteorder='little')
+    result_length = int.from_bytes(data[8:12], byteorder='little')
+    status = data[12]
+    result_data = data[16:16 + result_length].decode('utf-8')
+    
+    return request_id, status, result_data
+
+def new_parse_response(data):
+    magic_number, request_id, result_length, status, encoding = unpack_response_header(data)
+    result_data = str(data[MESSAGE_HEADER_LENGTH:MESSAGE_HEADER_LENGTH + result_length], 'utf-8')
+    
+    return request_id, status, result_data
+
+def old_parse_file_join(body_data):
+    # The former file-join parse_request_body.
+    file_a_length = int.from_bytes(body_data[0:4], byteorder='little')
+    file_b_length = int.from_bytes(body_data[4:8], byteorder='little')
+    
+    start = 8
+    end = start + file_a_length
+    file_a_text = str(body_data[start:end], 'utf-8')
+    
+    start = end
+    end = start + file_b_length
+    file_b_text = str(body_data[start:end], 'utf-8')
+    
+    return file_a_text, file_b_text
+
+def new_parse_file_join(body_data):
+    file_a_data, file_b_data = FILE_JOIN_REQUEST.decode(body_data)
+    
+    return str(file_a_data, 'utf-8'), str(file_b_data, 'utf-8')
+
+def old_build_file_join(file_a_data, file_b_data):
+    # The former client_main.build_request_data.
+    return (len(file_a_data).to_bytes(4, byteorder='little') + len(file_b_data).to_bytes(4, byteorder='little') +
+        file_a_data + file_b_data)
+
+def measure(function, *args):
+    # Best time per call in nanoseconds.
+    timer = timeit.Timer(lambda: function(*args))
+    return min(timer.repeat(REPEAT, NUMBER)) / NUMBER * 1e9
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+# A receive buffer holding a request frame after some other data.
+request_frame = build_request_message(7, BODY_DATA, service_id=1)
+rx_buffer = bytearray(100) + request_frame
+reader = FrameReader()
+
+response_message = RequestMessage(7, len(BODY_DATA)).create_response()
+response_frame = build_response_message(7, STATUS_OK, BODY_DATA)
+file_join_body = memoryview(FILE_JOIN_REQUEST.encode(FILE_A_DATA, FILE_B_DATA))
+
+# The old and new code must agree before they are compared.
+old_request, new_request = old_peek_header(rx_buffer, 100), reader.parse_header(rx_buffer, 100)
+for name in ('request_id', 'body_length', 'encoding', 'accept_encodings', 'batch', 'service_id'):
+    assert getattr(old_request, name) == getattr(new_request, name)
+assert old_build_response_header(7, STATUS_OK, 64, 1) == response_message.build_header(STATUS_OK, 64, 1)
+assert old_build_request(7, BODY_DATA) == build_request_message(7, BODY_DATA)
+assert old_parse_response(response_frame) == new_parse_response(response_frame)
+assert old_parse_file_join(file_join_body) == new_parse_file_join(file_join_body)
+assert old_build_file_join(FILE_A_DATA, FILE_B_DATA) == FILE_JOIN_REQUEST.encode(FILE_A_DATA, FILE_B_DATA)
+
+cases = [
+        ('request header parse', (old_peek_header, rx_buffer, 100), (reader.parse_header, rx_buffer, 100)),
+        ('response header build', (old_build_response_header, 7, STATUS_OK, 64, 1),
+            (response_message.build_header, STATUS_OK, 64, 1)),
+        ('client request build', (old_build_request, 7, BODY_DATA), (build_request_message, 7, BODY_DATA)),
+        ('client response parse', (old_parse_response, response_frame), (new_parse_response, response_frame)),
+        ('file-join body parse', (old_parse_file_join, file_join_body), (new_parse_file_join, file_join_body)),
+        ('file-join body build', (old_build_file_join, FILE_A_DATA, FILE_B_DATA),
+            (FILE_JOIN_REQUEST.encode, FILE_A_DATA, FILE_B_DATA))
+    ]
+
+print(f'{"case":>22} {"old ns":>8} {"new ns":>8} {"speedup":>8}')
+
+for name, old_case, new_case in cases:
+    old_ns = measure(*old_case)
+    new_ns = measure(*new_case)
+    print(f'{name:>22} {old_ns:8.0f} {new_ns:8.0f} {old_ns / new_ns:7.2f}x')
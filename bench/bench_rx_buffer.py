@@ -0,0 +1,102 @@
+################################################################################
+# Receive buffer benchmark.                                                    #
+#                                                                              #
+# Compares CPU time and peak memory per MB received for the former list based  #
+# receive path and FrameReader (bytearray + recv_into + memoryview).           #
+################################################################################
+
+import os, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import FrameReader, RequestMessage, RECV_BUFSIZE, MESSAGE_HEADER_LENGTH
+from common.protocol import REQUEST_MAGIC_NUMBER
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BODY_SIZES = [64 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class FakeConnection:
+    # Hands out a preloaded byte string in RECV_BUFSIZE chunks so that only
+    # the user space receive path is measured.
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+        
+    def recv(self, bufsize):
+        chunk = bytes(self.data[self.offset:self.offset + bufsize])
+        self.offset += len(chunk)
+        return chunk
+        
+    def recv_into(self, buffer):
+        count = min(len(buffer), RECV_BUFSIZE, len(self.data) - self.offset)
+        buffer[0:count] = self.data[self.offset:self.offset + count]
+        self.offset += count
+        return count
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def build_frame(body_length):
+    return (
+        REQUEST_MAGIC_NUMBER +
+        (1).to_bytes(4, byteorder='little') +
+        body_length.to_bytes(4, byteorder='little') +
+        bytes(4) +
+        bytes(body_length)
+    )
+
+def receive_list(connection, frame_length):
+    # The former ClientHandler.read_ready path.
+    rx_data = []
+    while True:
+        data = connection.recv(RECV_BUFSIZE)
+        rx_data += list(data)
+        if len(rx_data) == frame_length:
+            request = RequestMessage(1, frame_length - MESSAGE_HEADER_LENGTH)
+            request.body_data = bytes(rx_data[MESSAGE_HEADER_LENGTH:])
+            return len(request.body_data)
+
+def receive_frame_reader(connection, frame_length):
+    reader = FrameReader()
+    while True:
+        reader.recv_from(connection)
+        request = reader.next_frame()
+        if request:
+            length = len(request.body_data)
+            reader.release(request)
+            return length
+
+def measure(receive, frame):
+    tracemalloc.start()
+    start_time = time.process_time()
+    
+    receive(FakeConnection(frame), len(frame))
+    
+    cpu_time = time.process_time() - start_time
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    return cpu_time, peak
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+print(f'{"body":>10} {"path":>12} {"cpu ms/MB":>10} {"peak MB/MB":>11}')
+
+for body_size in BODY_SIZES:
+    frame = build_frame(body_size)
+    mb = body_size / (1024 * 1024)
+    
+    for name, receive in [('list', receive_list), ('FrameReader', receive_frame_reader)]:
+        cpu_time, peak = measure(receive, frame)
+        print(f'{body_size:10} {name:>12} {cpu_time * 1000 / mb:10.2f} {peak / (1024 * 1024) / mb:11.2f}')
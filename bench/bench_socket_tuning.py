@@ -0,0 +1,194 @@
+################################################################################
+# Listener and socket tuning benchmark.                                        #
+#                                                                              #
+# 1. Connect storm: CONNECT_COUNT clients connect at once and each sends one   #
+#    small request. Reports the time until all are answered or failed, how     #
+#    many waited over a second and how many failed, for the old backlog        #
+#    of 5 with one accept per wakeup and for a long backlog with batched       #
+#    accepts.                                                                  #
+# 2. Large bodies: round trip latency of file-join requests with the old       #
+#    settings (Nagle on, 4 KB receives), with TCP_NODELAY only, and with the   #
+#    new defaults (TCP_NODELAY, receives that follow the body length).         #
+################################################################################
+
+import os, sys, time, socket, selectors, threading, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, SocketOptions, ENGINE_SELECTORS, RECV_BUFSIZE
+from tcp_server import DEFAULT_ACCEPT_BATCH, DEFAULT_MAX_RECV_SIZE
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+from tcp_client import TcpClient
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BASE_PORT = 31000
+
+CONNECT_COUNT = 3000
+
+# Clients not answered by then count as failed.
+STORM_TIMEOUT = 30
+
+# name -> (backlog, accept_batch)
+STORM_CONFIGS = {
+        'old': (5, 1),
+        'backlog': (1024, 1),
+        'backlog+batch': (1024, DEFAULT_ACCEPT_BATCH)
+    }
+
+# name -> (tcp_nodelay, max_recv_size)
+BODY_CONFIGS = {
+        'old': (False, RECV_BUFSIZE),
+        'nodelay': (True, RECV_BUFSIZE),
+        'new': (True, DEFAULT_MAX_RECV_SIZE)
+    }
+
+# (body length, round trips)
+BODY_PAYLOADS = [(64 * 1024, 200), (1024 * 1024, 100), (16 * 1024 * 1024, 10)]
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(port, backlog, accept_batch, no_delay, max_recv_size):
+    # The file-join service is streamed for bodies the response cache does
+    # not take.
+    services = ServiceRegistry()
+    services.register('file-join', FileJoinService)
+    
+    handler_factory = ClientHandlerFactory(services, max_body_length=64 * 1024 * 1024, max_recv_size=max_recv_size)
+    tcp_server = TcpServer('bench-server', ENGINE_SELECTORS, backlog=backlog,
+        socket_options=SocketOptions(no_delay=no_delay), accept_batch=accept_batch)
+    tcp_server.run(port, handler_factory)
+
+def start_server(port, *args):
+    process = multiprocessing.Process(target=run_server, args=(port,) + args, daemon=True)
+    process.start()
+    
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def stop_server(process):
+    process.terminate()
+    process.join()
+
+def build_request(body_data):
+    return b'TRRQ' + (1).to_bytes(4, byteorder='little') + len(body_data).to_bytes(4, byteorder='little') + bytes(4) + body_data
+
+def build_body(length):
+    # file-join request: the lengths of file_a and file_b, then both.
+    text = b'x' * (length - 8)
+    file_a_length = len(text) // 2
+    return (file_a_length.to_bytes(4, byteorder='little') + (len(text) - file_a_length).to_bytes(4, byteorder='little') +
+        text)
+
+def connect_storm(port):
+    # Returns the time until every client got its response or failed, the
+    # number of clients that waited over a second and the number that
+    # failed.
+    request_data = build_request(build_body(64))
+    sel = selectors.DefaultSelector()
+    started = time.perf_counter()
+    
+    for i in range(CONNECT_COUNT):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setblocking(False)
+        client.connect_ex(('127.0.0.1', port))
+        sel.register(client, selectors.EVENT_WRITE, [time.perf_counter(), b''])
+    
+    slow = 0
+    failed = 0
+    remaining = CONNECT_COUNT
+    while remaining and time.perf_counter() - started < STORM_TIMEOUT:
+        for key, events in sel.select(1):
+            client, state = key.fileobj, key.data
+            try:
+                if events & selectors.EVENT_WRITE:
+                    client.send(request_data)
+                    sel.modify(client, selectors.EVENT_READ, state)
+                    continue
+                
+                state[1] += client.recv(4096)
+                if len(state[1]) < 16 + int.from_bytes(state[1][8:12], byteorder='little'):
+                    continue
+                if time.perf_counter() - state[0] > 1.0:
+                    slow += 1
+            except OSError:
+                failed += 1
+            
+            sel.unregister(client)
+            client.close()
+            remaining -= 1
+    
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+    sel.close()
+    return time.perf_counter() - started, slow, failed + remaining
+
+def round_trip(client, body_data):
+    # The result is streamed back while the body is sent, so the body is
+    # sent by another thread.
+    request_id = client.request_counter + 1
+    sender = threading.Thread(target=client.send, args=(body_data,))
+    sender.start()
+    status, result_data = client.recv(request_id)
+    sender.join()
+    return status
+
+def body_round_trips(port, body_data, count):
+    client = TcpClient('127.0.0.1', port)
+    round_trip(client, body_data)
+    
+    durations = []
+    for i in range(count):
+        started = time.perf_counter()
+        status = round_trip(client, body_data)
+        durations.append(time.perf_counter() - started)
+        
+        if status != 0:
+            raise RuntimeError(f'Request failed with status {status}')
+    
+    client.close()
+    
+    durations.sort()
+    return durations[len(durations) // 2], sum(durations) / len(durations)
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+port = BASE_PORT
+
+print(f'Connect storm of {CONNECT_COUNT} clients')
+print(f'{"config":>14} {"backlog":>8} {"batch":>6} {"total ms":>9} {"over 1 s":>9} {"failed":>6}')
+
+for name, (backlog, accept_batch) in STORM_CONFIGS.items():
+    process = start_server(port, backlog, accept_batch, True, DEFAULT_MAX_RECV_SIZE)
+    total, slow, failed = connect_storm(port)
+    stop_server(process)
+    port += 1
+    
+    print(f'{name:>14} {backlog:8} {accept_batch:6} {total * 1e3:9.1f} {slow:9} {failed:6}')
+
+print()
+print('Large request bodies')
+print(f'{"config":>14} {"body":>9} {"p50 ms":>9} {"mean ms":>9}')
+
+for name, (no_delay, max_recv_size) in BODY_CONFIGS.items():
+    process = start_server(port, 1024, DEFAULT_ACCEPT_BATCH, no_delay, max_recv_size)
+    for length, count in BODY_PAYLOADS:
+        p50, mean = body_round_trips(port, build_body(length), count)
+        print(f'{name:>14} {length:9} {p50 * 1e3:9.2f} {mean * 1e3:9.2f}')
+    stop_server(process)
+    port += 1
@@ -0,0 +1,142 @@
+################################################################################
+# Streaming service memory benchmark.                                          #
+#                                                                              #
+# Sends one file-join request per server process and reports the server's      #
+# peak RSS (VmHWM). With the streaming FileJoinService the peak stays flat as  #
+# the body grows to 1 GB; the buffered path (process() on a thread pool) grows #
+# with the body. Linux only.                                                   #
+#                                                                              #
+# Usage: python bench_streaming.py [max_body_mb]                               #
+################################################################################
+
+import os, sys, time, socket, threading, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECTORS
+from service_executor import EXECUTION_INLINE, EXECUTION_THREAD
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+from common.protocol import FLAG_STREAM, STATUS_STREAMED, STREAM_TRAILER, unpack_stream_trailer
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BASE_PORT = 50300
+
+MB = 1024 * 1024
+SEND_CHUNK_SIZE = 1 * MB
+
+# (mode, body size in MB)
+RUNS = [
+    (EXECUTION_THREAD, 1), (EXECUTION_THREAD, 64), (EXECUTION_THREAD, 256),
+    (EXECUTION_INLINE, 1), (EXECUTION_INLINE, 64), (EXECUTION_INLINE, 256), (EXECUTION_INLINE, 1024)
+]
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(mode, port):
+    services = ServiceRegistry()
+    services.register('file-join', FileJoinService, mode=mode)
+    
+    TcpServer('bench-server', ENGINE_SELECTORS).run(port, ClientHandlerFactory(services, max_body_length=2 * 1024 * MB))
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def peak_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    
+    return 0.0
+
+def send_request(connection, body_size):
+    file_a_length = body_size // 2 - 4
+    file_b_length = body_size - 8 - file_a_length
+    
+    connection.sendall(
+        b'TRRQ' +
+        (1).to_bytes(4, byteorder='little') +
+        body_size.to_bytes(4, byteorder='little') +
+        bytes([FLAG_STREAM, 0, 0, 0]) +
+        file_a_length.to_bytes(4, byteorder='little') +
+        file_b_length.to_bytes(4, byteorder='little')
+    )
+    
+    chunk = b'a' * SEND_CHUNK_SIZE
+    remaining = body_size - 8
+    while remaining > 0:
+        count = min(remaining, SEND_CHUNK_SIZE)
+        connection.sendall(chunk[:count])
+        remaining -= count
+
+def recv_response(connection, result):
+    buffer = bytearray(SEND_CHUNK_SIZE)
+    header = b''
+    while len(header) < 16:
+        header += connection.recv(16 - len(header))
+    
+    status = header[12]
+    remaining = int.from_bytes(header[8:12], byteorder='little')
+    while remaining > 0:
+        count = connection.recv_into(buffer, min(remaining, len(buffer)))
+        if count == 0:
+            raise ConnectionError('Connection closed')
+        remaining -= count
+        
+        if remaining == 0 and status == STATUS_STREAMED:
+            # The trailer carries the final status and the length of a
+            # replacement result, which follows it.
+            trailer = b''
+            while len(trailer) < STREAM_TRAILER.size:
+                trailer += connection.recv(STREAM_TRAILER.size - len(trailer))
+            status, replaced, remaining = unpack_stream_trailer(trailer)
+    
+    result.append(status)
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+max_body_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+
+print(f'{"mode":>8} {"body MB":>8} {"peak RSS MB":>12} {"sec":>7}')
+
+for i, (mode, body_mb) in enumerate(RUNS):
+    if body_mb > max_body_mb:
+        continue
+    
+    port = BASE_PORT + i
+    process = multiprocessing.Process(target=run_server, args=(mode, port), daemon=True)
+    process.start()
+    wait_for_server(port)
+    
+    start_time = time.perf_counter()
+    
+    connection = socket.create_connection(('127.0.0.1', port))
+    result = []
+    receiver = threading.Thread(target=recv_response, args=(connection, result))
+    receiver.start()
+    send_request(connection, body_mb * MB)
+    receiver.join()
+    connection.close()
+    
+    elapsed_time = time.perf_counter() - start_time
+    name = 'stream' if mode == EXECUTION_INLINE else 'buffered'
+    print(f'{name:>8} {body_mb:8} {peak_rss_mb(process.pid):12.1f} {elapsed_time:7.2f}')
+    
+    process.terminate()
+    process.join()
@@ -0,0 +1,75 @@
+################################################################################
+# Timer wheel benchmark.                                                       #
+#                                                                              #
+# With N connections armed at spread out deadlines, measures the cost of       #
+# arming a timer, of a tick that expires nothing and of expiring one timer.    #
+# All three should stay flat as N grows.                                       #
+################################################################################
+
+import os, sys, time, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from timer_wheel import ConnectionTimeouts
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+CONNECTION_COUNTS = [1000, 10000, 50000, 100000]
+
+IDLE_TIMEOUT = 300.0
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class IdleHandler:
+    # Stands in for a connection handler whose timer finds it idle.
+    def __init__(self):
+        self.closed = False
+        self.timer_deadline = None
+    
+    def check_timeouts(self, now):
+        return 'idle'
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def bench(count):
+    timeouts = ConnectionTimeouts(IDLE_TIMEOUT)
+    start = timeouts.wheel.next_time
+    handlers = [IdleHandler() for i in range(count)]
+    deadlines = [start + random.uniform(0, IDLE_TIMEOUT) for i in range(count)]
+    
+    started = time.perf_counter()
+    for handler, deadline in zip(handlers, deadlines):
+        handler.timer_deadline = deadline
+        timeouts.schedule(handler, deadline)
+    schedule_time = (time.perf_counter() - started) / count
+    
+    # A tick between the ticks of the wheel, where nothing is due.
+    started = time.perf_counter()
+    for i in range(count):
+        timeouts.expire(start - timeouts.wheel.tick / 2)
+    idle_tick_time = (time.perf_counter() - started) / count
+    
+    # Every tick of the idle timeout, each expiring about count / 300 timers.
+    expired = 0
+    started = time.perf_counter()
+    for tick in range(int(IDLE_TIMEOUT / timeouts.wheel.tick) + 2):
+        expired += len(timeouts.expire(start + tick * timeouts.wheel.tick))
+    expire_time = (time.perf_counter() - started) / max(expired, 1)
+    
+    return schedule_time, idle_tick_time, expire_time, expired
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+print(f'{"connections":>12} {"arm ns":>8} {"idle tick ns":>13} {"expire ns":>10} {"expired":>8}')
+
+for count in CONNECTION_COUNTS:
+    schedule_time, idle_tick_time, expire_time, expired = bench(count)
+    print(f'{count:12} {schedule_time * 1e9:8.0f} {idle_tick_time * 1e9:13.0f} {expire_time * 1e9:10.0f} {expired:8}')
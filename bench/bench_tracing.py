@@ -0,0 +1,154 @@
+################################################################################
+# Request tracing overhead benchmark.                                          #
+#                                                                              #
+# Round trip latency of small file-join requests, one at a time, and the       #
+# throughput of pipelined requests, on the selectors and asyncio engines       #
+# without a tracer, with a tracer that records the phase histograms, and       #
+# with a sampling profile running.                                             #
+################################################################################
+
+import os, sys, time, socket, tempfile, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECTORS
+from asyncio_server import AsyncioTcpServer, ENGINE_ASYNCIO
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+from common.service_bodies import FILE_JOIN_REQUEST
+from metrics import Metrics
+from profiling import RequestTracer, Profiler, PROFILE_SAMPLE
+from common.protocol import MESSAGE_HEADER_LENGTH, build_request_message, unpack_response_header
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BASE_PORT = 32000
+
+ROUND_TRIPS = 5000
+
+PIPELINE_DEPTH = 32
+PIPELINE_ROUNDS = 500
+
+# name -> (trace requests, profile)
+CONFIGS = {
+        'off': (False, False),
+        'trace': (True, False),
+        'trace+sample': (True, True)
+    }
+
+ENGINES = [ENGINE_SELECTORS, ENGINE_ASYNCIO]
+
+# The profile runs until the server is stopped and is never written.
+PROFILE_DIR = tempfile.gettempdir()
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(port, engine, trace, profile):
+    # The response cache is off, so that every request reaches the service.
+    services = ServiceRegistry()
+    services.register('file-join', FileJoinService)
+    
+    metrics = Metrics()
+    tracer = RequestTracer(None, metrics) if trace else None
+    handler_factory = ClientHandlerFactory(services, metrics=metrics, tracer=tracer)
+    
+    profiler = None
+    if profile:
+        profiler = Profiler(PROFILE_DIR, 3600, PROFILE_SAMPLE)
+        profiler.request()
+    
+    if engine == ENGINE_ASYNCIO:
+        tcp_server = AsyncioTcpServer('bench-server', use_uvloop=False, profiler=profiler)
+    else:
+        tcp_server = TcpServer('bench-server', engine, profiler=profiler)
+    tcp_server.run(port, handler_factory)
+
+def start_server(port, *args):
+    process = multiprocessing.Process(target=run_server, args=(port,) + args, daemon=True)
+    process.start()
+    
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            # A requested profile starts with the first poll.
+            time.sleep(1.0)
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def stop_server(process):
+    process.terminate()
+    process.join()
+
+def recv_response(client):
+    header = b''
+    while len(header) < MESSAGE_HEADER_LENGTH:
+        header += client.recv(MESSAGE_HEADER_LENGTH - len(header))
+    
+    magic_number, request_id, result_length, status, encoding = unpack_response_header(header)
+    remaining = result_length
+    while remaining:
+        remaining -= len(client.recv(remaining))
+    return status
+
+def round_trips(port, body_data):
+    # Returns the median and the mean round trip.
+    client = socket.create_connection(('127.0.0.1', port))
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    durations = []
+    for request_id in range(ROUND_TRIPS):
+        started = time.perf_counter()
+        client.sendall(build_request_message(request_id, body_data))
+        status = recv_response(client)
+        durations.append(time.perf_counter() - started)
+        
+        if status != 0:
+            raise RuntimeError(f'Request failed with status {status}')
+    
+    client.close()
+    
+    durations.sort()
+    return durations[len(durations) // 2], sum(durations) / len(durations)
+
+def pipelined(port, body_data):
+    # Returns requests per second.
+    client = socket.create_connection(('127.0.0.1', port))
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    batch = b''.join(build_request_message(request_id, body_data) for request_id in range(PIPELINE_DEPTH))
+    
+    started = time.perf_counter()
+    for i in range(PIPELINE_ROUNDS):
+        client.sendall(batch)
+        for request_id in range(PIPELINE_DEPTH):
+            recv_response(client)
+    duration = time.perf_counter() - started
+    
+    client.close()
+    return PIPELINE_DEPTH * PIPELINE_ROUNDS / duration
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+body_data = FILE_JOIN_REQUEST.encode(b'Hello' * 10, b'World' * 10)
+port = BASE_PORT
+
+print(f'{"engine":>10} {"config":>14} {"p50 us":>8} {"mean us":>8} {"pipelined req/s":>16}')
+
+for engine in ENGINES:
+    for name, (trace, profile) in CONFIGS.items():
+        process = start_server(port, engine, trace, profile)
+        p50, mean = round_trips(port, body_data)
+        throughput = pipelined(port, body_data)
+        stop_server(process)
+        port += 1
+        
+        print(f'{engine:>10} {name:>14} {p50 * 1e6:8.1f} {mean * 1e6:8.1f} {throughput:16.0f}')
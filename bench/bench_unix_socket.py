@@ -0,0 +1,100 @@
+################################################################################
+# Unix domain socket benchmark.                                                #
+#                                                                              #
+# Round trip latency of TcpClient calls to the file-join service over          #
+# loopback TCP and over a Unix domain socket of the same server, for small     #
+# and large request bodies.                                                    #
+################################################################################
+
+import os, sys, time, socket, tempfile, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECTORS
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+from tcp_client import TcpClient
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+PORT = 30900
+
+# (body length, round trips)
+PAYLOADS = [(64, 20000), (64 * 1024, 5000), (1024 * 1024, 500)]
+
+WARMUP_ROUND_TRIPS = 100
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(port, unix_path):
+    services = ServiceRegistry()
+    services.register('file-join', FileJoinService)
+    TcpServer('bench-server', ENGINE_SELECTORS, unix_path=unix_path).run(port, ClientHandlerFactory(services))
+
+def wait_for_server(port, unix_path):
+    for i in range(100):
+        if os.path.exists(unix_path):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                return
+            except ConnectionRefusedError:
+                pass
+        time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def build_body(length):
+    # file-join request: the lengths of file_a and file_b, then both.
+    text = b'x' * (length - 8)
+    file_a_length = len(text) // 2
+    return (file_a_length.to_bytes(4, byteorder='little') + (len(text) - file_a_length).to_bytes(4, byteorder='little') +
+        text)
+
+def bench(host, port, body_data, count):
+    client = TcpClient(host, port)
+    for i in range(WARMUP_ROUND_TRIPS):
+        client.send(body_data)
+        client.recv()
+    
+    durations = []
+    for i in range(count):
+        started = time.perf_counter()
+        client.send(body_data)
+        status, result_data = client.recv()
+        durations.append(time.perf_counter() - started)
+        
+        if status != 0:
+            raise RuntimeError(f'Request failed with status {status}')
+    
+    client.close()
+    
+    durations.sort()
+    return durations[len(durations) // 2], durations[int(len(durations) * 0.99)], sum(durations) / len(durations)
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+with tempfile.TemporaryDirectory() as dir_path:
+    unix_path = os.path.join(dir_path, 'bench.sock')
+    
+    process = multiprocessing.Process(target=run_server, args=(PORT, unix_path), daemon=True)
+    process.start()
+    wait_for_server(PORT, unix_path)
+    
+    print(f'{"transport":>10} {"body":>8} {"p50 us":>8} {"p99 us":>8} {"mean us":>8}')
+    
+    for length, count in PAYLOADS:
+        body_data = build_body(length)
+        for transport, host in [('tcp', '127.0.0.1'), ('unix', f'unix:{unix_path}')]:
+            p50, p99, mean = bench(host, PORT, body_data, count)
+            print(f'{transport:>10} {length:8} {p50 * 1e6:8.1f} {p99 * 1e6:8.1f} {mean * 1e6:8.1f}')
+    
+    process.terminate()
+    process.join()
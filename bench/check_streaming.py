@@ -0,0 +1,312 @@
+################################################################################
+# Streaming service checks.                                                    #
+#                                                                              #
+# Scripted assertions for streamed requests on each engine. Exits with status  #
+# 1 when a check fails.                                                        #
+#   1. Interleaving: an async-delay request followed by a slowly sent 2 MB     #
+#      file-join request. The stream must not start before the delayed         #
+#      response is sent, so both responses arrive whole and in order.          #
+#   2. Validation: invalid UTF-8 early and late in the body, a UTF-8 sequence  #
+#      split between file_a and file_b, file lengths past the end of the body  #
+#      and a body too short for the lengths. Each result must equal what       #
+#      FileJoinService.process() returns for the same body, and a request      #
+#      sent after it on the same connection must still be answered.            #
+#   3. Plain clients: file-join requests without FLAG_STREAM are answered with #
+#      a STATUS_OK header and no trailer.                                      #
+#   4. Memory: the server's peak RSS after a 1 GB streamed request stays       #
+#      within RSS_MARGIN_MB of its peak after a 16 MB one. Linux only.         #
+#                                                                              #
+# Usage: python check_streaming.py                                             #
+################################################################################
+
+import os, sys, time, types, socket, threading, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, ENGINE_SELECT, ENGINE_SELECTORS
+from asyncio_server import AsyncioTcpServer, ENGINE_ASYNCIO
+from service_registry import ServiceRegistry
+from services.file_join_service import FileJoinService
+from services.async_delay_service import AsyncDelayService
+from common.service_bodies import FILE_JOIN_REQUEST, SEPARATOR_DATA, ASYNC_DELAY_REQUEST
+from common.protocol import MESSAGE_HEADER_LENGTH, FLAG_STREAM, STATUS_OK, STATUS_STREAMED, STREAM_TRAILER
+from common.protocol import build_request_header, unpack_response_header, unpack_stream_trailer
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+BASE_PORT = 50400
+
+ENGINES = [ENGINE_SELECT, ENGINE_SELECTORS, ENGINE_ASYNCIO]
+
+FILE_JOIN_SERVICE_ID = 1
+ASYNC_DELAY_SERVICE_ID = 3
+
+MB = 1024 * 1024
+
+# The file-join body is sent in chunks with a pause after each, so that the
+# stream would be running while the delayed response completes.
+SEND_CHUNK_SIZE = 64 * 1024
+SEND_PAUSE = 0.01
+DELAY_MS = 100
+
+RECV_TIMEOUT = 10.0
+
+# Body sizes of the memory check, and how much more the peak RSS after the
+# large one may be. A buffered body or result would add about its size.
+RSS_SMALL_BODY = 16 * MB
+RSS_LARGE_BODY = 1024 * MB
+RSS_MARGIN_MB = 64
+RSS_CHUNK_SIZE = MB
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def run_server(engine, port):
+    services = ServiceRegistry()
+    services.register('file-join', FileJoinService, FILE_JOIN_SERVICE_ID)
+    services.register('async-delay', AsyncDelayService, ASYNC_DELAY_SERVICE_ID)
+    handler_factory = ClientHandlerFactory(services, max_body_length=2 * RSS_LARGE_BODY)
+    
+    if engine == ENGINE_ASYNCIO:
+        tcp_server = AsyncioTcpServer('check-server', use_uvloop=False)
+    else:
+        tcp_server = TcpServer('check-server', engine)
+    tcp_server.run(port, handler_factory)
+
+def start_server(engine, port):
+    process = multiprocessing.Process(target=run_server, args=(engine, port), daemon=True)
+    process.start()
+    
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    
+    raise RuntimeError(f'Server on port {port} did not start')
+
+def recv_exact(connection, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = connection.recv(min(length - len(data), MB))
+        if not chunk:
+            raise ConnectionError('Connection closed by server')
+        data += chunk
+    return bytes(data)
+
+def recv_responses(connection, count, responses):
+    # Appends (request ID, status, result data) of 'count' responses, or the
+    # exception that ended the receive.
+    try:
+        for i in range(count):
+            magic_number, request_id, result_length, status, encoding = unpack_response_header(
+                recv_exact(connection, MESSAGE_HEADER_LENGTH))
+            result_data = recv_exact(connection, result_length)
+            if status == STATUS_STREAMED:
+                status, replaced, replacement_length = unpack_stream_trailer(
+                    recv_exact(connection, STREAM_TRAILER.size))
+                replacement_data = recv_exact(connection, replacement_length)
+                if replaced:
+                    result_data = replacement_data
+            responses.append((request_id, status, result_data))
+    except Exception as ex:
+        responses.append(ex)
+
+def recv_plain_responses(connection, count, responses):
+    # Reads responses like a client that does not know FLAG_STREAM: a
+    # header and the result, no trailer.
+    try:
+        for i in range(count):
+            magic_number, request_id, result_length, status, encoding = unpack_response_header(
+                recv_exact(connection, MESSAGE_HEADER_LENGTH))
+            responses.append((request_id, status, recv_exact(connection, result_length)))
+    except Exception as ex:
+        responses.append(ex)
+
+def recv_discard(connection, results):
+    # Reads one streamed response without keeping its result. Appends the
+    # final status and the result length.
+    try:
+        buffer = bytearray(RSS_CHUNK_SIZE)
+        magic_number, request_id, result_length, status, encoding = unpack_response_header(
+            recv_exact(connection, MESSAGE_HEADER_LENGTH))
+        
+        remaining = result_length
+        while remaining > 0:
+            count = connection.recv_into(buffer, min(remaining, len(buffer)))
+            if count == 0:
+                raise ConnectionError('Connection closed by server')
+            remaining -= count
+        
+        if status == STATUS_STREAMED:
+            status, replaced, replacement_length = unpack_stream_trailer(recv_exact(connection, STREAM_TRAILER.size))
+            recv_exact(connection, replacement_length)
+        results.append((status, result_length))
+    except Exception as ex:
+        results.append(ex)
+
+def send_slowly(connection, data):
+    for offset in range(0, len(data), SEND_CHUNK_SIZE):
+        connection.sendall(data[offset:offset + SEND_CHUNK_SIZE])
+        time.sleep(SEND_PAUSE)
+
+def check_interleaving(port):
+    file_a_data = b'a' * MB
+    file_b_data = b'b' * MB
+    delay_body = ASYNC_DELAY_REQUEST.encode(DELAY_MS, b'delayed')
+    join_body = FILE_JOIN_REQUEST.encode(file_a_data, file_b_data)
+    
+    connection = socket.create_connection(('127.0.0.1', port))
+    connection.settimeout(RECV_TIMEOUT)
+    responses = []
+    receiver = threading.Thread(target=recv_responses, args=(connection, 2, responses))
+    receiver.start()
+    
+    connection.sendall(build_request_header(1, len(delay_body), service_id=ASYNC_DELAY_SERVICE_ID) + delay_body)
+    connection.sendall(build_request_header(2, len(join_body), FLAG_STREAM, service_id=FILE_JOIN_SERVICE_ID))
+    send_slowly(connection, join_body)
+    
+    receiver.join()
+    connection.close()
+    
+    expected = [(1, STATUS_OK, b'delayed'), (2, STATUS_OK, file_a_data + SEPARATOR_DATA + file_b_data)]
+    return check('interleaving', responses, expected)
+
+def check_validation(port):
+    # name -> request body
+    file_data = b'a' * MB
+    file_head = FILE_JOIN_REQUEST.head
+    bodies = {
+            'invalid utf-8 early': FILE_JOIN_REQUEST.encode(b'\xff' + file_data, file_data),
+            'invalid utf-8 late': FILE_JOIN_REQUEST.encode(file_data, file_data + b'\xff'),
+            'split utf-8': FILE_JOIN_REQUEST.encode(file_data + b'\xc3', b'\xa9' + file_data),
+            'lengths past body': file_head.pack(MB, MB) + file_data,
+            'short body': file_head.pack(1, 1)[:5]
+        }
+    follow_body = FILE_JOIN_REQUEST.encode(b'Hello', b'World')
+    
+    passed = True
+    for name, body in bodies.items():
+        connection = socket.create_connection(('127.0.0.1', port))
+        connection.settimeout(RECV_TIMEOUT)
+        responses = []
+        receiver = threading.Thread(target=recv_responses, args=(connection, 2, responses))
+        receiver.start()
+        
+        connection.sendall(build_request_header(1, len(body), FLAG_STREAM, service_id=FILE_JOIN_SERVICE_ID))
+        send_slowly(connection, body)
+        connection.sendall(build_request_header(2, len(follow_body), FLAG_STREAM, service_id=FILE_JOIN_SERVICE_ID) +
+            follow_body)
+        
+        receiver.join()
+        connection.close()
+        
+        expected = [(1, STATUS_OK, buffered_result(1, body)), (2, STATUS_OK, buffered_result(2, follow_body))]
+        passed = check(name, responses, expected) and passed
+    
+    return passed
+
+def check_plain_client(port):
+    file_data = b'a' * MB
+    bodies = [FILE_JOIN_REQUEST.encode(file_data, file_data), FILE_JOIN_REQUEST.encode(b'\xff', file_data)]
+    
+    connection = socket.create_connection(('127.0.0.1', port))
+    connection.settimeout(RECV_TIMEOUT)
+    responses = []
+    receiver = threading.Thread(target=recv_plain_responses, args=(connection, len(bodies), responses))
+    receiver.start()
+    
+    for request_id, body in enumerate(bodies, 1):
+        connection.sendall(build_request_header(request_id, len(body), service_id=FILE_JOIN_SERVICE_ID))
+        send_slowly(connection, body)
+    
+    receiver.join()
+    connection.close()
+    
+    expected = [(request_id, STATUS_OK, buffered_result(request_id, body)) for request_id, body in enumerate(bodies, 1)]
+    return check('plain client', responses, expected)
+
+def check_memory(port, pid):
+    peaks = []
+    for body_size in [RSS_SMALL_BODY, RSS_LARGE_BODY]:
+        connection = socket.create_connection(('127.0.0.1', port))
+        connection.settimeout(RECV_TIMEOUT)
+        results = []
+        receiver = threading.Thread(target=recv_discard, args=(connection, results))
+        receiver.start()
+        
+        file_a_length = body_size // 2
+        file_b_length = body_size - FILE_JOIN_REQUEST.head.size - file_a_length
+        connection.sendall(build_request_header(1, body_size, FLAG_STREAM, service_id=FILE_JOIN_SERVICE_ID) +
+            FILE_JOIN_REQUEST.head.pack(file_a_length, file_b_length))
+        chunk = b'a' * RSS_CHUNK_SIZE
+        remaining = file_a_length + file_b_length
+        while remaining > 0:
+            connection.sendall(chunk[:remaining])
+            remaining -= len(chunk)
+        
+        receiver.join()
+        connection.close()
+        
+        expected = [(STATUS_OK, file_a_length + len(SEPARATOR_DATA) + file_b_length)]
+        if results != expected:
+            print(f'    memory: FAILED, {body_size // MB} MB request got {results}')
+            return False
+        peaks.append(peak_rss_mb(pid))
+    
+    if peaks[1] > peaks[0] + RSS_MARGIN_MB:
+        print(f'    memory: FAILED, peak RSS {peaks[0]:.1f} MB after {RSS_SMALL_BODY // MB} MB, '
+            f'{peaks[1]:.1f} MB after {RSS_LARGE_BODY // MB} MB')
+        return False
+    
+    print(f'    memory: ok, peak RSS {peaks[0]:.1f} MB after {RSS_SMALL_BODY // MB} MB, '
+        f'{peaks[1]:.1f} MB after {RSS_LARGE_BODY // MB} MB')
+    return True
+
+def peak_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    
+    return 0.0
+
+def buffered_result(request_id, body):
+    # The result of the buffered path for the same request.
+    request = types.SimpleNamespace(request_id=request_id, body_data=body)
+    return FileJoinService().process(request)
+
+def check(name, responses, expected):
+    if responses == expected:
+        print(f'    {name}: ok')
+        return True
+    
+    summary = [response if isinstance(response, Exception) else (response[0], response[1], len(response[2]))
+        for response in responses]
+    print(f'    {name}: FAILED, got {summary}')
+    return False
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+passed = True
+
+for i, engine in enumerate(ENGINES):
+    print(engine)
+    process = start_server(engine, BASE_PORT + i)
+    
+    passed = check_interleaving(BASE_PORT + i) and passed
+    passed = check_validation(BASE_PORT + i) and passed
+    passed = check_plain_client(BASE_PORT + i) and passed
+    passed = check_memory(BASE_PORT + i, process.pid) and passed
+    
+    process.terminate()
+    process.join()
+
+sys.exit(0 if passed else 1)
@@ -0,0 +1,70 @@
+################################################################################
+# Scenario suite.                                                              #
+#                                                                              #
+# Runs the load generator scenarios in bench/scenarios/<service>.json against  #
+# a server that is already running that service, e.g.                          #
+#   python server_main.py file-join                                            #
+#   python run_scenarios.py file-join --json results.json                      #
+################################################################################
+
+import os, sys, json, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from load_generator import run_scenario, format_result
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+SCENARIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenarios')
+
+# Shorter than the load generator defaults, so the suite runs in minutes.
+SUITE_WARMUP = 1.0
+SUITE_DURATION = 5.0
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def load_scenarios(server_service):
+    path = os.path.join(SCENARIO_DIR, f'{server_service}.json')
+    with open(path) as scenario_file:
+        suite = json.load(scenario_file)
+    return suite['scenarios']
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Runs the scenario suite of one server service.')
+    parser.add_argument('service', help='service the server runs, e.g. file-join')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50000)
+    parser.add_argument('--warmup', type=float, default=SUITE_WARMUP)
+    parser.add_argument('--duration', type=float, default=SUITE_DURATION)
+    parser.add_argument('--only', help='run only the scenario with this name')
+    parser.add_argument('--json', help='write the results to this file')
+    return parser.parse_args(argv)
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+args = parse_args(sys.argv[1:])
+
+results = []
+
+for scenario in load_scenarios(args.service):
+    if args.only and scenario['name'] != args.only:
+        continue
+    
+    scenario = dict({'warmup': args.warmup, 'duration': args.duration}, **scenario)
+    scenario['host'] = args.host
+    scenario['port'] = args.port
+    
+    result = run_scenario(scenario)
+    results.append(result)
+    print(format_result(result), flush=True)
+
+if args.json:
+    with open(args.json, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
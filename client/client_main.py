@@ -2,16 +2,14 @@
 # Test TCP socket client.                                                      #
 ################################################################################
 
-import sys, time
+import os, sys, time
 import threading
-from tcp_client import TcpClient
 
-################################################################################
-# Constants                                                                    #
-################################################################################
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-STATUS_OK = 0
-STATUS_SERVICE_ERROR = 1
+from tcp_client import TcpClient
+from common.protocol import STATUS_OK
+from common.service_bodies import FILE_JOIN_REQUEST
 
 ################################################################################
 # Functions                                                                    #
@@ -20,29 +18,19 @@ STATUS_SERVICE_ERROR = 1
 def build_request_data(file_a, file_b):
     with open(file_a, mode='r') as cfile:
         file_a_text = cfile.read()
-    file_a_data = file_a_text.encode('utf-8')
-    file_a_data_len = len(file_a_data).to_bytes(4, byteorder='little')
     
     with open(file_b, mode='r') as cfile:
         file_b_text = cfile.read()
-    file_b_data = file_b_text.encode('utf-8')
-    file_b_data_len = len(file_b_data).to_bytes(4, byteorder='little')
     
-    request_data = (
-        file_a_data_len + 
-        file_b_data_len +
-        file_a_data +
-        file_b_data
-    )
-    
-    return request_data
+    return FILE_JOIN_REQUEST.encode(file_a_text.encode('utf-8'), file_b_text.encode('utf-8'))
 
 def do_test(thread_name, 
         host, port, 
         connection_count, loop_per_connection, 
-        file_a, file_b):
+        body_data, fragmented):
     send_count = 0
     error_count = 0
+    result_data = None
 
     start_time = time.time()
 
@@ -51,16 +39,13 @@ def do_test(thread_name,
 
         for i in range(loop_per_connection):
             send_count = send_count + 1
-        
-            body_data = build_request_data(file_a, file_b)
             
-            tcp_client.send(body_data)
+            tcp_client.send(body_data, fragmented)
         
             status, result_data = tcp_client.recv()
         
             if status != STATUS_OK:
                 error_count = error_count + 1
-            print(f'[{thread_name}] send = {send_count:7}, error = {error_count:7}, result = {result_data}', end = '\r')
         
         tcp_client.close()
     
@@ -69,7 +54,9 @@ def do_test(thread_name,
     print(f'[{thread_name}] send = {send_count:7}, error = {error_count:7}, result = {result_data}, elapsed_time = {elapsed_time:.3f} sec')
 
 def print_usage(script_name):
-    print(f'Usage: python {script_name} <ip> <port> <connection_count> <loop_per_connection>')
+    print(f'Usage: python {script_name} <ip> <port> <connection_count> <loop_per_connection> [fragmented]')
+    print('<ip> may be unix:<path> for a Unix domain socket, the port is then not used.')
+    print('For load tests, use load_generator.py.')
             
 ################################################################################
 # Configuration                                                                #
@@ -92,6 +79,10 @@ host = sys.argv[1]
 port = int(sys.argv[2])
 connection_count = int(sys.argv[3])
 loop_per_connection = int(sys.argv[4])
+fragmented = len(sys.argv) > 5 and sys.argv[5] == 'fragmented'
+
+# The request is the same every time, so it is built once.
+body_data = build_request_data(file_a, file_b)
 
 thread_list = []
 
@@ -102,7 +93,7 @@ for i in range(thread_count):
             args = (thread_name, 
                     host, port, 
                     connection_count, loop_per_connection, 
-                    file_a, file_b)
+                    body_data, fragmented)
         )
     thread_list.append(t)
 
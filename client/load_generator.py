@@ -0,0 +1,619 @@
+################################################################################
+# Load generator.                                                              #
+#                                                                              #
+# Features:                                                                    #
+#   1. Non-blocking connections driven by one selectors loop per process.      #
+#   2. Closed-loop mode: every connection keeps 'pipeline' requests            #
+#      outstanding.                                                            #
+#   3. Open-loop mode: requests are sent at a fixed arrival rate, whether or   #
+#      not earlier responses arrived.                                          #
+#   4. Latency percentiles corrected for coordinated omission, as JSON.        #
+#   5. Fragmentation test mode that sends each request in delayed pieces.      #
+#   6. A host of 'unix:<path>' connects through a Unix domain socket.          #
+################################################################################
+
+import sys, os, time, math, json, random, string, socket, selectors, collections, argparse
+import multiprocessing
+from array import array
+
+# Importers put the repository root on sys.path themselves.
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.protocol import MESSAGE_HEADER_LENGTH, STATUS_OK, build_request_header, unpack_response_header
+from common.service_bodies import FILE_JOIN_REQUEST, SEPARATOR_DATA, ASYNC_DELAY_REQUEST
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+RECV_BUFSIZE = 256 * 1024
+
+# A host of 'unix:<path>' is a Unix domain socket; the port is not used.
+UNIX_ADDRESS_PREFIX = 'unix:'
+
+MODE_CLOSED = 'closed'
+MODE_OPEN   = 'open'
+
+ARRIVAL_UNIFORM = 'uniform'
+ARRIVAL_POISSON = 'poisson'
+
+SERVICE_FILE_JOIN   = 'file-join'
+SERVICE_ASYNC_DELAY = 'async-delay'
+SERVICE_RAW         = 'raw'
+
+# The former TcpClient.send pattern: a request is sent in pieces ending at
+# these offsets, with these pauses before the second, third and last piece.
+FRAGMENT_ENDS = (10, 50, 500)
+FRAGMENT_DELAYS = (0.005, 0.01, 0.05)
+
+PERCENTILES = (50, 90, 99, 99.9, 99.99)
+
+# Outstanding responses are waited for this long after the run.
+DRAIN_TIMEOUT = 5.0
+
+MAX_SELECT_TIMEOUT = 0.05
+
+# Maximum number of buffers passed to one sendmsg call.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+DEFAULT_SCENARIO = {
+    'name': 'default',
+    'host': '127.0.0.1',
+    'port': 50000,
+    'service': SERVICE_FILE_JOIN,
+    'mode': MODE_CLOSED,
+    'connections': 4,
+    'pipeline': 1,
+    'rate': 1000.0,
+    'arrival': ARRIVAL_UNIFORM,
+    'payload': 'fixed:1024',
+    'delay_ms': 0,
+    'warmup': 1.0,
+    'duration': 10.0,
+    'fragment': False,
+    'processes': 1,
+    'seed': 1
+}
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def parse_size_distribution(spec):
+    # fixed:N, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA or choice:N,N,...
+    kind, _, args = spec.partition(':')
+    
+    if kind == 'fixed':
+        size = int(args)
+        return lambda rng: size
+    elif kind == 'uniform':
+        low, high = (int(arg) for arg in args.split(':'))
+        return lambda rng: rng.randint(low, high)
+    elif kind == 'lognormal':
+        median, sigma = (float(arg) for arg in args.split(':'))
+        mu = math.log(median)
+        return lambda rng: int(rng.lognormvariate(mu, sigma))
+    elif kind == 'choice':
+        sizes = [int(arg) for arg in args.split(',')]
+        return lambda rng: rng.choice(sizes)
+    else:
+        raise ValueError(f'Unknown payload distribution: {spec}')
+
+def percentile(values, p):
+    # values must be sorted.
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+def summarize(latencies):
+    values = sorted(latencies)
+    summary = {'count': len(values)}
+    for p in PERCENTILES:
+        summary[f'p{p:g}'] = percentile(values, p) * 1000
+    summary['max'] = (values[-1] if values else 0.0) * 1000
+    summary['mean'] = (sum(values) / len(values) if values else 0.0) * 1000
+    return summary
+
+def correct_coordinated_omission(latencies, expected_interval):
+    # A closed-loop client does not send while it waits, so a stall of L
+    # seconds hides the requests that would have been sent during it. Like
+    # HdrHistogram's recordValueWithExpectedInterval, each such latency adds
+    # L - E, L - 2E, ... for the expected interval E between requests.
+    corrected = array('d', latencies)
+    if expected_interval <= 0:
+        return corrected
+    
+    for latency in latencies:
+        missed = latency - expected_interval
+        while missed >= expected_interval:
+            corrected.append(missed)
+            missed -= expected_interval
+    
+    return corrected
+
+def run_generator(scenario):
+    return LoadGenerator(scenario).run()
+
+def split_scenario(scenario):
+    # One scenario per process, with the connections and the rate divided.
+    process_count = min(scenario['processes'], scenario['connections'])
+    parts = []
+    for index in range(process_count):
+        part = dict(scenario)
+        part['connections'] = scenario['connections'] // process_count + (1 if index < scenario['connections'] % process_count else 0)
+        part['rate'] = scenario['rate'] * part['connections'] / scenario['connections']
+        part['seed'] = scenario['seed'] + index
+        parts.append(part)
+    return parts
+
+def run_scenario(scenario):
+    scenario = dict(DEFAULT_SCENARIO, **scenario)
+    
+    parts = split_scenario(scenario)
+    if len(parts) == 1:
+        outcomes = [run_generator(parts[0])]
+    else:
+        with multiprocessing.Pool(len(parts)) as pool:
+            outcomes = pool.map(run_generator, parts)
+    
+    latencies = array('d')
+    sent_latencies = array('d')
+    statuses = collections.Counter()
+    result = {
+        'scenario': scenario,
+        'length_mismatches': 0,
+        'unanswered': 0,
+        'closed_connections': 0,
+        'sent_bytes': 0,
+        'received_bytes': 0
+    }
+    for outcome in outcomes:
+        latencies.extend(outcome['latencies'])
+        sent_latencies.extend(outcome['sent_latencies'])
+        statuses.update(outcome['statuses'])
+        for key in ('length_mismatches', 'unanswered', 'closed_connections', 'sent_bytes', 'received_bytes'):
+            result[key] += outcome[key]
+    
+    result['requests'] = len(latencies)
+    result['throughput'] = len(latencies) / scenario['duration']
+    result['statuses'] = {str(status): count for status, count in sorted(statuses.items())}
+    result['errors'] = sum(count for status, count in statuses.items() if status != STATUS_OK) + result['length_mismatches']
+    
+    if scenario['mode'] == MODE_OPEN:
+        # Measured from the time each request was due, so queueing behind a
+        # slow response is already included.
+        corrected = latencies
+    else:
+        expected_interval = percentile(sorted(latencies), 50)
+        corrected = correct_coordinated_omission(latencies, expected_interval)
+    
+    result['latency_ms'] = summarize(corrected)
+    result['uncorrected_latency_ms'] = summarize(sent_latencies)
+    
+    return result
+
+def format_result(result):
+    scenario = result['scenario']
+    latency = result['latency_ms']
+    return (
+        f'{scenario["name"]:<28} {result["throughput"]:10.0f} req/s '
+        f'p50 {latency["p50"]:8.3f} p99 {latency["p99"]:8.3f} p99.9 {latency["p99.9"]:8.3f} '
+        f'max {latency["max"]:8.3f} ms errors {result["errors"]}'
+    )
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load generator for the TRRQ/TRRS servers.')
+    parser.add_argument('--name', default=DEFAULT_SCENARIO['name'])
+    parser.add_argument('--host', default=DEFAULT_SCENARIO['host'],
+            help="IP address, or 'unix:<path>' for a Unix domain socket")
+    parser.add_argument('--port', type=int, default=DEFAULT_SCENARIO['port'])
+    parser.add_argument('--service', default=DEFAULT_SCENARIO['service'],
+            choices=[SERVICE_FILE_JOIN, SERVICE_ASYNC_DELAY, SERVICE_RAW],
+            help='request body format')
+    parser.add_argument('--mode', default=DEFAULT_SCENARIO['mode'], choices=[MODE_CLOSED, MODE_OPEN])
+    parser.add_argument('--connections', type=int, default=DEFAULT_SCENARIO['connections'])
+    parser.add_argument('--pipeline', type=int, default=DEFAULT_SCENARIO['pipeline'],
+            help='outstanding requests per connection')
+    parser.add_argument('--rate', type=float, default=DEFAULT_SCENARIO['rate'],
+            help='requests per second in open-loop mode')
+    parser.add_argument('--arrival', default=DEFAULT_SCENARIO['arrival'], choices=[ARRIVAL_UNIFORM, ARRIVAL_POISSON])
+    parser.add_argument('--payload', default=DEFAULT_SCENARIO['payload'],
+            help='payload size: fixed:N, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA or choice:N,N,...')
+    parser.add_argument('--delay-ms', type=int, default=DEFAULT_SCENARIO['delay_ms'],
+            help='delay requested from the async-delay service')
+    parser.add_argument('--warmup', type=float, default=DEFAULT_SCENARIO['warmup'])
+    parser.add_argument('--duration', type=float, default=DEFAULT_SCENARIO['duration'])
+    parser.add_argument('--fragment', action='store_true',
+            help='send each request in delayed pieces to test reassembly')
+    parser.add_argument('--processes', type=int, default=DEFAULT_SCENARIO['processes'])
+    parser.add_argument('--seed', type=int, default=DEFAULT_SCENARIO['seed'])
+    parser.add_argument('--json', help='write the result to this file, - for stdout')
+    return parser.parse_args(argv)
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class PayloadSource:
+    # Request bodies are built from slices of one shared text buffer, so that
+    # no request data is generated or copied per request.
+    def __init__(self, scenario, rng):
+        self.service = scenario['service']
+        self.delay_ms = scenario['delay_ms']
+        self.next_size = parse_size_distribution(scenario['payload'])
+        self.rng = rng
+        self.text = memoryview(b'')
+    
+    def get_text(self, size):
+        if size > len(self.text):
+            pattern = string.ascii_letters.encode('ascii')
+            self.text = memoryview(pattern * (size // len(pattern) + 1))
+        return self.text[:size]
+    
+    def next_body(self):
+        # Returns the body segments and the expected result length, or -1
+        # when the result length is not known.
+        size = max(0, self.next_size(self.rng))
+        text = self.get_text(size)
+        
+        if self.service == SERVICE_FILE_JOIN:
+            file_a_length = size // 2
+            return FILE_JOIN_REQUEST.encode_segments(text[:file_a_length], text[file_a_length:]), size + len(SEPARATOR_DATA)
+        elif self.service == SERVICE_ASYNC_DELAY:
+            return ASYNC_DELAY_REQUEST.encode_segments(self.delay_ms, text), size
+        else:
+            return [text], -1
+
+class Connection:
+    def __init__(self, address):
+        host, port = address
+        if host.startswith(UNIX_ADDRESS_PREFIX):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(host[len(UNIX_ADDRESS_PREFIX):])
+        else:
+            self.socket = socket.create_connection(address)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(0)
+        
+        # (not before time, data) segments waiting to be sent
+        self.tx_segments = collections.deque()
+        self.writing = False
+        
+        self.rx_buffer = bytearray(RECV_BUFSIZE)
+        self.rx_start = 0
+        self.rx_end = 0
+        
+        # request ID -> (due time, send time, expected result length)
+        self.outstanding = {}
+    
+    def queue(self, segments, fragment, now):
+        if not fragment:
+            for segment in segments:
+                self.tx_segments.append((0, segment))
+            return
+        
+        data = b''.join(segments)
+        start = 0
+        send_time = now
+        for end, delay in zip(FRAGMENT_ENDS + (len(data),), (0,) + FRAGMENT_DELAYS):
+            send_time += delay
+            if end > start:
+                self.tx_segments.append((send_time, memoryview(data)[start:end]))
+                start = end
+    
+    def next_send_time(self):
+        return self.tx_segments[0][0] if self.tx_segments else None
+    
+    def flush(self, now):
+        # Returns the number of bytes sent. Segments that are not due yet
+        # and anything after them stay queued.
+        total = 0
+        
+        while self.tx_segments and self.tx_segments[0][0] <= now:
+            iov = []
+            for not_before, segment in self.tx_segments:
+                if not_before > now or len(iov) == IOV_MAX:
+                    break
+                iov.append(segment)
+            
+            try:
+                count = self.socket.sendmsg(iov)
+            except (BlockingIOError, InterruptedError):
+                break
+            
+            total += count
+            self.consume(count)
+            
+            if count < sum(len(segment) for segment in iov):
+                break
+        
+        return total
+    
+    def consume(self, count):
+        while count > 0:
+            not_before, segment = self.tx_segments[0]
+            if count >= len(segment):
+                self.tx_segments.popleft()
+                count -= len(segment)
+            else:
+                self.tx_segments[0] = (not_before, memoryview(segment)[count:])
+                count = 0
+    
+    def has_pending_tx(self, now):
+        return bool(self.tx_segments) and self.tx_segments[0][0] <= now
+    
+    def recv(self):
+        # Returns the number of bytes received, 0 at EOF.
+        if self.rx_end == len(self.rx_buffer):
+            self.reserve(len(self.rx_buffer))
+        
+        with memoryview(self.rx_buffer) as view:
+            count = self.socket.recv_into(view[self.rx_end:])
+        self.rx_end += count
+        return count
+    
+    def reserve(self, length):
+        # Moves the unparsed data to the front of a buffer of at least
+        # 'length' free bytes.
+        pending = self.rx_end - self.rx_start
+        if pending + length > len(self.rx_buffer):
+            buffer = bytearray(pending + length)
+        else:
+            buffer = self.rx_buffer
+        buffer[0:pending] = self.rx_buffer[self.rx_start:self.rx_end]
+        self.rx_buffer = buffer
+        self.rx_start = 0
+        self.rx_end = pending
+    
+    def next_response(self):
+        # Returns (request ID, status, result length) of the next complete
+        # response, or None.
+        pending = self.rx_end - self.rx_start
+        if pending < MESSAGE_HEADER_LENGTH:
+            return None
+        
+        magic_number, request_id, result_length, status, encoding = unpack_response_header(self.rx_buffer, self.rx_start)
+        
+        frame_length = MESSAGE_HEADER_LENGTH + result_length
+        if pending < frame_length:
+            if self.rx_start + frame_length > len(self.rx_buffer):
+                self.reserve(frame_length)
+            return None
+        
+        self.rx_start += frame_length
+        if self.rx_start == self.rx_end:
+            self.rx_start = 0
+            self.rx_end = 0
+        
+        return request_id, status, result_length
+    
+    def close(self):
+        self.socket.close()
+
+class LoadGenerator:
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.mode = scenario['mode']
+        self.pipeline = scenario['pipeline']
+        self.fragment = scenario['fragment']
+        self.rng = random.Random(scenario['seed'])
+        self.payloads = PayloadSource(scenario, self.rng)
+        
+        self.selector = selectors.DefaultSelector()
+        self.connections = []
+        self.request_counter = 0
+        
+        # Due times of open-loop requests waiting for a free pipeline slot.
+        self.backlog = collections.deque()
+        self.next_due_time = 0
+        self.next_connection = 0
+        
+        self.measure_start = 0
+        self.end_time = 0
+        
+        self.latencies = array('d')
+        self.sent_latencies = array('d')
+        self.statuses = collections.Counter()
+        self.length_mismatches = 0
+        self.closed_connections = 0
+        self.unanswered = 0
+        self.sent_bytes = 0
+        self.received_bytes = 0
+    
+    def run(self):
+        address = (self.scenario['host'], self.scenario['port'])
+        for i in range(self.scenario['connections']):
+            connection = Connection(address)
+            self.connections.append(connection)
+            self.selector.register(connection.socket, selectors.EVENT_READ, connection)
+        
+        now = time.perf_counter()
+        self.measure_start = now + self.scenario['warmup']
+        self.end_time = self.measure_start + self.scenario['duration']
+        self.next_due_time = now
+        
+        if self.mode == MODE_CLOSED:
+            for connection in self.connections:
+                self.fill(connection, now)
+        
+        try:
+            self.loop()
+        finally:
+            for connection in self.connections:
+                self.selector.unregister(connection.socket)
+                connection.close()
+            self.selector.close()
+        
+        return {
+            'latencies': self.latencies,
+            'sent_latencies': self.sent_latencies,
+            'statuses': dict(self.statuses),
+            'length_mismatches': self.length_mismatches,
+            'unanswered': self.unanswered + sum(len(connection.outstanding) for connection in self.connections),
+            'closed_connections': self.closed_connections,
+            'sent_bytes': self.sent_bytes,
+            'received_bytes': self.received_bytes
+        }
+    
+    def loop(self):
+        while self.connections:
+            now = time.perf_counter()
+            
+            if now < self.end_time:
+                if self.mode == MODE_OPEN:
+                    self.schedule(now)
+            elif not self.has_outstanding() or now > self.end_time + DRAIN_TIMEOUT:
+                break
+            
+            for key, events in self.selector.select(self.get_timeout(now)):
+                connection = key.data
+                now = time.perf_counter()
+                
+                if events & selectors.EVENT_READ:
+                    if not self.read_ready(connection, now):
+                        self.close(connection)
+                        continue
+                
+                if events & selectors.EVENT_WRITE:
+                    self.sent_bytes += connection.flush(now)
+                
+                self.update_interest(connection, now)
+            
+            if self.fragment:
+                now = time.perf_counter()
+                for connection in self.connections:
+                    if connection.has_pending_tx(now):
+                        self.sent_bytes += connection.flush(now)
+                        self.update_interest(connection, now)
+    
+    def get_timeout(self, now):
+        timeout = MAX_SELECT_TIMEOUT
+        
+        if self.mode == MODE_OPEN and now < self.end_time:
+            timeout = min(timeout, self.next_due_time - now)
+        
+        if self.fragment:
+            for connection in self.connections:
+                send_time = connection.next_send_time()
+                if send_time is not None:
+                    timeout = min(timeout, send_time - now)
+        
+        return max(timeout, 0)
+    
+    def has_outstanding(self):
+        return any(connection.outstanding for connection in self.connections)
+    
+    def schedule(self, now):
+        # Open loop: every request that became due is sent now, or waits in
+        # the backlog when all pipeline slots are taken. Its latency counts
+        # from the due time either way.
+        while self.next_due_time <= now:
+            connection = self.find_free_connection()
+            if connection:
+                self.send(connection, self.next_due_time, now)
+            else:
+                self.backlog.append(self.next_due_time)
+            
+            if self.scenario['arrival'] == ARRIVAL_POISSON:
+                self.next_due_time += self.rng.expovariate(self.scenario['rate'])
+            else:
+                self.next_due_time += 1 / self.scenario['rate']
+    
+    def find_free_connection(self):
+        for i in range(len(self.connections)):
+            connection = self.connections[self.next_connection % len(self.connections)]
+            self.next_connection += 1
+            if len(connection.outstanding) < self.pipeline:
+                return connection
+        return None
+    
+    def fill(self, connection, now):
+        while len(connection.outstanding) < self.pipeline and now < self.end_time:
+            if self.mode == MODE_OPEN:
+                if not self.backlog:
+                    break
+                self.send(connection, self.backlog.popleft(), now)
+            else:
+                self.send(connection, now, now)
+        
+        self.update_interest(connection, now)
+    
+    def send(self, connection, due_time, now):
+        self.request_counter = (self.request_counter + 1) & 0xffffffff
+        request_id = self.request_counter
+        
+        body_segments, expected_length = self.payloads.next_body()
+        body_length = sum(len(segment) for segment in body_segments)
+        header = build_request_header(request_id, body_length)
+        
+        connection.outstanding[request_id] = (due_time, now, expected_length)
+        connection.queue([header] + body_segments, self.fragment, now)
+        self.sent_bytes += connection.flush(now)
+    
+    def read_ready(self, connection, now):
+        # Returns False when the connection was closed by the server.
+        try:
+            count = connection.recv()
+        except (BlockingIOError, InterruptedError):
+            return True
+        except ConnectionError:
+            return False
+        
+        if count == 0:
+            return False
+        self.received_bytes += count
+        
+        while True:
+            response = connection.next_response()
+            if not response:
+                break
+            
+            request_id, status, result_length = response
+            due_time, send_time, expected_length = connection.outstanding.pop(request_id)
+            
+            if self.measure_start <= due_time < self.end_time:
+                self.latencies.append(now - due_time)
+                self.sent_latencies.append(now - send_time)
+                self.statuses[status] += 1
+                if status == STATUS_OK and expected_length >= 0 and result_length != expected_length:
+                    self.length_mismatches += 1
+        
+        self.fill(connection, now)
+        return True
+    
+    def update_interest(self, connection, now):
+        writing = connection.has_pending_tx(now)
+        if writing != connection.writing:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self.selector.modify(connection.socket, events, connection)
+            connection.writing = writing
+    
+    def close(self, connection):
+        self.closed_connections += 1
+        self.selector.unregister(connection.socket)
+        connection.close()
+        self.connections.remove(connection)
+        self.unanswered += len(connection.outstanding)
+
+################################################################################
+# Main                                                                         #
+################################################################################
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    
+    scenario = {key: value for key, value in vars(args).items() if key in DEFAULT_SCENARIO}
+    result = run_scenario(scenario)
+    
+    print(format_result(result))
+    
+    if args.json == '-':
+        print(json.dumps(result, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(result, json_file, indent=2)
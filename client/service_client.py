@@ -0,0 +1,597 @@
+################################################################################
+# Service client library.                                                      #
+#                                                                              #
+# Features:                                                                    #
+#   1. Framing with recv_into into a reusable receive buffer.                  #
+#   2. Request ID multiplexing: many threads or coroutines share a few         #
+#      connections and may have any number of requests outstanding.            #
+#   3. Thread safe connection pool that reconnects broken connections.         #
+#   4. Sync API without a reader thread: a waiting caller reads responses for  #
+#      everyone until its own arrives, so a call costs no thread switch.       #
+#   5. asyncio API with the same pool and batch helpers.                       #
+#   6. Optional compression of request bodies and results (see                 #
+#      server/body_encoding.py for the header fields).                         #
+#   7. Batch frames that carry many small requests in one frame.               #
+#   8. Requests name the service they are for by its service ID, 0 for the     #
+#      server's default service.                                               #
+#   9. A host of 'unix:<path>' connects through a Unix domain socket.          #
+################################################################################
+
+import time, socket, select, threading, itertools, asyncio
+from common.protocol import MESSAGE_HEADER_LENGTH, FLAG_BATCH, build_request_header, unpack_response_header
+from common.protocol import build_batch_body, parse_batch_result
+from common.body_encoding import ENCODING_IDENTITY, DEFAULT_COMPRESS_MIN_LENGTH
+from common.body_encoding import DEFAULT_COMPRESS_LEVEL, supported_encodings, encode_body, decode_body
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+RECV_BUFSIZE = 64 * 1024
+
+# Encodings this client can decode, as the accepted encodings bit mask.
+SUPPORTED_ENCODINGS = supported_encodings()
+
+# Longest result a compressed result may decode to.
+DEFAULT_MAX_RESULT_LENGTH = 64 * 1024 * 1024
+
+REQUEST_ID_MASK = 0xffffffff
+
+# Bodies up to this size are copied into one buffer with the header, larger
+# ones are sent with sendmsg.
+COALESCE_LIMIT = 16 * 1024
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 5.0
+
+# A host of 'unix:<path>' is a Unix domain socket; the port is not used.
+UNIX_ADDRESS_PREFIX = 'unix:'
+
+# TCP keepalive probes on idle pooled connections, where supported.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def build_request_segments(request_id, body, encoding=ENCODING_IDENTITY, accept_encodings=0, batch=False, service_id=0):
+    if encoding != ENCODING_IDENTITY and len(body) >= DEFAULT_COMPRESS_MIN_LENGTH:
+        encoding, body = encode_body(body, encoding, DEFAULT_COMPRESS_LEVEL)
+    else:
+        encoding = ENCODING_IDENTITY
+    
+    flags = encoding | FLAG_BATCH if batch else encoding
+    header = build_request_header(request_id, len(body), flags, accept_encodings, service_id)
+    if len(body) <= COALESCE_LIMIT:
+        return [header + body]
+    return [header, body]
+
+def connect_socket(host, port, timeout=None, keepalive=True):
+    # TCP connections get TCP_NODELAY and, with keepalive, keepalive probes.
+    if host.startswith(UNIX_ADDRESS_PREFIX):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.settimeout(timeout)
+            connection.connect(host[len(UNIX_ADDRESS_PREFIX):])
+        except OSError:
+            connection.close()
+            raise
+        return connection
+    
+    connection = socket.create_connection((host, port), timeout=timeout)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if keepalive:
+        set_keepalive(connection)
+    return connection
+
+def set_keepalive(connection):
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in [('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL), ('TCP_KEEPCNT', KEEPALIVE_COUNT)]:
+        if hasattr(socket, option):
+            connection.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+def send_segments(connection, segments):
+    # sendall for a list of buffers.
+    segments = [memoryview(segment) for segment in segments]
+    while segments:
+        count = connection.sendmsg(segments)
+        while count > 0:
+            if count >= len(segments[0]):
+                count -= len(segments[0])
+                segments.pop(0)
+            else:
+                segments[0] = segments[0][count:]
+                count = 0
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class ResponseReader:
+    # Receive buffer and TRRS framing shared by the sync and async clients.
+    def __init__(self, size=RECV_BUFSIZE, max_result_length=DEFAULT_MAX_RESULT_LENGTH):
+        self.max_result_length = max_result_length
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+    
+    def get_buffer(self):
+        if self.end == len(self.buffer):
+            self.reserve(len(self.buffer))
+        return memoryview(self.buffer)[self.end:]
+    
+    def buffer_updated(self, count):
+        self.end += count
+    
+    def reserve(self, length):
+        # Moves the unparsed data to the front of a buffer with room for at
+        # least 'length' bytes after it.
+        pending = self.end - self.start
+        if pending + length > len(self.buffer):
+            buffer = bytearray(pending + length)
+            buffer[0:pending] = memoryview(self.buffer)[self.start:self.end]
+            self.buffer = buffer
+        elif self.start > 0:
+            self.buffer[0:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+    
+    def next_response(self):
+        # Returns (request ID, status, result data) of the next complete
+        # response, or None. Compressed results are decoded.
+        pending = self.end - self.start
+        if pending < MESSAGE_HEADER_LENGTH:
+            return None
+        
+        magic_number, request_id, result_length, status, encoding = unpack_response_header(self.buffer, self.start)
+        
+        frame_length = MESSAGE_HEADER_LENGTH + result_length
+        if pending < frame_length:
+            if self.start + frame_length > len(self.buffer):
+                self.reserve(frame_length)
+            return None
+        
+        body_start = self.start + MESSAGE_HEADER_LENGTH
+        if encoding == ENCODING_IDENTITY:
+            result_data = bytes(self.buffer[body_start:body_start + result_length])
+        else:
+            with memoryview(self.buffer) as view:
+                # The decompressor output is bounded, so a corrupt or
+                # malicious result cannot expand beyond max_result_length.
+                result_data = bytes(decode_body(view[body_start:body_start + result_length], encoding,
+                    self.max_result_length))
+        
+        self.start += frame_length
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        
+        return request_id, status, result_data
+
+class PendingCall:
+    __slots__ = ('connection', 'request_id', 'done', 'status', 'result_data', 'error')
+    
+    def __init__(self, connection, request_id):
+        self.connection = connection
+        self.request_id = request_id
+        self.done = False
+        self.status = None
+        self.result_data = None
+        self.error = None
+    
+    def result(self, timeout=None):
+        # Returns (status, result data). Raises ConnectionError when the
+        # connection broke and TimeoutError when the timeout expired.
+        return self.connection.wait(self, timeout)
+
+class ServiceConnection:
+    # One multiplexed connection. submit, send_many and wait may be called
+    # from any thread. Request bodies are compressed with 'encoding' and
+    # the server may compress results with any of 'accept_encodings'.
+    # Requests go to the service with 'service_id'.
+    def __init__(self, host, port, connect_timeout=DEFAULT_CONNECT_TIMEOUT, keepalive=True,
+            encoding=ENCODING_IDENTITY, accept_encodings=SUPPORTED_ENCODINGS, service_id=0):
+        self.connection = connect_socket(host, port, connect_timeout, keepalive)
+        self.connection.settimeout(None)
+        
+        self.encoding = encoding
+        self.accept_encodings = accept_encodings
+        self.service_id = service_id
+        self.request_ids = itertools.count(1)
+        self.send_lock = threading.Lock()
+        
+        # request ID -> PendingCall
+        self.outstanding = {}
+        self.reader = ResponseReader()
+        
+        # Guards 'reading' and wakes callers whose response arrived or that
+        # may take over reading.
+        self.condition = threading.Condition()
+        self.reading = False
+        self.broken = None
+        
+        # Read timeouts use poll, since a socket timeout would also apply to
+        # the sends of other threads.
+        self.poller = select.poll()
+        self.poller.register(self.connection, select.POLLIN)
+    
+    @property
+    def closed(self):
+        return self.broken is not None
+    
+    def submit(self, body):
+        return self.send_many([body])[0]
+    
+    def submit_batch(self, bodies):
+        # Sends the bodies as one batch frame. The result of its PendingCall
+        # is passed to parse_batch_result.
+        return self.send_many([build_batch_body(bodies)], batch=True)[0]
+    
+    def send_many(self, bodies, batch=False):
+        # All requests go out in one send. Returns their PendingCalls.
+        calls = []
+        segments = []
+        
+        with self.send_lock:
+            if self.broken:
+                raise ConnectionError(f'Connection is broken: {self.broken}')
+            
+            for body in bodies:
+                request_id = next(self.request_ids) & REQUEST_ID_MASK
+                pending = PendingCall(self, request_id)
+                self.outstanding[request_id] = pending
+                calls.append(pending)
+                segments += build_request_segments(request_id, body, self.encoding, self.accept_encodings, batch,
+                    self.service_id)
+            
+            try:
+                if len(segments) == 1:
+                    self.connection.sendall(segments[0])
+                else:
+                    send_segments(self.connection, segments)
+            except OSError as ex:
+                self.fail(ex)
+                raise
+        
+        return calls
+    
+    def call(self, body, timeout=None):
+        return self.wait(self.submit(body), timeout)
+    
+    def call_many(self, bodies, timeout=None):
+        return [self.wait(pending, timeout) for pending in self.send_many(bodies)]
+    
+    def call_batch(self, bodies, timeout=None):
+        # Returns (status, result data) per body.
+        status, result_data = self.wait(self.submit_batch(bodies), timeout)
+        return parse_batch_result(status, result_data, len(bodies))
+    
+    def wait(self, pending, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        
+        with self.condition:
+            while not pending.done:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.outstanding.pop(pending.request_id, None)
+                    raise TimeoutError(f'No response to request {pending.request_id}')
+                
+                if self.reading:
+                    # Another caller reads and wakes us.
+                    self.condition.wait(remaining)
+                    continue
+                
+                self.reading = True
+                self.condition.release()
+                try:
+                    self.read_until(pending, remaining)
+                finally:
+                    self.condition.acquire()
+                    self.reading = False
+                    # Another waiter takes over reading.
+                    self.condition.notify_all()
+        
+        if pending.error:
+            raise ConnectionError(f'Connection is broken: {pending.error}')
+        return pending.status, pending.result_data
+    
+    def read_until(self, pending, timeout):
+        # Reads responses for all callers until 'pending' is done or the
+        # timeout expires.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        
+        while not pending.done:
+            try:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.poller.poll(remaining * 1000):
+                        return
+                
+                count = self.connection.recv_into(self.reader.get_buffer())
+            except OSError as ex:
+                self.fail(ex)
+                return
+            
+            if count == 0:
+                self.fail(ConnectionError('Connection closed by server'))
+                return
+            
+            self.reader.buffer_updated(count)
+            try:
+                self.dispatch()
+            except ValueError as ex:
+                # Framing or encoding error, the stream cannot be recovered.
+                self.fail(ex)
+                return
+    
+    def dispatch(self):
+        completed = False
+        while True:
+            response = self.reader.next_response()
+            if not response:
+                break
+            
+            request_id, status, result_data = response
+            pending = self.outstanding.pop(request_id, None)
+            if pending:
+                pending.status = status
+                pending.result_data = result_data
+                pending.done = True
+                completed = True
+        
+        if completed:
+            with self.condition:
+                self.condition.notify_all()
+    
+    def fail(self, error):
+        # Every outstanding call fails with the error.
+        if not self.broken:
+            self.broken = error
+            try:
+                # Wakes a caller blocked in recv on this connection.
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.connection.close()
+        
+        for request_id in list(self.outstanding):
+            pending = self.outstanding.pop(request_id, None)
+            if pending:
+                pending.error = error
+                pending.done = True
+        
+        with self.condition:
+            self.condition.notify_all()
+    
+    def close(self):
+        self.fail(ConnectionError('Connection closed'))
+
+class ConnectionPool:
+    # Requests are spread round robin over 'size' connections, which are
+    # opened on first use and reopened when they break.
+    def __init__(self, host, port, size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT, keepalive=True,
+            encoding=ENCODING_IDENTITY, accept_encodings=SUPPORTED_ENCODINGS, service_id=0):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.encoding = encoding
+        self.accept_encodings = accept_encodings
+        self.service_id = service_id
+        self.connections = [None] * size
+        self.next_index = itertools.count()
+        self.lock = threading.Lock()
+    
+    def get_connection(self):
+        index = next(self.next_index) % len(self.connections)
+        connection = self.connections[index]
+        if connection and not connection.closed:
+            return connection
+        
+        with self.lock:
+            connection = self.connections[index]
+            if not connection or connection.closed:
+                connection = ServiceConnection(self.host, self.port, self.connect_timeout, self.keepalive,
+                    self.encoding, self.accept_encodings, self.service_id)
+                self.connections[index] = connection
+            return connection
+    
+    def submit(self, body):
+        return self.get_connection().submit(body)
+    
+    def submit_batch(self, bodies):
+        return self.get_connection().submit_batch(bodies)
+    
+    def send_many(self, bodies):
+        return self.get_connection().send_many(bodies)
+    
+    def call(self, body, timeout=None):
+        return self.get_connection().call(body, timeout)
+    
+    def call_many(self, bodies, timeout=None):
+        return self.get_connection().call_many(bodies, timeout)
+    
+    def call_batch(self, bodies, timeout=None):
+        return self.get_connection().call_batch(bodies, timeout)
+    
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                if connection:
+                    connection.close()
+            self.connections = [None] * len(self.connections)
+
+class AsyncServiceConnection(asyncio.BufferedProtocol):
+    # asyncio counterpart of ServiceConnection. Create with connect().
+    def __init__(self, encoding=ENCODING_IDENTITY, accept_encodings=SUPPORTED_ENCODINGS, service_id=0):
+        self.encoding = encoding
+        self.accept_encodings = accept_encodings
+        self.service_id = service_id
+        self.transport = None
+        self.reader = ResponseReader()
+        self.request_ids = itertools.count(1)
+        # request ID -> asyncio.Future of (status, result data)
+        self.outstanding = {}
+        self.broken = None
+        self.drain_waiter = None
+    
+    @classmethod
+    async def connect(cls, host, port, keepalive=True, encoding=ENCODING_IDENTITY, accept_encodings=SUPPORTED_ENCODINGS,
+            service_id=0):
+        loop = asyncio.get_running_loop()
+        factory = lambda: cls(encoding, accept_encodings, service_id)
+        if host.startswith(UNIX_ADDRESS_PREFIX):
+            transport, protocol = await loop.create_unix_connection(factory, host[len(UNIX_ADDRESS_PREFIX):])
+            return protocol
+        
+        transport, protocol = await loop.create_connection(factory, host, port)
+        if keepalive:
+            set_keepalive(transport.get_extra_info('socket'))
+        return protocol
+    
+    @property
+    def closed(self):
+        return self.broken is not None
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        connection = transport.get_extra_info('socket')
+        if connection.family in (socket.AF_INET, socket.AF_INET6):
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    def connection_lost(self, exc):
+        self.fail(exc or ConnectionError('Connection closed by server'))
+    
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+    
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        
+        while True:
+            try:
+                response = self.reader.next_response()
+            except ValueError as ex:
+                self.fail(ex)
+                return
+            if not response:
+                break
+            
+            request_id, status, result_data = response
+            future = self.outstanding.pop(request_id, None)
+            if future and not future.done():
+                future.set_result((status, result_data))
+    
+    def pause_writing(self):
+        self.drain_waiter = asyncio.get_running_loop().create_future()
+    
+    def resume_writing(self):
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        self.drain_waiter = None
+    
+    def submit(self, body):
+        return self.send_many([body])[0]
+    
+    def send_many(self, bodies, batch=False):
+        # Returns one future of (status, result data) per body.
+        if self.broken:
+            raise ConnectionError(f'Connection is broken: {self.broken}')
+        
+        loop = asyncio.get_running_loop()
+        futures = []
+        segments = []
+        for body in bodies:
+            request_id = next(self.request_ids) & REQUEST_ID_MASK
+            future = loop.create_future()
+            self.outstanding[request_id] = future
+            futures.append(future)
+            segments += build_request_segments(request_id, body, self.encoding, self.accept_encodings, batch,
+                self.service_id)
+        
+        self.transport.writelines(segments)
+        return futures
+    
+    async def drain(self):
+        # Waits while the transport write buffer is above its high water mark.
+        if self.drain_waiter:
+            await self.drain_waiter
+    
+    async def call(self, body, timeout=None):
+        future = self.submit(body)
+        await self.drain()
+        return await asyncio.wait_for(future, timeout)
+    
+    async def call_many(self, bodies, timeout=None):
+        futures = self.send_many(bodies)
+        await self.drain()
+        return await asyncio.wait_for(asyncio.gather(*futures), timeout)
+    
+    async def call_batch(self, bodies, timeout=None):
+        future = self.send_many([build_batch_body(bodies)], batch=True)[0]
+        await self.drain()
+        status, result_data = await asyncio.wait_for(future, timeout)
+        return parse_batch_result(status, result_data, len(bodies))
+    
+    def fail(self, error):
+        if not self.broken:
+            self.broken = error
+            if self.transport:
+                self.transport.abort()
+        
+        for future in self.outstanding.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f'Connection is broken: {error}'))
+        self.outstanding.clear()
+        
+        self.resume_writing()
+    
+    def close(self):
+        self.fail(ConnectionError('Connection closed'))
+
+class AsyncConnectionPool:
+    def __init__(self, host, port, size=DEFAULT_POOL_SIZE, keepalive=True,
+            encoding=ENCODING_IDENTITY, accept_encodings=SUPPORTED_ENCODINGS, service_id=0):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.encoding = encoding
+        self.accept_encodings = accept_encodings
+        self.service_id = service_id
+        self.connections = [None] * size
+        self.locks = [asyncio.Lock() for i in range(size)]
+        self.next_index = itertools.count()
+    
+    async def get_connection(self):
+        index = next(self.next_index) % len(self.connections)
+        connection = self.connections[index]
+        if connection and not connection.closed:
+            return connection
+        
+        async with self.locks[index]:
+            connection = self.connections[index]
+            if not connection or connection.closed:
+                connection = await AsyncServiceConnection.connect(self.host, self.port, self.keepalive,
+                    self.encoding, self.accept_encodings, self.service_id)
+                self.connections[index] = connection
+            return connection
+    
+    async def call(self, body, timeout=None):
+        connection = await self.get_connection()
+        return await connection.call(body, timeout)
+    
+    async def call_many(self, bodies, timeout=None):
+        connection = await self.get_connection()
+        return await connection.call_many(bodies, timeout)
+    
+    async def call_batch(self, bodies, timeout=None):
+        connection = await self.get_connection()
+        return await connection.call_batch(bodies, timeout)
+    
+    def close(self):
+        for connection in self.connections:
+            if connection:
+                connection.close()
+        self.connections = [None] * len(self.connections)
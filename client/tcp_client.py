@@ -3,6 +3,7 @@
 ################################################################################
 
 import time, socket
+from common.protocol import MESSAGE_HEADER_LENGTH, build_request_message, unpack_response_header
 
 ################################################################################
 # Constants                                                                    #
@@ -10,9 +11,8 @@ import time, socket
 
 RECV_BUFSIZE = 4096
 
-REQUEST_MAGIC_NUMBER  = b'TRRQ'
-RESPONSE_MAGIC_NUMBER = b'TRRS'
-MESSAGE_HEADER_LENGTH = 16
+# A host of 'unix:<path>' is a Unix domain socket; the port is not used.
+UNIX_ADDRESS_PREFIX = 'unix:'
 
 ################################################################################
 # Classes                                                                      #
@@ -21,74 +21,90 @@ MESSAGE_HEADER_LENGTH = 16
 class TcpClient:
     def __init__(self, host, port):
         self.request_counter = 0
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((host, port))
+        self.responses = {}
+        if host.startswith(UNIX_ADDRESS_PREFIX):
+            self.client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.client_socket.connect(host[len(UNIX_ADDRESS_PREFIX):])
+        else:
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.client_socket.connect((host, port))
 
     def parse_response_message(self, data):
         if len(data) < MESSAGE_HEADER_LENGTH:
             raise ValueError(f'Short message header length: expected = {MESSAGE_HEADER_LENGTH}, actual = {len(data)}')
-            
-        # Magic number
-        magic_number = data[0:4]
-        if magic_number != RESPONSE_MAGIC_NUMBER:
-            raise ValueError(f'Illegal magic number: {magic_number.hex()}')
         
-        # Request ID
-        request_id = int.from_bytes(data[4:8], byteorder='little')
-        
-        # Result data length
-        result_length = int.from_bytes(data[8:12], byteorder='little')
+        magic_number, request_id, result_length, status, encoding = unpack_response_header(data)
         
         expected_total_length = MESSAGE_HEADER_LENGTH + result_length
         if len(data) < expected_total_length:
             raise ValueError(f'Short total message length: expected = {expected_total_length}, actual = {len(data)}')
         
-        # Status
-        status = data[12]
-        
-        # Reserved area
-        reserved_area = data[13:16]
+        result_data = str(data[MESSAGE_HEADER_LENGTH:expected_total_length], 'utf-8')
         
-        # Result data
-        result_data_arr = data[16:16+result_length]
-        result_data = result_data_arr.decode('utf-8')
-
         return request_id, status, result_data
     
-    def send(self, data):
+    def send(self, data, fragmented=False):
+        # With fragmented, the message is sent in four pieces with pauses in
+        # between, to test how the server reassembles partial frames.
         self.request_counter += 1
-        request_id = self.request_counter.to_bytes(4, byteorder='little')
+        tx_data = build_request_message(self.request_counter, data)
         
-        body_length = len(data).to_bytes(4, byteorder='little')
+        if not fragmented:
+            self.client_socket.sendall(tx_data)
+            return self.request_counter
         
-        reserved_area = bytes([0, 0, 0, 0])
-    
-        tx_data = (
-            REQUEST_MAGIC_NUMBER + 
-            request_id + 
-            body_length +
-            reserved_area +
-            data
-        )
-        
-        #self.client_socket.sendall(tx_data)
-        self.client_socket.send(tx_data[0:10])
+        self.client_socket.sendall(tx_data[0:10])
         time.sleep(0.005)
-        self.client_socket.send(tx_data[10:50])
+        self.client_socket.sendall(tx_data[10:50])
         time.sleep(0.01)
-        self.client_socket.send(tx_data[50:500])
+        self.client_socket.sendall(tx_data[50:500])
         time.sleep(0.05)
-        self.client_socket.send(tx_data[500:])
+        self.client_socket.sendall(tx_data[500:])
         
-    def recv(self):
-        rx_data = self.client_socket.recv(RECV_BUFSIZE)
+        return self.request_counter
         
-        request_id, status, result_data = self.parse_response_message(rx_data)
+    def recv(self, request_id=None):
+        # Several requests may be outstanding and the server may answer them
+        # out of order, so responses are matched by request ID. Without an ID
+        # the response to the latest request is returned.
+        if request_id is None:
+            request_id = self.request_counter
+        
+        while request_id not in self.responses:
+            received_id, status, result_data = self.recv_message()
+            self.responses[received_id] = (status, result_data)
+        
+        return self.responses.pop(request_id)
+    
+    def recv_any(self):
+        # Returns the next response, whichever request it belongs to.
+        if self.responses:
+            request_id = next(iter(self.responses))
+            status, result_data = self.responses.pop(request_id)
+            return request_id, status, result_data
+        
+        return self.recv_message()
+    
+    def recv_message(self):
+        header_data = self.recv_exact(MESSAGE_HEADER_LENGTH)
+        magic_number, request_id, result_length, status, encoding = unpack_response_header(header_data)
+        
+        result_data = str(self.recv_exact(result_length), 'utf-8')
+        
+        return request_id, status, result_data
+    
+    def recv_exact(self, length):
+        rx_data = bytearray(length)
+        view = memoryview(rx_data)
         
-        if request_id != self.request_counter:
-            raise RuntimeError(f'Request ID mismatch: expected = {self.request_counter}, received = {request_id}')
+        offset = 0
+        while offset < length:
+            count = self.client_socket.recv_into(view[offset:])
+            if count == 0:
+                raise ConnectionError('Connection closed by server')
+            offset += count
         
-        return status, result_data
+        return rx_data
         
     def close(self):
         self.client_socket.close()
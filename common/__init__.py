@@ -0,0 +1,7 @@
+################################################################################
+# Modules shared by the server and the clients.                                #
+#                                                                              #
+# The server and client scripts put the repository root on sys.path, so the    #
+# modules are imported as common.protocol, common.body_encoding and            #
+# common.service_bodies.                                                       #
+################################################################################
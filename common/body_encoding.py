@@ -0,0 +1,143 @@
+################################################################################
+# Body encodings.                                                              #
+#                                                                              #
+# Request and response bodies may be compressed. The encoding is carried in    #
+# the reserved header bytes:                                                   #
+#   request  byte 12: flags, the low 4 bits are the encoding of the body       #
+#   request  byte 13: bit mask of the encodings the client accepts             #
+#   response byte 13: encoding of the result                                   #
+# Decoding is incremental and stops as soon as the output exceeds a limit,     #
+# so a small compressed body cannot expand into a large one.                   #
+################################################################################
+
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # Python builds without liblzma.
+    lzma = None
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+ENCODING_IDENTITY = 0
+ENCODING_ZLIB     = 1
+ENCODING_LZMA     = 2
+
+# Bodies shorter than this are sent as they are.
+DEFAULT_COMPRESS_MIN_LENGTH = 1024
+
+DEFAULT_COMPRESS_LEVEL = 1
+
+DECODE_ERRORS = (zlib.error, EOFError) + ((lzma.LZMAError,) if lzma else ())
+
+# Compressed input is fed to the decompressor in pieces of this size.
+DECODE_CHUNK_SIZE = 64 * 1024
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def encoding_bit(encoding):
+    return 1 << encoding
+
+def supported_encodings():
+    # Bit mask of the encodings this build can decode.
+    mask = encoding_bit(ENCODING_ZLIB)
+    if lzma:
+        mask |= encoding_bit(ENCODING_LZMA)
+    return mask
+
+def choose_encoding(accept_encodings):
+    # zlib is preferred for its speed, lzma is used only when the peer
+    # accepts nothing else.
+    for encoding in [ENCODING_ZLIB, ENCODING_LZMA]:
+        if accept_encodings & supported_encodings() & encoding_bit(encoding):
+            return encoding
+    return ENCODING_IDENTITY
+
+def encode_body(data, encoding, level=DEFAULT_COMPRESS_LEVEL):
+    # Returns (encoding, data). The data is sent as it is when compression
+    # does not make it smaller. Raises BodyEncodingError when the encoding is
+    # unknown or not supported by this build.
+    if encoding == ENCODING_IDENTITY:
+        return ENCODING_IDENTITY, data
+    elif encoding == ENCODING_ZLIB:
+        encoded_data = zlib.compress(data, level)
+    elif encoding == ENCODING_LZMA and lzma:
+        encoded_data = lzma.compress(data, preset=level)
+    else:
+        raise BodyEncodingError(f'Unsupported body encoding: {encoding}')
+    
+    if len(encoded_data) >= len(data):
+        return ENCODING_IDENTITY, data
+    return encoding, encoded_data
+
+def decode_body(data, encoding, max_length):
+    # Raises BodyEncodingError when the encoding is unknown, the data is
+    # corrupt or it decodes to more than max_length bytes.
+    if encoding == ENCODING_IDENTITY:
+        return data
+    
+    if encoding == ENCODING_ZLIB:
+        decoder = ZlibDecoder()
+    elif encoding == ENCODING_LZMA and lzma:
+        decoder = LzmaDecoder()
+    else:
+        raise BodyEncodingError(f'Unsupported body encoding: {encoding}')
+    
+    output = bytearray()
+    view = memoryview(data)
+    try:
+        for offset in range(0, len(view), DECODE_CHUNK_SIZE):
+            decoder.feed(view[offset:offset + DECODE_CHUNK_SIZE], output, max_length)
+    except DECODE_ERRORS as ex:
+        raise BodyEncodingError(f'Corrupt body: {ex}')
+    
+    if not decoder.eof:
+        raise BodyEncodingError('Truncated body')
+    
+    return output
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class BodyEncodingError(ValueError):
+    pass
+
+class ZlibDecoder:
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+    
+    @property
+    def eof(self):
+        return self.decompressor.eof
+    
+    def feed(self, data, output, max_length):
+        # The output is bounded by max_length + 1, so that an overflow is
+        # detected without decompressing more than that.
+        while data and not self.decompressor.eof:
+            output += self.decompressor.decompress(data, max_length + 1 - len(output))
+            if len(output) > max_length:
+                raise BodyEncodingError(f'Body expands beyond {max_length} bytes')
+            data = self.decompressor.unconsumed_tail
+
+class LzmaDecoder:
+    def __init__(self):
+        self.decompressor = lzma.LZMADecompressor()
+    
+    @property
+    def eof(self):
+        return self.decompressor.eof
+    
+    def feed(self, data, output, max_length):
+        while not self.decompressor.eof:
+            output += self.decompressor.decompress(data, max_length + 1 - len(output))
+            if len(output) > max_length:
+                raise BodyEncodingError(f'Body expands beyond {max_length} bytes')
+            if self.decompressor.needs_input:
+                break
+            data = b''
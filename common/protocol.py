@@ -0,0 +1,239 @@
+################################################################################
+# TRRQ/TRRS wire protocol.                                                     #
+#                                                                              #
+# Precompiled struct codecs for the message headers, batch bodies and service  #
+# request bodies, shared by the server and the clients. Headers are unpacked   #
+# in place from the receive buffer and the magic number is checked here only.  #
+#                                                                              #
+# Request header:                                                              #
+#   bytes 0-3   magic number TRRQ                                              #
+#   bytes 4-7   request ID                                                     #
+#   bytes 8-11  body length                                                    #
+#   byte  12    flags, the low 4 bits are the body encoding, FLAG_STREAM       #
+#               and FLAG_BATCH                                                 #
+#   byte  13    bit mask of the encodings the client accepts                   #
+#   bytes 14-15 service ID                                                     #
+#                                                                              #
+# Response header:                                                             #
+#   bytes 0-3   magic number TRRS                                              #
+#   bytes 4-7   request ID                                                     #
+#   bytes 8-11  result length                                                  #
+#   byte  12    status                                                         #
+#   byte  13    encoding of the result                                         #
+#   bytes 14-15 reserved                                                       #
+#                                                                              #
+# A client that sets FLAG_STREAM accepts a streamed result, which is sent      #
+# while the request body is still being received, before the service knows     #
+# whether it succeeds. Its header has STATUS_STREAMED and the result is        #
+# followed by a trailer:                                                       #
+#   byte  0     final status                                                   #
+#   byte  1     TRAILER_REPLACE when the streamed bytes are to be discarded    #
+#   bytes 2-5   length of the replacement result that follows                  #
+# Without TRAILER_REPLACE the streamed bytes are the result. Requests without  #
+# FLAG_STREAM are answered with a plain response.                              #
+################################################################################
+
+import struct
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+REQUEST_MAGIC_NUMBER  = b'TRRQ'
+RESPONSE_MAGIC_NUMBER = b'TRRS'
+MESSAGE_HEADER_LENGTH = 16
+
+# magic number, request ID, body length, flags, accepted encodings, service ID
+REQUEST_HEADER = struct.Struct('<4sIIBBH')
+# magic number, request ID, result length, status, encoding, reserved
+RESPONSE_HEADER = struct.Struct('<4sIIBB2x')
+
+STATUS_OK = 0
+STATUS_SERVICE_ERROR = 1
+STATUS_BUSY = 2
+STATUS_TIMEOUT = 3
+STATUS_BODY_TOO_LARGE = 4
+STATUS_BAD_ENCODING = 5
+STATUS_BAD_REQUEST = 6
+STATUS_UNKNOWN_SERVICE = 7
+STATUS_STREAMED = 8
+
+# Request flags. The low 4 bits are the body encoding.
+FLAG_BATCH = 0x80
+FLAG_STREAM = 0x40
+ENCODING_MASK = 0x0f
+
+# A batch body is an item count followed by the items. Request items are a
+# body length and the body, result items a status, a result length and the
+# result.
+BATCH_COUNT = struct.Struct('<I')
+BATCH_REQUEST_ITEM = struct.Struct('<I')
+BATCH_RESULT_ITEM = struct.Struct('<BI')
+
+# final status, flags, replacement result length
+STREAM_TRAILER = struct.Struct('<BBI')
+TRAILER_REPLACE = 0x01
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def unpack_request_header(buffer, offset=0):
+    # Returns (magic number, request ID, body length, flags, accepted
+    # encodings, service ID) of the header at 'offset'.
+    fields = REQUEST_HEADER.unpack_from(buffer, offset)
+    if fields[0] != REQUEST_MAGIC_NUMBER:
+        raise ValueError(f'Illegal magic number: {fields[0].hex()}')
+    return fields
+
+def unpack_response_header(buffer, offset=0):
+    # Returns (magic number, request ID, result length, status, encoding) of
+    # the header at 'offset'.
+    fields = RESPONSE_HEADER.unpack_from(buffer, offset)
+    if fields[0] != RESPONSE_MAGIC_NUMBER:
+        raise ValueError(f'Illegal magic number: {fields[0].hex()}')
+    return fields
+
+def unpack_stream_trailer(buffer, offset=0):
+    # Returns (final status, replaced, replacement length) of the trailer
+    # at 'offset'.
+    status, flags, result_length = STREAM_TRAILER.unpack_from(buffer, offset)
+    return status, (flags & TRAILER_REPLACE) != 0, result_length
+
+def build_request_header(request_id, body_length, flags=0, accept_encodings=0, service_id=0):
+    return REQUEST_HEADER.pack(REQUEST_MAGIC_NUMBER, request_id, body_length, flags, accept_encodings, service_id)
+
+def build_response_header(request_id, result_length, status, encoding=0):
+    return RESPONSE_HEADER.pack(RESPONSE_MAGIC_NUMBER, request_id, result_length, status, encoding)
+
+def build_request_message(request_id, body_data, flags=0, accept_encodings=0, service_id=0):
+    # The header and the body in one buffer. Concatenating the packed header
+    # is faster than packing it into a new bytearray.
+    return REQUEST_HEADER.pack(REQUEST_MAGIC_NUMBER, request_id, len(body_data), flags, accept_encodings,
+        service_id) + body_data
+
+def build_response_message(request_id, status, body_data, encoding=0):
+    return RESPONSE_HEADER.pack(RESPONSE_MAGIC_NUMBER, request_id, len(body_data), status, encoding) + body_data
+
+def build_batch_body(bodies):
+    segments = [BATCH_COUNT.pack(len(bodies))]
+    for body in bodies:
+        segments.append(BATCH_REQUEST_ITEM.pack(len(body)))
+        segments.append(body)
+    return b''.join(segments)
+
+def parse_batch_body(body_data):
+    # Returns the item bodies of a batch body as views into it.
+    body_data = memoryview(body_data)
+    if len(body_data) < BATCH_COUNT.size:
+        raise ValueError(f'Short batch body: {len(body_data)} bytes')
+    
+    count, = BATCH_COUNT.unpack_from(body_data, 0)
+    offset = BATCH_COUNT.size
+    if count * BATCH_REQUEST_ITEM.size > len(body_data) - offset:
+        raise ValueError(f'Batch of {count} items does not fit in {len(body_data)} bytes')
+    
+    bodies = []
+    for i in range(count):
+        if offset + BATCH_REQUEST_ITEM.size > len(body_data):
+            raise ValueError(f'Batch item {i} header exceeds the body')
+        body_length, = BATCH_REQUEST_ITEM.unpack_from(body_data, offset)
+        offset += BATCH_REQUEST_ITEM.size
+        
+        if offset + body_length > len(body_data):
+            raise ValueError(f'Batch item {i} of {body_length} bytes exceeds the body')
+        bodies.append(body_data[offset:offset + body_length])
+        offset += body_length
+    
+    if offset != len(body_data):
+        raise ValueError(f'{len(body_data) - offset} bytes after the last batch item')
+    
+    return bodies
+
+def build_batch_result(results):
+    # results is a list of (status, result_data).
+    segments = [BATCH_COUNT.pack(len(results))]
+    for status, result_data in results:
+        segments.append(BATCH_RESULT_ITEM.pack(status, len(result_data)))
+        segments.append(result_data)
+    
+    return b''.join(segments)
+
+def parse_batch_result(status, result_data, count):
+    # Returns (status, result data) per item. When the batch as a whole
+    # failed, every item gets its status.
+    if status != STATUS_OK:
+        return [(status, result_data)] * count
+    
+    view = memoryview(result_data)
+    item_count, = BATCH_COUNT.unpack_from(view, 0)
+    if item_count != count:
+        raise ValueError(f'Batch result has {item_count} items, expected {count}')
+    
+    results = []
+    offset = BATCH_COUNT.size
+    for i in range(count):
+        item_status, length = BATCH_RESULT_ITEM.unpack_from(view, offset)
+        offset += BATCH_RESULT_ITEM.size
+        results.append((item_status, bytes(view[offset:offset + length])))
+        offset += length
+    return results
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class BodyLayout:
+    # Layout of a service's request body, declared once by the service:
+    # fixed fields packed as 'head_format', of which the last 'blob_count'
+    # are the lengths of the blobs that follow in order, then with 'tail'
+    # the rest of the body. For example BodyLayout('<II', blob_count=2) is
+    # two lengths and two blobs, BodyLayout('<I', tail=True) a number and
+    # the rest.
+    #
+    # decode() returns the other fixed fields, the blobs and the tail, the
+    # blobs and the tail as memoryviews into the body; copy what is kept
+    # beyond the request. Bytes after the last blob are ignored unless there
+    # is a tail. encode() takes the same values and fills in the lengths.
+    def __init__(self, head_format, blob_count=0, tail=False):
+        self.head = struct.Struct(head_format)
+        self.blob_count = blob_count
+        self.tail = tail
+        # Fixed fields that are not blob lengths.
+        self.field_count = len(self.head.unpack(bytes(self.head.size))) - blob_count
+    
+    def decode(self, data):
+        head = self.head
+        if len(data) < head.size:
+            raise ValueError(f'Short body: {len(data)} bytes, expected at least {head.size}')
+        
+        fields = head.unpack_from(data, 0)
+        if not self.blob_count and not self.tail:
+            return fields
+        
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+        body_length = len(data)
+        values = list(fields[:self.field_count])
+        offset = head.size
+        
+        for length in fields[self.field_count:]:
+            if offset + length > body_length:
+                raise ValueError(f'Body field of {length} bytes at {offset} exceeds the body of {body_length} bytes')
+            values.append(data[offset:offset + length])
+            offset += length
+        
+        if self.tail:
+            values.append(data[offset:])
+        
+        return values
+    
+    def encode_segments(self, *values):
+        # The packed fixed fields followed by the blobs and the tail, for
+        # scatter-gather sends that do not copy the blobs.
+        blobs = values[self.field_count:]
+        lengths = [len(blob) for blob in blobs[:self.blob_count]]
+        return [self.head.pack(*values[:self.field_count], *lengths), *blobs]
+    
+    def encode(self, *values):
+        return b''.join(self.encode_segments(*values))
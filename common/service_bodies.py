@@ -0,0 +1,20 @@
+################################################################################
+# Request body layouts of the services, shared by the services and the         #
+# clients that call them.                                                      #
+################################################################################
+
+from common.protocol import BodyLayout
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+# File join service: the lengths of file_a and file_b, then both. The results
+# are joined with SEPARATOR.
+FILE_JOIN_REQUEST = BodyLayout('<II', blob_count=2)
+
+SEPARATOR = '^.^'
+SEPARATOR_DATA = SEPARATOR.encode('utf-8')
+
+# Async delay service: the delay in milliseconds, then the data to echo.
+ASYNC_DELAY_REQUEST = BodyLayout('<I', tail=True)
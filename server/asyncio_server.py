@@ -0,0 +1,320 @@
+################################################################################
+# asyncio TCP socket server.                                                   #
+#                                                                              #
+# Features:                                                                    #
+#   1. asyncio BufferedProtocol, optionally running on uvloop.                 #
+#   2. Same TRRQ/TRRS framing and services as TcpServer.                       #
+#   3. Reading is paused while the transport write buffer or the in-flight     #
+#      window of a connection is full, and while the memory budget is          #
+#      exhausted and the connection still has responses to send.              #
+#   4. Listens on a TCP port, a Unix domain socket, or both.                   #
+#   5. Same socket options as TcpServer.                                       #
+#   6. Same request tracing and on-demand profiling as TcpServer.              #
+################################################################################
+
+import os, time, logging, asyncio
+from tcp_server import RequestHandler, MESSAGE_HEADER_LENGTH, DEFAULT_BACKLOG
+from tcp_server import SocketOptions, create_inet_server, create_unix_server, connection_address
+from metrics import LAG_PROBE_INTERVAL
+from profiling import PROFILE_POLL_INTERVAL
+from service_executor import EXECUTION_ASYNC
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+ENGINE_ASYNCIO = 'asyncio'
+
+# How often the transport write buffer of a connection is measured while it
+# holds data the connection has not seen drain.
+TX_SYNC_INTERVAL = 0.01
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class AsyncioTcpServer:
+    # unix_path, socket_options and profiler are used like in TcpServer. The
+    # loop accepts up to backlog connections per wakeup on its own, so
+    # accepts are not traced.
+    def __init__(self, name, use_uvloop=True, reuse_port=False, backlog=DEFAULT_BACKLOG, unix_path=None,
+            socket_options=None, profiler=None):
+        self.logger = logging.getLogger()
+        self.name = name
+        self.use_uvloop = use_uvloop and uvloop is not None
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.unix_path = unix_path
+        self.socket_options = socket_options or SocketOptions()
+        self.profiler = profiler
+        
+    def run(self, port, handler_factory):
+        if self.use_uvloop:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        
+        asyncio.run(self.serve(port, handler_factory))
+    
+    async def serve(self, port, handler_factory):
+        loop = asyncio.get_running_loop()
+        servers = []
+        
+        # The sockets are created like TcpServer's, so that they get the same
+        # options and a stale socket file is handled the same way.
+        if port is not None:
+            sock = create_inet_server('', port, self.backlog, self.reuse_port, self.socket_options)
+            servers.append(await loop.create_server(
+                    lambda: ServiceProtocol(handler_factory, self.socket_options), 
+                    sock=sock, backlog=self.backlog
+                ))
+        if self.unix_path is not None:
+            sock = create_unix_server(self.unix_path, self.backlog, self.socket_options) if isinstance(self.unix_path, str) else self.unix_path
+            servers.append(await loop.create_unix_server(
+                    lambda: ServiceProtocol(handler_factory, self.socket_options), 
+                    sock=sock, backlog=self.backlog
+                ))
+        
+        if not servers:
+            raise ValueError('No port or Unix domain socket to listen on')
+        
+        for server in servers:
+            self.logger.info('Listening on %s (engine = %s, loop = %s)', server.sockets[0].getsockname(), ENGINE_ASYNCIO, type(loop).__module__)
+        
+        if handler_factory.metrics:
+            loop.create_task(self.probe_loop_lag(handler_factory.metrics))
+        if handler_factory.timeouts:
+            loop.create_task(self.expire_timeouts(handler_factory.timeouts))
+        if self.profiler:
+            loop.create_task(self.poll_profiler(self.profiler))
+        
+        try:
+            await asyncio.gather(*[server.serve_forever() for server in servers])
+        finally:
+            for server in servers:
+                server.close()
+            if isinstance(self.unix_path, str):
+                os.unlink(self.unix_path)
+    
+    async def probe_loop_lag(self, metrics):
+        # The loop lag is how late a sleep of LAG_PROBE_INTERVAL wakes up.
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            metrics.observe_loop_lag(max(loop.time() - started - LAG_PROBE_INTERVAL, 0.0))
+
+    async def expire_timeouts(self, timeouts):
+        while True:
+            await asyncio.sleep(timeouts.wheel.tick)
+            for protocol, reason in timeouts.expire(time.monotonic()):
+                if reason:
+                    self.logger.info('close %s client %s', reason, protocol.address)
+                    protocol.transport.abort()
+                else:
+                    protocol.update_reading()
+    
+    async def poll_profiler(self, profiler):
+        while True:
+            await asyncio.sleep(PROFILE_POLL_INTERVAL)
+            profiler.poll()
+
+class ServiceProtocol(asyncio.BufferedProtocol, RequestHandler):
+    __slots__ = ('socket_options', 'tx_high_water', 'tx_low_water', 'transport', 'address', 'reading_paused',
+        'writing_paused', 'tx_charged', 'tx_sync_handle')
+    
+    def __init__(self, handler_factory, socket_options=None):
+        RequestHandler.__init__(self, handler_factory)
+        self.socket_options = socket_options
+        self.tx_high_water = handler_factory.tx_high_water
+        self.tx_low_water = handler_factory.tx_low_water
+        self.transport = None
+        self.address = None
+        self.reading_paused = False
+        self.writing_paused = False
+        # Bytes of the transport write buffer charged to the memory budget
+        # and the tx_buffered_bytes metric. The transport sends on its own,
+        # so the buffer is measured after each write and then polled every
+        # TX_SYNC_INTERVAL until it is empty.
+        self.tx_charged = 0
+        self.tx_sync_handle = None
+        
+    @property
+    def closed(self):
+        return self.transport.is_closing()
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(self.tx_high_water, self.tx_low_water)
+        
+        sock = transport.get_extra_info('socket')
+        if self.socket_options:
+            self.socket_options.apply_connection(sock)
+        self.address = connection_address(sock)
+        self.logger.info('new client %s', self.address)
+        
+        if self.metrics:
+            self.metrics.connection_opened()
+        
+        self.start_timer()
+    
+    def connection_lost(self, exc):
+        self.reader.close()
+        
+        if self.tx_sync_handle:
+            self.tx_sync_handle.cancel()
+            self.tx_sync_handle = None
+        self.charge_tx(0)
+        
+        if self.metrics:
+            self.metrics.connection_closed()
+        
+        if exc:
+            self.logger.info('close failed client %s: %s', self.address, exc)
+        else:
+            self.logger.info('close eof client %s', self.address)
+    
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+    
+    def buffer_updated(self, nbytes):
+        if self.tracer:
+            self.note_read()
+        self.reader.buffer_updated(nbytes)
+        if self.metrics:
+            self.metrics.bytes_received += nbytes
+        
+        try:
+            self.dispatch_frames()
+        except Exception as ex:
+            self.logger.exception('%s Exception occurred.', self.address)
+            self.transport.abort()
+            return
+        
+        if self.timeouts:
+            self.note_received(nbytes)
+        
+        if self.broken:
+            # Sends what is buffered, then closes.
+            self.transport.close()
+        else:
+            self.update_reading()
+    
+    def submit(self, request, response):
+        executor = request.hosted.executor
+        if executor.mode == EXECUTION_ASYNC:
+            future = executor.try_create_task(request)
+        else:
+            future = executor.try_submit(request)
+            if future:
+                future = asyncio.wrap_future(future)
+        
+        if not future:
+            return None
+        
+        future.add_done_callback(lambda future: self.executor_done(response, future))
+        return future
+    
+    def wait(self, future, response):
+        response.hosted.executor.add_waiter()
+        future.add_done_callback(lambda future: self.executor_done(response, future))
+    
+    def executor_done(self, response, future):
+        executor = response.hosted.executor
+        executor.task_done()
+        
+        if not future.cancelled():
+            status, result_data = executor.get_result(response, future)
+            self.complete(response, status, result_data)
+            
+            if self.broken:
+                self.transport.close()
+            elif not self.closed:
+                self.update_reading()
+    
+    def send_data(self, data):
+        self.transport.write(data)
+        if self.metrics:
+            self.metrics.bytes_sent += len(data)
+        if self.memory_budget or self.metrics:
+            self.sync_tx()
+    
+    def send_response(self, response):
+        header_data, body_data = self.encode_response(response)
+        self.transport.writelines([header_data, body_data])
+        if self.metrics:
+            self.metrics.bytes_sent += MESSAGE_HEADER_LENGTH + len(body_data)
+        if self.memory_budget or self.metrics:
+            self.sync_tx()
+    
+    def charge_tx(self, size):
+        count = size - self.tx_charged
+        if count == 0:
+            return
+        
+        self.tx_charged = size
+        if self.memory_budget:
+            self.memory_budget.charge(count)
+        if self.metrics:
+            self.metrics.tx_buffered_bytes += count
+    
+    def sync_tx(self):
+        self.charge_tx(self.transport.get_write_buffer_size())
+        if self.tx_charged and not self.tx_sync_handle:
+            self.tx_sync_handle = asyncio.get_running_loop().call_later(TX_SYNC_INTERVAL, self.poll_tx)
+    
+    def poll_tx(self):
+        self.tx_sync_handle = None
+        self.sync_tx()
+        
+        # Reading may resume once this connection's responses are sent.
+        if not self.closed:
+            self.resume_dispatch()
+            if self.broken:
+                self.transport.close()
+            elif not self.closed:
+                self.update_reading()
+    
+    def has_pending_tx(self):
+        return self.tx_charged > 0
+    
+    def flow_paused(self):
+        # Like ClientHandler.flow_paused: while the memory budget is
+        # exhausted, connections that still have responses to send stop
+        # reading.
+        if self.writing_paused:
+            return True
+        return self.memory_budget is not None and self.memory_budget.exhausted and self.has_pending_tx()
+    
+    def update_reading(self):
+        # Reading pauses while the in-flight window is full or the transport
+        # write buffer is above its high water mark.
+        paused = not self.wants_read()
+        if paused == self.reading_paused:
+            return
+        
+        self.reading_paused = paused
+        if paused:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+    
+    def pause_writing(self):
+        self.writing_paused = True
+        self.update_reading()
+    
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.memory_budget or self.metrics:
+            self.sync_tx()
+        if self.timeouts:
+            self.last_activity = time.monotonic()
+        self.resume_dispatch()
+        
+        if self.broken:
+            self.transport.close()
+        else:
+            self.update_reading()
@@ -0,0 +1,145 @@
+################################################################################
+# Logging pipeline.                                                            #
+#                                                                              #
+# Threads that log only put the record on a bounded queue; a listener thread   #
+# formats it and writes it to the console and the log file. When the queue     #
+# is full the record is dropped and counted rather than blocking the event     #
+# loop. Repetitive messages are rate limited per logging call site.            #
+# Process pool workers send their records to the parent over a                 #
+# multiprocessing queue, since a forked worker has no listener thread.         #
+################################################################################
+
+import os, queue, logging, logging.handlers, multiprocessing
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+DEFAULT_QUEUE_SIZE = 10000
+
+DEFAULT_RATE_LIMIT_COUNT = 20
+DEFAULT_RATE_LIMIT_INTERVAL = 10.0
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def init_worker_logging(log_queue, level):
+    # Runs in a process pool worker. The handlers inherited from the parent
+    # are replaced without closing them, since they belong to the parent.
+    logger = logging.getLogger()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    # Feeds the given handlers from a listener thread.
+    def __init__(self, handlers, queue_size=DEFAULT_QUEUE_SIZE):
+        super().__init__(queue.Queue(queue_size))
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.pid = os.getpid()
+        self.listener = LogListener(self, handlers)
+        self.listener.start()
+    
+    def prepare(self, record):
+        # The listener runs in this process, so the record is passed as it
+        # is and the message and traceback are formatted on its thread.
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    
+    def report_dropped(self):
+        # Called on the listener thread, or after it stopped.
+        dropped = self.dropped
+        if dropped == self.reported_dropped:
+            return
+        
+        record = logging.LogRecord('root', logging.WARNING, __file__, 0,
+            'Log queue full, %d records dropped (%d in total)', (dropped - self.reported_dropped, dropped), None)
+        self.reported_dropped = dropped
+        for handler in self.listener.handlers:
+            handler.handle(record)
+    
+    def close(self):
+        # A forked child has no listener thread, and the parent's queue may
+        # have been locked at the fork, so it is left alone there.
+        if self.listener and os.getpid() == self.pid:
+            self.listener.stop()
+            self.report_dropped()
+        self.listener = None
+        super().close()
+
+class LogListener(logging.handlers.QueueListener):
+    def __init__(self, queue_handler, handlers):
+        super().__init__(queue_handler.queue, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+    
+    def handle(self, record):
+        super().handle(record)
+        self.queue_handler.report_dropped()
+    
+    def enqueue_sentinel(self):
+        # Waits for room, the records queued before the sentinel are written.
+        self.queue.put(self._sentinel)
+
+class WorkerLogForwarder:
+    # Receives the records of process pool workers, set up with
+    # init_worker_logging(forwarder.queue, forwarder.level), and logs them in
+    # this process. The workers format the message and traceback before they
+    # send a record.
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.level = logging.getLogger().level
+        self.listener = logging.handlers.QueueListener(self.queue, ParentLogHandler())
+        self.listener.start()
+    
+    def close(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        self.queue.close()
+
+class ParentLogHandler(logging.Handler):
+    def emit(self, record):
+        logging.getLogger().handle(record)
+
+class RateLimitFilter(logging.Filter):
+    # Lets at most 'count' records per 'interval' seconds through from each
+    # logging call site. The number suppressed is appended to the first
+    # record let through after them.
+    def __init__(self, count=DEFAULT_RATE_LIMIT_COUNT, interval=DEFAULT_RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.count = count
+        self.interval = interval
+        
+        # (pathname, lineno) -> [window start, records passed, records suppressed]
+        self.windows = {}
+        self.suppressed = 0
+    
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        window = self.windows.get(key)
+        
+        if window is None or record.created - window[0] >= self.interval:
+            if window and window[2]:
+                record.msg = f'{record.msg} ({window[2]} similar messages suppressed)'
+            window = [record.created, 0, 0]
+            self.windows[key] = window
+        
+        if window[1] >= self.count:
+            window[2] += 1
+            self.suppressed += 1
+            return False
+        
+        window[1] += 1
+        return True
@@ -0,0 +1,277 @@
+################################################################################
+# Server metrics.                                                              #
+#                                                                              #
+# Counters, gauges and latency histograms recorded on the event loop thread,   #
+# published in the Prometheus text format on an HTTP admin port. The admin     #
+# port may also start on-demand profiles, see profiling.py.                    #
+################################################################################
+
+import bisect, threading, logging
+import http.server, urllib.parse
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+METRIC_PREFIX = 'tcp_server'
+
+# Histogram bucket upper bounds in seconds: 10 us to about 100 s, four
+# buckets per doubling. Quantiles are interpolated within a bucket.
+HISTOGRAM_BOUNDS = [0.00001 * 2 ** (i / 4) for i in range(93)]
+
+QUANTILES = [0.5, 0.99, 0.999]
+
+# How often the asyncio engine measures the loop lag.
+LAG_PROBE_INTERVAL = 0.1
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_ADMIN_HOST = '127.0.0.1'
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class Histogram:
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        # bounds[i] is the upper bound of counts[i]. The last bucket counts
+        # values above the last bound.
+        self.bounds = bounds
+        self.overflow = len(bounds)
+        self.counts = [0] * (self.overflow + 1)
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+    
+    def snapshot(self):
+        # Copied in one step, since the loop thread keeps recording while the
+        # admin thread formats the metrics.
+        counts = self.counts[:]
+        return counts, sum(counts), self.sum
+    
+    def quantile(self, q, counts, count):
+        if count == 0:
+            return 0.0
+        
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count > 0:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index] if index < self.overflow else self.bounds[-1]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        
+        return self.bounds[-1]
+    
+class ServiceMetrics(Histogram):
+    # Request duration histogram and response counts by status of one
+    # service. Handlers keep a reference, so recording a response is one
+    # method call.
+    def __init__(self):
+        super().__init__()
+        self.responses = [0] * 256
+    
+    def observe_response(self, status, seconds):
+        self.responses[status] += 1
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+    
+class Metrics:
+    # Recording is plain attribute and list updates, so it is only safe on
+    # the event loop thread. The admin thread only reads.
+    def __init__(self):
+        self.services = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections_active = 0
+        self.connections_total = 0
+        # reason -> connections closed by a timeout
+        self.connections_reclaimed = {}
+        self.tx_buffered_bytes = 0
+        self.loop_iteration_seconds = Histogram()
+        self.loop_lag_seconds = 0.0
+        # Only grows, so that a scrape does not change what others read. The
+        # loop_iteration_seconds histogram shows recent lag.
+        self.loop_lag_max_seconds = 0.0
+        # phase -> Histogram recorded by a profiling.RequestTracer
+        self.phases = {}
+        # A response_cache.ResponseCache whose counters are published.
+        self.response_cache = None
+    
+    def phase(self, name):
+        histogram = self.phases.get(name)
+        if histogram is None:
+            histogram = self.phases[name] = Histogram()
+        return histogram
+    
+    def service(self, service_name):
+        service_metrics = self.services.get(service_name)
+        if service_metrics is None:
+            service_metrics = self.services[service_name] = ServiceMetrics()
+        return service_metrics
+    
+    def connection_opened(self):
+        self.connections_active += 1
+        self.connections_total += 1
+    
+    def connection_closed(self):
+        self.connections_active -= 1
+    
+    def connection_reclaimed(self, reason):
+        self.connections_reclaimed[reason] = self.connections_reclaimed.get(reason, 0) + 1
+    
+    def observe_loop_iteration(self, seconds):
+        self.loop_iteration_seconds.observe(seconds)
+        self.observe_loop_lag(seconds)
+    
+    def observe_loop_lag(self, seconds):
+        # An event that becomes ready while the loop is busy waits up to one
+        # iteration before it is handled.
+        self.loop_lag_seconds = seconds
+        if seconds > self.loop_lag_max_seconds:
+            self.loop_lag_max_seconds = seconds
+    
+    def render(self):
+        lines = []
+        
+        def add(name, kind, help_text, samples):
+            name = f'{METRIC_PREFIX}_{name}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else f'{name}{suffix} {value}')
+        
+        services = self.services.copy()
+        
+        samples = []
+        for service_name, service_metrics in services.items():
+            for status, count in enumerate(service_metrics.responses[:]):
+                if count:
+                    samples.append(('', [('service', service_name), ('status', status)], count))
+        add('responses_total', 'counter', 'Responses sent, by service and status.', samples)
+        
+        add('received_bytes_total', 'counter', 'Bytes received from clients.', [('', [], self.bytes_received)])
+        add('sent_bytes_total', 'counter', 'Bytes sent to clients.', [('', [], self.bytes_sent)])
+        add('connections_active', 'gauge', 'Open client connections.', [('', [], self.connections_active)])
+        add('connections_total', 'counter', 'Accepted client connections.', [('', [], self.connections_total)])
+        add('connections_reclaimed_total', 'counter', 'Connections closed by a timeout, by reason.',
+            [('', [('reason', reason)], count) for reason, count in self.connections_reclaimed.copy().items()])
+        add('tx_buffered_bytes', 'gauge', 'Response bytes waiting to be sent.', [('', [], self.tx_buffered_bytes)])
+        
+        if self.response_cache:
+            cache_stats = self.response_cache.stats()
+            add('response_cache_hits_total', 'counter', 'Requests answered from the response cache.',
+                [('', [], cache_stats['hits'])])
+            add('response_cache_misses_total', 'counter', 'Cacheable requests not found in the response cache.',
+                [('', [], cache_stats['misses'])])
+            add('response_cache_evictions_total', 'counter', 'Results evicted to keep the response cache in size.',
+                [('', [], cache_stats['evictions'])])
+            add('response_cache_coalesced_total', 'counter', 'Requests that waited for an identical request.',
+                [('', [], cache_stats['coalesced'])])
+            add('response_cache_entries', 'gauge', 'Results in the response cache.', [('', [], cache_stats['entries'])])
+            add('response_cache_bytes', 'gauge', 'Result bytes in the response cache.', [('', [], cache_stats['bytes'])])
+        
+        for service_name, service_metrics in services.items():
+            self.add_histogram(add, 'request_duration_seconds', 'Time from dispatch to response, by service.',
+                service_metrics, [('service', service_name)])
+        
+        for phase, histogram in self.phases.copy().items():
+            self.add_histogram(add, 'phase_seconds', 'Time spent in each phase of a request, and per batch of accepts.',
+                histogram, [('phase', phase)])
+        
+        self.add_histogram(add, 'loop_iteration_seconds', 'Event loop time spent handling the events of one wait.',
+            self.loop_iteration_seconds, [])
+        add('loop_lag_seconds', 'gauge', 'Last measured event loop lag.', [('', [], self.loop_lag_seconds)])
+        add('loop_lag_max_seconds', 'gauge', 'Largest event loop lag since the server started.',
+            [('', [], self.loop_lag_max_seconds)])
+        
+        return '\n'.join(lines) + '\n'
+    
+    def add_histogram(self, add, name, help_text, histogram, labels):
+        counts, count, total = histogram.snapshot()
+        
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.bounds, counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', labels + [('le', f'{bound:.6g}')], cumulative))
+        samples.append(('_bucket', labels + [('le', '+Inf')], count))
+        samples.append(('_sum', labels, total))
+        samples.append(('_count', labels, count))
+        add(name, 'histogram', help_text, samples)
+        
+        add(name + '_quantile', 'gauge', help_text + ' Estimated quantiles.',
+            [('', labels + [('quantile', q)], histogram.quantile(q, counts, count)) for q in QUANTILES])
+    
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        
+        body = self.server.metrics.render().encode('utf-8')
+        
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_POST(self):
+        # POST /profile?seconds=N&mode=cprofile|sample starts a profile of
+        # the event loop.
+        url = urllib.parse.urlsplit(self.path)
+        profiler = self.server.profiler
+        if url.path != '/profile' or not profiler:
+            self.send_error(404)
+            return
+        
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            seconds = float(query['seconds'][0]) if 'seconds' in query else None
+            path = profiler.request(seconds, query['mode'][0] if 'mode' in query else None)
+        except ValueError as ex:
+            self.send_text(400, f'{ex}\n')
+            return
+        
+        if path is None:
+            self.send_text(409, 'A profile is already running.\n')
+        else:
+            self.send_text(202, f'Profiling to {path}\n')
+    
+    def send_text(self, code, text):
+        body = text.encode('utf-8')
+        
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer:
+    # Serves GET /metrics, and POST /profile when a profiling.Profiler is
+    # given, on a daemon thread. The admin port has no authentication, so it
+    # listens on the loopback interface unless another host is given.
+    def __init__(self, metrics, port, profiler=None, host=DEFAULT_ADMIN_HOST):
+        self.logger = logging.getLogger()
+        self.httpd = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = metrics
+        self.httpd.profiler = profiler
+        self.thread = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-server', daemon=True)
+        self.thread.start()
+        self.logger.info('Metrics on http://%s:%d/metrics', self.httpd.server_address[0], self.httpd.server_address[1])
+    
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,145 @@
+################################################################################
+# Pre-forked multi-process server.                                             #
+#                                                                              #
+# Features:                                                                    #
+#   1. Master process forks N workers, each running its own event loop.        #
+#   2. Workers bind the same port with SO_REUSEPORT; the kernel balances       #
+#      connections between them.                                               #
+#   3. Crashed workers are restarted and shutdown is propagated.               #
+#   4. Other signals, such as the profile signal, may be forwarded to all      #
+#      workers.                                                                #
+################################################################################
+
+import os, sys, time, signal, socket, weakref, logging
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+# A worker that crashes sooner than this after being started is restarted
+# only after this delay, so a worker that fails at startup does not spin.
+RESTART_MIN_INTERVAL = 1.0
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def handle_worker_stop_signal(signum, frame):
+    sys.exit(0)
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class PreforkServer:
+    # Signals in forward_signals received by the master are sent to every
+    # worker. Workers ignore them until worker_main installs its handlers.
+    def __init__(self, name, worker_count, forward_signals=()):
+        self.logger = logging.getLogger()
+        self.name = name
+        self.worker_count = worker_count
+        self.forward_signals = forward_signals
+        self.workers = {}
+        self.stopping = False
+        
+    def run(self, worker_main):
+        # worker_main(worker_index) runs in each forked worker process. It is
+        # expected to configure its own logging and run an event loop that
+        # binds its listening socket with SO_REUSEPORT.
+        if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('Pre-forked workers require os.fork and SO_REUSEPORT')
+        
+        signal.signal(signal.SIGTERM, self.handle_stop_signal)
+        signal.signal(signal.SIGINT, self.handle_stop_signal)
+        for signum in self.forward_signals:
+            signal.signal(signum, self.handle_forward_signal)
+        
+        for worker_index in range(self.worker_count):
+            self.start_worker(worker_index, worker_main)
+        
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            
+            worker_index, start_time = self.workers.pop(pid)
+            exit_code = os.waitstatus_to_exitcode(status)
+            
+            if self.stopping:
+                self.logger.info('worker %d (pid %d) stopped, exit code = %s', worker_index, pid, exit_code)
+                continue
+            
+            if exit_code == 0:
+                self.logger.info('worker %d (pid %d) exited', worker_index, pid)
+                continue
+            
+            self.logger.error('worker %d (pid %d) crashed, exit code = %s', worker_index, pid, exit_code)
+            
+            delay = RESTART_MIN_INTERVAL - (time.monotonic() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+            
+            if not self.stopping:
+                self.start_worker(worker_index, worker_main)
+        
+        self.logger.info('All workers stopped.')
+    
+    def start_worker(self, worker_index, worker_main):
+        pid = os.fork()
+        
+        if pid == 0:
+            self.run_worker(worker_index, worker_main)
+        
+        self.workers[pid] = (worker_index, time.monotonic())
+        self.logger.info('worker %d started, pid = %d', worker_index, pid)
+    
+    def run_worker(self, worker_index, worker_main):
+        signal.signal(signal.SIGTERM, handle_worker_stop_signal)
+        signal.signal(signal.SIGINT, handle_worker_stop_signal)
+        for signum in self.forward_signals:
+            signal.signal(signum, signal.SIG_IGN)
+        
+        # Handlers inherited from the master write to the master's log file.
+        # RotatingFileHandler is not multi-process safe, and the thread that
+        # writes the log does not survive the fork, so each worker must open
+        # its own.
+        logger = logging.getLogger()
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
+        
+        exit_code = 0
+        try:
+            worker_main(worker_index)
+        except SystemExit as ex:
+            exit_code = ex.code if isinstance(ex.code, int) else 0
+        except BaseException as ex:
+            logger.exception('Worker failed.')
+            exit_code = 1
+        finally:
+            # Only the worker's own handlers are shut down. The master's were
+            # inherited with the fork, maybe while the master's log writer
+            # thread held the lock of their stream, and would never flush.
+            logging.shutdown([weakref.ref(handler) for handler in logger.handlers])
+            os._exit(exit_code)
+    
+    def handle_stop_signal(self, signum, frame):
+        if self.stopping:
+            return
+        
+        self.stopping = True
+        self.logger.info('Stopping %d workers (signal %d).', len(self.workers), signum)
+        
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    def handle_forward_signal(self, signum, frame):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
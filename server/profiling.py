@@ -0,0 +1,296 @@
+################################################################################
+# Runtime profiling.                                                           #
+#                                                                              #
+# Features:                                                                    #
+#   1. Request tracing: the time each request spends in the read, frame        #
+#      parse, service and write phases, and the time of each batch of          #
+#      accepts, recorded as histograms in the metrics.                         #
+#   2. Slow request log: requests that take longer than a threshold are        #
+#      logged with their request ID, service, body size and phase times.       #
+#   3. On-demand profiler: a cProfile or sampling profile of the event loop    #
+#      thread for a number of seconds, started by a signal or the admin port   #
+#      without restarting the server, and written to the log directory.        #
+################################################################################
+
+import os, sys, io, time, threading, logging, collections, cProfile, pstats
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+PHASE_ACCEPT  = 'accept'
+PHASE_READ    = 'read'
+PHASE_PARSE   = 'parse'
+PHASE_SERVICE = 'service'
+PHASE_WRITE   = 'write'
+
+REQUEST_PHASES = (PHASE_READ, PHASE_PARSE, PHASE_SERVICE, PHASE_WRITE)
+
+DEFAULT_SLOW_REQUEST_THRESHOLD = 1.0
+
+PROFILE_CPROFILE = 'cprofile'
+PROFILE_SAMPLE   = 'sample'
+
+PROFILE_MODES = (PROFILE_CPROFILE, PROFILE_SAMPLE)
+
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 3600
+
+# The sampling profiler records the stack of the event loop thread this
+# often.
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# How often the asyncio engine starts and stops requested profiles.
+PROFILE_POLL_INTERVAL = 0.5
+
+# Functions listed in the summary of a cProfile profile.
+PROFILE_SUMMARY_LINES = 50
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class RequestTrace:
+    # Times of one request from time.perf_counter(): the receive that brought
+    # the first bytes of its frame, the start and end of parsing the frame,
+    # and the completion of its result.
+    __slots__ = ('body_length', 'received', 'parse_started', 'parsed', 'completed')
+    
+    def __init__(self, body_length, received, parse_started, parsed):
+        self.body_length = body_length
+        self.received = received
+        self.parse_started = parse_started
+        self.parsed = parsed
+        self.completed = None
+
+class RequestTracer:
+    # Hooks called by the engines and the connection handlers. The phases of
+    # a request are
+    #   read:    from the receive that brought the first bytes of its frame
+    #            until the frame is complete, including the time it waited
+    #            behind earlier frames of the connection
+    #   parse:   header parse, admission and framing of the body
+    #   service: from dispatch until the result is complete, including the
+    #            time queued for an executor
+    #   write:   until the response is handed to the kernel, including the
+    #            time it waited for earlier responses; the asyncio engine
+    #            hands it to the transport
+    # Streamed requests are read while the service runs, so their read phase
+    # ends with the header.
+    #
+    # The phase times are recorded in the metrics, when given, and requests
+    # that take slow_threshold seconds or longer are logged. Subclasses may
+    # override observe_accept and observe_request to export them elsewhere.
+    def __init__(self, slow_threshold=DEFAULT_SLOW_REQUEST_THRESHOLD, metrics=None):
+        self.logger = logging.getLogger()
+        self.slow_threshold = slow_threshold
+        self.histograms = None
+        if metrics:
+            self.histograms = {phase: metrics.phase(phase) for phase in (PHASE_ACCEPT,) + REQUEST_PHASES}
+        self.slow_count = 0
+    
+    def start(self, body_length, received, parse_started):
+        return RequestTrace(body_length, received, parse_started, time.perf_counter())
+    
+    def finish(self, response, address):
+        # Called once the response left the connection's send buffer.
+        trace = response.trace
+        now = time.perf_counter()
+        self.observe_request(response, address, trace.parse_started - trace.received, trace.parsed - trace.parse_started,
+            trace.completed - trace.parsed, now - trace.completed, now - trace.received)
+    
+    def observe_accept(self, seconds, count):
+        if self.histograms:
+            self.histograms[PHASE_ACCEPT].observe(seconds)
+    
+    def observe_request(self, response, address, read, parse, service, write, total):
+        if self.histograms:
+            histograms = self.histograms
+            histograms[PHASE_READ].observe(read)
+            histograms[PHASE_PARSE].observe(parse)
+            histograms[PHASE_SERVICE].observe(service)
+            histograms[PHASE_WRITE].observe(write)
+        
+        if self.slow_threshold is not None and total >= self.slow_threshold:
+            self.slow_count += 1
+            self.logger.warning('%s Slow request %d: service %s, body %d bytes, %.3f ms '
+                '(read %.3f, parse %.3f, service %.3f, write %.3f ms)', address, response.request_id,
+                response.hosted.name, response.trace.body_length, total * 1e3, read * 1e3, parse * 1e3,
+                service * 1e3, write * 1e3)
+
+class SamplingProfiler:
+    # Records the stack of one thread every 'interval' seconds on a thread
+    # of its own, so the profiled thread runs unchanged. The stacks are
+    # written in the collapsed format of flame graph tools: the functions
+    # from the outermost, separated by ';', and the number of samples.
+    def __init__(self, thread_id, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.sample_count = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+    
+    def run(self):
+        # Frame labels are cached by code object.
+        labels = {}
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+                stack.append(label)
+                frame = frame.f_back
+            
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.sample_count += 1
+    
+    def dump(self, file_name):
+        with open(file_name, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+class Profiler:
+    # Profiles the event loop thread on demand. request() may be called from
+    # any thread, and handle_signal() is a signal handler. The profile is
+    # started and stopped by poll(), which the event loop calls at least
+    # once a second, because cProfile only profiles the thread that enables
+    # it. The files are written on a thread of their own:
+    #   <dir>/profile-<pid>-<time>.prof     cProfile data for pstats or snakeviz
+    #   <dir>/profile-<pid>-<time>.txt      the top functions by cumulative time
+    #   <dir>/profile-<pid>-<time>.folded   sampled stacks for flame graphs
+    def __init__(self, output_dir, seconds=DEFAULT_PROFILE_SECONDS, mode=PROFILE_CPROFILE,
+            sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode: {mode}')
+        
+        self.logger = logging.getLogger()
+        self.output_dir = output_dir
+        self.seconds = seconds
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        # (mode, seconds, path) of a requested profile, set under the lock.
+        self.pending = None
+        # Set by the signal handler, which must not take the lock.
+        self.signalled = False
+        self.active = None
+        self.active_mode = None
+        self.active_path = None
+        self.deadline = None
+    
+    def request(self, seconds=None, mode=None):
+        # Returns the path of the profile files without their extension, or
+        # None when a profile is already requested or running.
+        seconds = self.seconds if seconds is None else seconds
+        mode = self.mode if mode is None else mode
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode: {mode}')
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise ValueError(f'Profile seconds must be in (0, {MAX_PROFILE_SECONDS}]: {seconds}')
+        
+        with self.lock:
+            if self.pending or self.active:
+                return None
+            
+            path = os.path.join(self.output_dir, f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}')
+            self.pending = (mode, seconds, path)
+        return path
+    
+    def handle_signal(self, signum, frame):
+        self.signalled = True
+    
+    def poll(self):
+        # Called on the event loop thread.
+        if self.signalled:
+            self.signalled = False
+            if self.request() is None:
+                self.logger.warning('Profile signal ignored, a profile is already running.')
+        
+        if self.deadline is not None:
+            if time.monotonic() >= self.deadline:
+                self.stop()
+        elif self.pending is not None and self.active is None:
+            self.start()
+    
+    def start(self):
+        mode, seconds, path = self.pending
+        
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            
+            if mode == PROFILE_CPROFILE:
+                profile = cProfile.Profile()
+                profile.enable()
+            else:
+                profile = SamplingProfiler(threading.get_ident(), self.sample_interval)
+                profile.start()
+        except Exception as ex:
+            # For example another profiler is active.
+            self.logger.exception('Profiling failed to start.')
+            with self.lock:
+                self.pending = None
+            return
+        
+        self.active = profile
+        self.active_mode = mode
+        self.active_path = path
+        self.deadline = time.monotonic() + seconds
+        self.logger.info('Profiling (%s) for %g seconds to %s', mode, seconds, path)
+    
+    def stop(self):
+        self.deadline = None
+        if self.active_mode == PROFILE_CPROFILE:
+            self.active.disable()
+        else:
+            self.active.stop()
+        
+        # The profile is written while the loop goes on. Another profile may
+        # start once it is written.
+        threading.Thread(target=self.write, args=(self.active, self.active_mode, self.active_path),
+            name='profile-writer', daemon=True).start()
+    
+    def write(self, profile, mode, path):
+        try:
+            if mode == PROFILE_CPROFILE:
+                profile.dump_stats(path + '.prof')
+                
+                summary = io.StringIO()
+                stats = pstats.Stats(profile, stream=summary)
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_SUMMARY_LINES)
+                with open(path + '.txt', 'w') as f:
+                    f.write(summary.getvalue())
+                self.logger.info('Profile written to %s.prof and %s.txt', path, path)
+            else:
+                profile.dump(path + '.folded')
+                self.logger.info('Profile of %d samples written to %s.folded', profile.sample_count, path)
+        except Exception as ex:
+            self.logger.exception('Writing the profile to %s failed.', path)
+        finally:
+            with self.lock:
+                self.pending = None
+                self.active = None
+    
+    def close(self):
+        # A running profile is cut short and written before the server
+        # exits.
+        if self.deadline is not None:
+            self.deadline = None
+            if self.active_mode == PROFILE_CPROFILE:
+                self.active.disable()
+            else:
+                self.active.stop()
+            self.write(self.active, self.active_mode, self.active_path)
@@ -0,0 +1,125 @@
+################################################################################
+# Response cache.                                                              #
+#                                                                              #
+# Caches the results of deterministic services, keyed by the service and a     #
+# hash of the request body. Entries are evicted in LRU order once the cached   #
+# bytes exceed the limit, and optionally expire after a TTL. Identical         #
+# requests that arrive while the first one is processed wait for its result.   #
+################################################################################
+
+import time, hashlib, collections
+from tcp_server import STATUS_OK
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Requests with a larger body are not cached, so that streamed services keep
+# streaming them.
+DEFAULT_CACHE_MAX_BODY_LENGTH = 64 * 1024
+
+KEY_DIGEST_SIZE = 16
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def is_cacheable_service(service):
+    # Services declare with a 'cacheable = True' attribute that their result
+    # depends only on the request body.
+    return getattr(service, 'cacheable', False)
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class ResponseCache:
+    def __init__(self, max_bytes=DEFAULT_CACHE_MAX_BYTES, ttl=None,
+            max_body_length=DEFAULT_CACHE_MAX_BODY_LENGTH):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_body_length = max_body_length
+        
+        # key -> (result_data, expiry time or None), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        
+        # key -> future of the request being processed for that key
+        self.pending = {}
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+    
+    def accepts(self, request):
+        # The key covers only the body, so batch requests are not cached.
+        return request.hosted.cacheable and request.body_length <= self.max_body_length and not request.batch
+    
+    def make_key(self, service_id, body_data):
+        # The service ID personalizes the hash, so identical bodies sent to
+        # different services have different keys.
+        return hashlib.blake2b(body_data, digest_size=KEY_DIGEST_SIZE, person=service_id.to_bytes(2, 'little')).digest()
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            result_data, expiry = entry
+            if expiry is None or expiry > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result_data
+            
+            self.remove(key)
+        
+        self.misses += 1
+        return None
+    
+    def put(self, key, result_data):
+        if len(result_data) > self.max_bytes:
+            return
+        
+        if key in self.entries:
+            self.remove(key)
+        
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        self.entries[key] = (result_data, expiry)
+        self.size += len(result_data)
+        
+        while self.size > self.max_bytes:
+            old_key = next(iter(self.entries))
+            self.remove(old_key)
+            self.evictions += 1
+    
+    def remove(self, key):
+        result_data, expiry = self.entries.pop(key)
+        self.size -= len(result_data)
+    
+    def get_pending(self, key):
+        # The future of an identical request being processed, if any.
+        future = self.pending.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+    
+    def add_pending(self, key, future):
+        self.pending[key] = future
+    
+    def finish(self, key, status, result_data):
+        # Called once the request that was processed for the key completes.
+        # Only successful results are cached.
+        self.pending.pop(key, None)
+        if status == STATUS_OK:
+            self.put(key, result_data)
+    
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'coalesced': self.coalesced
+        }
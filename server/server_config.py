@@ -0,0 +1,145 @@
+################################################################################
+# Server configuration file and command line.                                  #
+#                                                                              #
+# The settings are the variables of the Configuration section of               #
+# server_main.py. A configuration file given with --config changes them, and   #
+# the command line changes the file's values. Values are Python literals,      #
+# anything else is taken as a string.                                          #
+################################################################################
+
+import ast, argparse, configparser
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+# Types of the values a setting may have.
+SETTING_TYPES = (type(None), bool, int, float, str, list, tuple, dict)
+
+# Command line options of frequently changed settings:
+# option -> (setting, help). Others are set with --set NAME=VALUE.
+COMMAND_LINE_OPTIONS = {
+        '--port': ('port', 'TCP port, None to listen on the Unix domain socket only'),
+        '--unix-path': ('unix_path', 'Unix domain socket to listen on'),
+        '--engine': ('engine', 'select, selectors or asyncio'),
+        '--workers': ('worker_count', 'number of pre-forked worker processes, 0 for none'),
+        '--log-file': ('log_file_name', 'log file of the server'),
+        '--backlog': ('backlog', 'connections queued on the listening socket')
+    }
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def module_settings(namespace):
+    # The settings among the variables of a module: lower case names with a
+    # value a configuration file can give.
+    return {name: value for name, value in namespace.items()
+        if name.islower() and not name.startswith('_') and isinstance(value, SETTING_TYPES)}
+
+def parse_value(text):
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, TypeError, SyntaxError):
+        return text
+
+def setting_type(name, defaults, declared_types):
+    # The type of the default value, or the declared type of a setting whose
+    # default is None.
+    if defaults[name] is not None:
+        return type(defaults[name])
+    if name not in declared_types:
+        raise TypeError(f'Setting {name} defaults to None and has no declared type')
+    return declared_types[name]
+
+def check_setting(name, value, defaults, declared_types):
+    # A setting keeps its type, see setting_type. An int may be given for a
+    # float setting but not the other way round, and None for any setting.
+    if name not in defaults:
+        raise ValueError(f'Unknown setting: {name}')
+    
+    expected = setting_type(name, defaults, declared_types)
+    if value is None:
+        return
+    
+    if issubclass(expected, bool) or isinstance(value, bool):
+        valid = issubclass(expected, bool) and isinstance(value, bool)
+    elif issubclass(expected, float):
+        valid = isinstance(value, (int, float))
+    elif issubclass(expected, int):
+        valid = isinstance(value, int)
+    else:
+        valid = isinstance(value, expected)
+    
+    if not valid:
+        raise ValueError(f'Setting {name} must be {expected.__name__}, not {type(value).__name__}: {value!r}')
+
+def load_config_file(file_name):
+    # The section names only group the settings.
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.optionxform = str
+    with open(file_name) as f:
+        parser.read_file(f)
+    
+    settings = {}
+    for section in parser.sections():
+        for name, text in parser.items(section):
+            settings[name] = parse_value(text)
+    
+    return settings
+
+def parse_assignment(text):
+    name, separator, value = text.partition('=')
+    if not separator:
+        raise ValueError(f'Expected NAME=VALUE: {text}')
+    
+    return name.strip(), parse_value(value.strip())
+
+def create_argument_parser(script_name):
+    parser = argparse.ArgumentParser(prog=script_name,
+        description='Settings are read from the Configuration section of server_main.py, then the '
+            'configuration file, then the command line.')
+    parser.add_argument('service_name', nargs='?', help='service that also answers service ID 0')
+    parser.add_argument('-c', '--config', metavar='FILE', help='configuration file')
+    
+    for option, (name, help_text) in COMMAND_LINE_OPTIONS.items():
+        parser.add_argument(option, dest=name, type=parse_value, default=argparse.SUPPRESS, metavar=name.upper(),
+            help=help_text)
+    
+    parser.add_argument('-s', '--set', dest='assignments', action='append', default=[], metavar='NAME=VALUE',
+        help='any setting, may be repeated')
+    return parser
+
+def load_settings(script_name, argv, defaults, declared_types):
+    # Returns the settings changed by the configuration file and the command
+    # line. Invalid settings exit with a usage message. declared_types maps
+    # the settings that default to None to their type.
+    for name in defaults:
+        setting_type(name, defaults, declared_types)
+    
+    parser = create_argument_parser(script_name)
+    arguments = parser.parse_args(argv)
+    
+    try:
+        settings = {}
+        if arguments.config:
+            settings.update(load_config_file(arguments.config))
+        
+        for text in arguments.assignments:
+            name, value = parse_assignment(text)
+            settings[name] = value
+        
+        # Options that are not given are not set, so that None is a value.
+        for name, help_text in COMMAND_LINE_OPTIONS.values():
+            if hasattr(arguments, name):
+                settings[name] = getattr(arguments, name)
+        
+        if arguments.service_name is not None:
+            settings['service_name'] = arguments.service_name
+        
+        for name, value in settings.items():
+            check_setting(name, value, defaults, declared_types)
+    except (OSError, ValueError, configparser.Error) as ex:
+        parser.error(str(ex))
+    
+    return settings
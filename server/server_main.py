@@ -1,21 +1,50 @@
 ################################################################################
 # TCP socket server main.                                                      #
+#                                                                              #
+# Usage: python server_main.py [--config FILE] [options] <service_name>        #
+#                                                                              #
+# The Configuration section holds the default settings. A configuration file   #
+# and the command line may change any of them, see server_config.py and        #
+# server.conf.example.                                                         #
 ################################################################################
 
-import sys, os, traceback, logging, logging.handlers
-from tcp_server import TcpServer, ClientHandlerFactory
-from services.file_join_service import FileJoinService
-from services.raise_error_service import RaiseErrorService
+import sys, os, signal, logging, logging.handlers
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tcp_server import TcpServer, ClientHandlerFactory, SocketOptions, ENGINE_SELECTORS
+from tcp_server import create_unix_server
+from asyncio_server import AsyncioTcpServer, ENGINE_ASYNCIO
+from prefork import PreforkServer
+from service_executor import EXECUTION_INLINE
+from service_registry import ServiceRegistry
+from response_cache import ResponseCache
+from metrics import Metrics, MetricsServer
+from profiling import RequestTracer, Profiler
+from timer_wheel import ConnectionTimeouts
+from log_pipeline import QueueLogHandler, RateLimitFilter
+from server_config import module_settings, load_settings
 
 ################################################################################
 # Constants                                                                    #
 ################################################################################
 
+# Types of the settings below that default to None, for checking the values
+# a configuration file or the command line gives them.
+DECLARED_SETTING_TYPES = {
+        'service_name': str,
+        'unix_path': str,
+        'socket_rcvbuf': int,
+        'socket_sndbuf': int,
+        'tcp_defer_accept': int,
+        'response_cache_ttl': float
+    }
+
 ################################################################################
 # Functions                                                                    #
 ################################################################################
 
-def init_logger(log_file_name, max_bytes, backup_count):
+def init_logger(log_file_name, max_bytes, backup_count, queue_size, rate_limit_count, rate_limit_interval):
     log_dir_path = os.path.dirname(log_file_name)
     if not os.path.exists(log_dir_path):
         os.makedirs(log_dir_path)
@@ -27,60 +56,334 @@ def init_logger(log_file_name, max_bytes, backup_count):
 
     stream_hander = logging.StreamHandler()
     stream_hander.setFormatter(formatter)
-    logger.addHandler(stream_hander)
     
     file_handler = logging.handlers.RotatingFileHandler(log_file_name, maxBytes=max_bytes, backupCount=backup_count)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    
+    # The console and the file are written by a listener thread, the threads
+    # that log only queue the records.
+    queue_handler = QueueLogHandler([stream_hander, file_handler], queue_size)
+    if rate_limit_count:
+        queue_handler.addFilter(RateLimitFilter(rate_limit_count, rate_limit_interval))
+    logger.addHandler(queue_handler)
+
+def create_socket_options():
+    return SocketOptions(tcp_nodelay, socket_rcvbuf, socket_sndbuf, tcp_defer_accept, reuse_addr,
+        tcp_keepalive, tcp_keepalive_idle, tcp_keepalive_interval, tcp_keepalive_count)
+
+def create_tcp_server(reuse_port, unix_server, profiler):
+    if engine == ENGINE_ASYNCIO:
+        return AsyncioTcpServer("svc-server", use_uvloop, reuse_port, backlog, unix_server, create_socket_options(),
+            profiler)
+    else:
+        return TcpServer("svc-server", engine, reuse_port, backlog, unix_server, create_socket_options(), accept_batch,
+            profiler)
+
+def handle_stop_signal(signum, frame):
+    sys.exit(0)
+
+def get_profile_signal():
+    # None when disabled or not available on this platform.
+    return getattr(signal, profile_signal, None) if profile_signal else None
+
+def create_service_registry(metrics):
+    services = ServiceRegistry(executor_max_workers, executor_max_in_flight, request_timeout, metrics)
+    
+    for name, (service_id, target) in service_table.items():
+        mode = service_execution_table.get(name, EXECUTION_INLINE)
+        services.register(name, target, service_id, mode, service_max_in_flight_table.get(name))
+    
+    services.set_default(service_name)
+    services.preload()
+    return services
+
+def create_handler_factory():
+    metrics = Metrics() if admin_port else None
+    services = create_service_registry(metrics)
+    
+    response_cache = None
+    if response_cache_max_bytes:
+        response_cache = ResponseCache(response_cache_max_bytes, response_cache_ttl, response_cache_max_body_length)
+        if metrics:
+            metrics.response_cache = response_cache
+    
+    timeouts = None
+    if any(timeout is not None for timeout in [idle_timeout, header_timeout, request_deadline]):
+        timeouts = ConnectionTimeouts(idle_timeout, header_timeout, body_min_rate, request_deadline, metrics=metrics)
+    
+    tracer = RequestTracer(slow_request_threshold, metrics) if trace_requests else None
+    
+    return ClientHandlerFactory(
+            services, max_in_flight_per_connection, ordered_responses,
+            max_body_length, tx_high_water, tx_low_water, memory_limit, response_cache, metrics,
+            compress_min_length, compress_level, timeouts, recv_bufsize, max_recv_size, tracer
+        )
+
+def run_tcp_server(reuse_port, worker_index=0, unix_server=None):
+    handler_factory = create_handler_factory()
+    
+    profiler = Profiler(profile_dir, profile_seconds, profile_mode)
+    if get_profile_signal():
+        signal.signal(get_profile_signal(), profiler.handle_signal)
+    
+    metrics_server = None
+    if handler_factory.metrics:
+        # Each worker process has its own metrics, on its own admin port.
+        metrics_server = MetricsServer(handler_factory.metrics, admin_port + worker_index,
+            profiler if profile_endpoint else None, admin_host)
+        metrics_server.start()
+    
+    try:
+        tcp_server = create_tcp_server(reuse_port, unix_server, profiler)
+        tcp_server.run(port, handler_factory)
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        profiler.close()
+        handler_factory.close()
+        
+        logger = logging.getLogger()
+        if handler_factory.response_cache:
+            logger.info('Response cache: %s', handler_factory.response_cache.stats())
+        if handler_factory.timeouts:
+            logger.info('Connections reclaimed: %s', dict(handler_factory.timeouts.reclaimed))
+        if handler_factory.tracer:
+            logger.info('Slow requests: %d', handler_factory.tracer.slow_count)
+
+def run_worker(worker_index):
+    init_logger(worker_log_file_name.format(worker_index), log_max_bytes, log_backup_count,
+        log_queue_size, log_rate_limit_count, log_rate_limit_interval)
+    logger = logging.getLogger()
+    logger.info('Worker %d started, pid = %d', worker_index, os.getpid())
+    
+    try:
+        run_tcp_server(True, worker_index, shared_unix_server)
+    finally:
+        logger.info('Worker %d stopped.', worker_index)
 
 def print_usage(script_name):
-    print(f'Usage: python {script_name} <service_name>')
+    print(f'Usage: python {script_name} [--config FILE] [options] <service_name>')
+    print('All services are hosted, <service_name> also answers service ID 0.')
+    print(f'Run python {script_name} --help for the options.')
     print('Available services:')
-    for key in service_table.keys():
-        print(f'        {key}')
+    for key, (service_id, target) in service_table.items():
+        print(f'        {key} (service ID {service_id})')
     
 ################################################################################
 # Configuration                                                                #
 ################################################################################
 
+# Service that also answers service ID 0. Usually given on the command line.
+service_name = None
+
 log_file_name = 'logs/server.log'
 log_max_bytes = 10 * 1014 * 1024 # 10 MB
 log_backup_count = 10
 
+# Each worker process writes its own log file.
+worker_log_file_name = 'logs/server-worker-{}.log'
+
+# Records waiting for the log writer thread. Records logged while the queue
+# is full are dropped and counted.
+log_queue_size = 10000
+
+# At most log_rate_limit_count records per log_rate_limit_interval seconds
+# from each logging call site, such as the per-connection messages. None
+# disables the limit.
+log_rate_limit_count = 20
+log_rate_limit_interval = 10.0
+
 sw_version = '1.0.0'
 
 port = 50000
 
+# Clients on this host may connect through a Unix domain socket at unix_path
+# as well, with TcpClient('unix:<path>', None). port = None listens on the
+# Unix domain socket only.
+unix_path = None
+
+# Connections the kernel queues on a listening socket before they are
+# accepted. Up to accept_batch of them are accepted per wakeup; the asyncio
+# engine accepts up to backlog.
+backlog = 1024
+accept_batch = 64
+
+# Socket options, None keeps the system default. With tcp_nodelay responses
+# are sent without waiting for the ACK of the previous segment.
+# socket_rcvbuf and socket_sndbuf are the kernel buffer sizes of each
+# connection in bytes. With tcp_defer_accept (Linux) a connection is only
+# accepted once it sent data, or after that many seconds. reuse_addr lets a
+# restarted server bind while connections of the previous one are in
+# TIME-WAIT. tcp_keepalive probes connections idle for tcp_keepalive_idle
+# seconds every tcp_keepalive_interval seconds and drops them after
+# tcp_keepalive_count unanswered probes. TCP options are not set on the Unix
+# domain socket.
+tcp_nodelay = True
+socket_rcvbuf = None
+socket_sndbuf = None
+tcp_defer_accept = None
+reuse_addr = True
+tcp_keepalive = False
+tcp_keepalive_idle = 60
+tcp_keepalive_interval = 10
+tcp_keepalive_count = 5
+
+# Receives take recv_bufsize bytes while a request header is awaited, the
+# rest of the frame once the header is parsed, and up to max_recv_size bytes
+# of a streamed body.
+recv_bufsize = 4096
+max_recv_size = 256 * 1024
+
+# ENGINE_SELECTORS uses epoll/kqueue where available and scales to many
+# thousands of connections. ENGINE_SELECT is limited to FD_SETSIZE sockets.
+# ENGINE_ASYNCIO runs the services on an asyncio loop (uvloop if installed
+# and use_uvloop is set).
+engine = ENGINE_SELECTORS
+use_uvloop = True
+
+# Number of pre-forked worker processes sharing the port with SO_REUSEPORT.
+# 0 runs the server in this process.
+worker_count = 0
+
+# Services hosted by the server: name -> (service ID, dotted path of the
+# service class). A request names its service by the service ID in header
+# bytes 14-15. A service is imported and created on its first request.
+# Requests with service ID 0 go to the service named on the command line.
 service_table = {
-        'file-join': FileJoinService(),
-        'raise-error': RaiseErrorService()
+        'file-join': (1, 'services.file_join_service.FileJoinService'),
+        'raise-error': (2, 'services.raise_error_service.RaiseErrorService'),
+        'async-delay': (3, 'services.async_delay_service.AsyncDelayService')
+    }
+
+# Where each service's process() runs: EXECUTION_INLINE on the event loop
+# thread, EXECUTION_THREAD or EXECUTION_PROCESS on a pool. Services with an
+# 'async def process' always run as coroutines on an asyncio loop. Services
+# run on a process pool are created at startup.
+service_execution_table = {
+        'file-join': EXECUTION_INLINE,
+        'raise-error': EXECUTION_INLINE
+    }
+
+# Each service run on a pool or asyncio loop has its own executor. At most
+# executor_max_in_flight requests of a service run at once, or the limit in
+# service_max_in_flight_table; further requests get a STATUS_BUSY response.
+executor_max_workers = 4
+executor_max_in_flight = 1024
+
+service_max_in_flight_table = {
+        'async-delay': 256
     }
+
+# Clients may pipeline requests. At most max_in_flight_per_connection requests
+# of a connection are processed at once. With ordered_responses = False a
+# response is sent as soon as it completes and clients match it by request ID.
+max_in_flight_per_connection = 64
+ordered_responses = True
+
+# Coroutine services that do not finish within this many seconds get a
+# STATUS_TIMEOUT response.
+request_timeout = 10.0
+
+# Requests with a body longer than max_body_length get a
+# STATUS_BODY_TOO_LARGE response and the connection is closed.
+max_body_length = 64 * 1024 * 1024
+
+# A connection stops reading while more than tx_high_water bytes of responses
+# wait to be sent, and resumes at tx_low_water.
+tx_high_water = 1024 * 1024
+tx_low_water = 256 * 1024
+
+# Bytes buffered by all connections together. Requests that do not fit get a
+# STATUS_BUSY response. None for no limit.
+memory_limit = 512 * 1024 * 1024
+
+# Results of services that declare 'cacheable = True' are cached by a hash of
+# the request body, for requests up to response_cache_max_body_length bytes.
+# response_cache_max_bytes = 0 disables the cache. response_cache_ttl is in
+# seconds, None for no expiry.
+response_cache_max_bytes = 64 * 1024 * 1024
+response_cache_ttl = None
+response_cache_max_body_length = 64 * 1024
+
+# Results of at least compress_min_length bytes are compressed for clients
+# that accept a compressed result. None disables compression. Compressed
+# request bodies are always accepted and may decode to at most
+# max_body_length bytes.
+compress_min_length = 1024
+compress_level = 1
+
+# Connections without traffic for idle_timeout seconds are closed, and so are
+# connections that take longer than header_timeout to send a request header
+# or send a request body slower than body_min_rate bytes per second. Requests
+# run by the executor that take longer than request_deadline get a
+# STATUS_TIMEOUT response. None disables a timeout.
+idle_timeout = 300.0
+header_timeout = 10.0
+body_min_rate = 1024
+request_deadline = 30.0
+
+# Metrics are served in the Prometheus text format at
+# http://<admin_host>:<admin_port>/metrics. Worker N of a pre-forked server
+# uses admin_port + N. None disables metrics. The admin port has no
+# authentication; admin_host = '' listens on all interfaces.
+admin_host = '127.0.0.1'
+admin_port = 50001
+
+# With trace_requests the time each request spends reading, parsing, in the
+# service and writing is recorded in the metrics, and requests that take
+# slow_request_threshold seconds or longer are logged with their phase
+# times. None disables the slow request log.
+trace_requests = True
+slow_request_threshold = 1.0
+
+# The event loop is profiled for profile_seconds on profile_signal, or with
+# profile_endpoint on POST
+# http://<admin_host>:<admin_port>/profile?seconds=N&mode=M, and the profile
+# is written to profile_dir. profile_mode is 'cprofile' (deterministic, for
+# pstats) or 'sample' (stack samples, for flame graphs, with less overhead).
+# The master of a pre-forked server forwards the signal to its workers.
+profile_dir = 'logs'
+profile_seconds = 30
+profile_mode = 'cprofile'
+profile_signal = 'SIGUSR1'
+profile_endpoint = False
     
 ################################################################################
 # Main                                                                         #
 ################################################################################
 
-script_name = os.path.basename(sys.argv[0])
-
-if len(sys.argv) != 2:
-    print_usage(script_name)
-    sys.exit(-1)
+# The configuration file and the command line replace the settings above.
+globals().update(load_settings(os.path.basename(sys.argv[0]), sys.argv[1:], module_settings(globals()),
+    DECLARED_SETTING_TYPES))
 
-service_name = sys.argv[1]
+script_name = os.path.basename(sys.argv[0])
 
 if service_name not in service_table:
     print_usage(script_name)
     sys.exit(-1)
     
 try:
-    init_logger(log_file_name, log_max_bytes, log_backup_count)
+    init_logger(log_file_name, log_max_bytes, log_backup_count,
+        log_queue_size, log_rate_limit_count, log_rate_limit_interval)
     logger = logging.getLogger()
-    logger.info(f'SW version: {sw_version}')
+    logger.info('SW version: %s', sw_version)
     
-    tcp_server = TcpServer("svc-server")
-    tcp_server.run(port, ClientHandlerFactory(service_table[service_name]))
+    if worker_count > 0:
+        # The workers share one Unix domain socket, created before they fork.
+        shared_unix_server = create_unix_server(unix_path, backlog, create_socket_options()) if unix_path else None
+        try:
+            forward_signals = [get_profile_signal()] if get_profile_signal() else []
+            prefork_server = PreforkServer("svc-server", worker_count, forward_signals)
+            prefork_server.run(run_worker)
+        finally:
+            if shared_unix_server:
+                shared_unix_server.close()
+                os.unlink(unix_path)
+    else:
+        signal.signal(signal.SIGTERM, handle_stop_signal)
+        run_tcp_server(False, 0, unix_path)
 except Exception as ex:
-    logger.error(traceback.format_exc())
+    logger.exception('Server failed.')
 finally:
     logger.info('Server stopped.')
     logging.shutdown()
@@ -0,0 +1,219 @@
+################################################################################
+# Service executor.                                                            #
+#                                                                              #
+# Runs service.process on a thread or process pool, or as a coroutine on an    #
+# asyncio loop, so that a slow request does not block the event loop.          #
+# Completions are handed back to the loop through a wakeup socketpair that     #
+# the executors of all services share.                                         #
+################################################################################
+
+import socket, collections, threading, inspect, logging, asyncio
+import concurrent.futures
+from tcp_server import call_service, call_async_service, STATUS_SERVICE_ERROR
+from log_pipeline import WorkerLogForwarder, init_worker_logging
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+EXECUTION_INLINE  = 'inline'
+EXECUTION_THREAD  = 'thread'
+EXECUTION_PROCESS = 'process'
+EXECUTION_ASYNC   = 'async'
+
+DEFAULT_MAX_IN_FLIGHT = 1024
+DEFAULT_REQUEST_TIMEOUT = 30.0
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+# The service of a process pool worker, set once by the pool initializer so
+# that it is not pickled with every request.
+process_service = None
+
+def init_process_service(service, log_queue, log_level):
+    global process_service
+    process_service = service
+    init_worker_logging(log_queue, log_level)
+
+def call_process_service(request):
+    return call_service(process_service, request)
+
+def is_async_service(service):
+    return inspect.iscoroutinefunction(service.process)
+
+def create_executor(service, mode, max_workers=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, 
+        request_timeout=DEFAULT_REQUEST_TIMEOUT, completions=None):
+    # Coroutine services always run on an asyncio loop.
+    if is_async_service(service):
+        mode = EXECUTION_ASYNC
+    
+    if mode == EXECUTION_INLINE:
+        return None
+    elif mode in (EXECUTION_THREAD, EXECUTION_PROCESS, EXECUTION_ASYNC):
+        return ServiceExecutor(service, mode, max_workers, max_in_flight, request_timeout, completions)
+    else:
+        raise ValueError(f'Unknown execution mode: {mode}')
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class CompletionQueue:
+    # Results completed on pool threads, handed to the event loop thread.
+    def __init__(self):
+        # Completed (executor, handler, response, future) tuples. deque
+        # append and popleft are thread safe.
+        self.completed = collections.deque()
+        
+        self.wakeup_socket, self.notify_socket = socket.socketpair()
+        self.wakeup_socket.setblocking(0)
+        self.notify_socket.setblocking(0)
+    
+    def notify(self, executor, handler, response, future):
+        # Runs on a pool thread.
+        self.completed.append((executor, handler, response, future))
+        
+        try:
+            self.notify_socket.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The loop has not drained earlier wakeups yet, so it will run.
+            pass
+    
+    def wakeup_ready(self):
+        # Runs on the event loop thread. Returns the handlers that received
+        # results.
+        try:
+            while self.wakeup_socket.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        
+        handlers = set()
+        
+        while self.completed:
+            executor, handler, response, future = self.completed.popleft()
+            executor.task_done()
+            
+            status, result_data = executor.get_result(response, future)
+            handler.complete(response, status, result_data)
+            handlers.add(handler)
+        
+        return handlers
+    
+    def close(self):
+        self.wakeup_socket.close()
+        self.notify_socket.close()
+
+class ServiceExecutor:
+    def __init__(self, service, mode, max_workers=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, 
+            request_timeout=DEFAULT_REQUEST_TIMEOUT, completions=None):
+        self.logger = logging.getLogger()
+        self.service = service
+        self.mode = mode
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.completions = completions
+        self.in_flight = 0
+        
+        self.executor = None
+        self.loop = None
+        self.loop_thread = None
+        self.log_forwarder = None
+        
+        if mode == EXECUTION_ASYNC:
+            # The loop thread is started on first use, so engines that run
+            # on asyncio themselves never start it.
+            pass
+        elif mode == EXECUTION_PROCESS:
+            # The workers log through this process, whose handlers they
+            # cannot use.
+            self.log_forwarder = WorkerLogForwarder()
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=max_workers, 
+                    initializer=init_process_service, 
+                    initargs=(service, self.log_forwarder.queue, self.log_forwarder.level)
+                )
+            
+            # Start the worker processes now, before the listening socket
+            # exists, so that forked workers do not inherit it.
+            self.executor.submit(int).result()
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    
+    def try_submit(self, request):
+        # Returns a concurrent.futures.Future of (status, result_data), or
+        # None when max_in_flight requests are already running. The caller
+        # must call task_done once the future has been handled.
+        if self.in_flight >= self.max_in_flight:
+            return None
+        
+        if self.mode == EXECUTION_ASYNC:
+            if not self.loop:
+                self.start_loop()
+            future = asyncio.run_coroutine_threadsafe(self.call_async(request), self.loop)
+        elif self.mode == EXECUTION_PROCESS:
+            future = self.executor.submit(call_process_service, request)
+        else:
+            future = self.executor.submit(call_service, self.service, request)
+        
+        self.in_flight += 1
+        return future
+    
+    def try_create_task(self, request):
+        # Same as try_submit for EXECUTION_ASYNC, for callers that already run
+        # on an asyncio loop. Returns an asyncio.Task.
+        if self.in_flight >= self.max_in_flight:
+            return None
+        
+        self.in_flight += 1
+        return asyncio.ensure_future(self.call_async(request))
+    
+    def call_async(self, request):
+        return call_async_service(self.service, request, self.request_timeout)
+    
+    def start_loop(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='service-loop', daemon=True)
+        self.loop_thread.start()
+    
+    def task_done(self):
+        self.in_flight -= 1
+        
+    def submit(self, request, handler, response):
+        future = self.try_submit(request)
+        if not future:
+            return None
+        
+        future.add_done_callback(lambda future: self.notify(handler, response, future))
+        return future
+    
+    def wait(self, future, handler, response):
+        # Hands the result of an already submitted future to another handler.
+        self.add_waiter()
+        future.add_done_callback(lambda future: self.notify(handler, response, future))
+    
+    def add_waiter(self):
+        # A request that waits for the future of an identical request counts
+        # as in flight until its result is handled, like the request itself.
+        self.in_flight += 1
+    
+    def notify(self, handler, response, future):
+        self.completions.notify(self, handler, response, future)
+    
+    def get_result(self, response, future):
+        try:
+            return future.result()
+        except Exception as ex:
+            # The pool itself failed, e.g. a worker process died.
+            self.logger.error('[request(%d)] Executor failed: %r', response.request_id, ex)
+            return STATUS_SERVICE_ERROR, repr(ex).encode('utf-8')
+    
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.log_forwarder:
+            self.log_forwarder.close()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,139 @@
+################################################################################
+# Service registry.                                                            #
+#                                                                              #
+# One server hosts any number of services. A request names its service by      #
+# the service ID in header bytes 14-15; ID 0 is the default service. A         #
+# service is registered by dotted path and only imported and created, with     #
+# its executor, on the first request for it.                                   #
+################################################################################
+
+import time, inspect, importlib, logging
+from service_executor import create_executor, CompletionQueue, EXECUTION_INLINE, EXECUTION_PROCESS
+from service_executor import DEFAULT_MAX_IN_FLIGHT, DEFAULT_REQUEST_TIMEOUT
+from response_cache import is_cacheable_service
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+DEFAULT_SERVICE_ID = 0
+
+# Service IDs are 16 bits.
+MAX_SERVICE_ID = 0xffff
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def load_service(target):
+    # The target is a class, an instance, or the path of either as
+    # 'package.module.Name' or 'package.module:Name', the syntax of entry
+    # points. Classes are called without arguments.
+    if isinstance(target, str):
+        if ':' in target:
+            module_name, attribute = target.split(':', 1)
+        else:
+            module_name, attribute = target.rsplit('.', 1)
+        
+        target = importlib.import_module(module_name)
+        for name in attribute.split('.'):
+            target = getattr(target, name)
+    
+    if inspect.isclass(target):
+        return target()
+    return target
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class HostedService:
+    # A registered service. service is None until it is loaded.
+    def __init__(self, name, service_id, target, mode, max_in_flight):
+        self.name = name
+        self.service_id = service_id
+        self.target = target
+        self.mode = mode
+        self.max_in_flight = max_in_flight
+        
+        self.service = None
+        self.executor = None
+        self.metrics = None
+        self.cacheable = False
+        # Inline services that implement create_stream() are streamed.
+        self.streaming = False
+
+class ServiceRegistry:
+    # The executor settings apply to every service; max_in_flight, the
+    # number of requests of one service run at once, may be set per service.
+    # Its executor is the service's own, so a slow service cannot take the
+    # capacity of the others. Inline services run one request at a time.
+    def __init__(self, max_workers=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            request_timeout=DEFAULT_REQUEST_TIMEOUT, metrics=None):
+        self.logger = logging.getLogger()
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.metrics = metrics
+        
+        # service ID -> HostedService. The default service is also found
+        # under DEFAULT_SERVICE_ID.
+        self.services = {}
+        self.names = {}
+        
+        # Shared by the executors of all services.
+        self.completions = CompletionQueue()
+    
+    def register(self, name, target, service_id=DEFAULT_SERVICE_ID, mode=EXECUTION_INLINE, max_in_flight=None):
+        if not 0 <= service_id <= MAX_SERVICE_ID:
+            raise ValueError(f'Service ID out of range: {service_id}')
+        if service_id in self.services or name in self.names:
+            raise ValueError(f'Service already registered: {name} ({service_id})')
+        
+        hosted = HostedService(name, service_id, target, mode, max_in_flight or self.max_in_flight)
+        self.services[service_id] = hosted
+        self.names[name] = hosted
+        return hosted
+    
+    def set_default(self, name):
+        self.services[DEFAULT_SERVICE_ID] = self.names[name]
+    
+    def get(self, service_id):
+        # Returns the loaded HostedService, or None when the ID is not
+        # registered. Raises the error of a service that fails to load; it
+        # is loaded again on its next request.
+        hosted = self.services.get(service_id)
+        if hosted is not None and hosted.service is None:
+            self.load(hosted)
+        return hosted
+    
+    def preload(self):
+        # Process pools fork their workers, which must happen before the
+        # listening socket exists, so that they do not inherit it.
+        for hosted in self.names.values():
+            if hosted.service is None and hosted.mode == EXECUTION_PROCESS:
+                self.load(hosted)
+    
+    def load(self, hosted):
+        started = time.perf_counter()
+        
+        service = load_service(hosted.target)
+        executor = create_executor(service, hosted.mode, self.max_workers, hosted.max_in_flight,
+            self.request_timeout, self.completions)
+        
+        hosted.executor = executor
+        hosted.cacheable = is_cacheable_service(service)
+        hosted.streaming = executor is None and hasattr(service, 'create_stream')
+        hosted.metrics = self.metrics.service(hosted.name) if self.metrics else None
+        hosted.service = service
+        
+        self.logger.info('Service %s (ID %d) loaded in %.3f s', hosted.name, hosted.service_id, time.perf_counter() - started)
+    
+    def loaded(self):
+        return [hosted for hosted in self.names.values() if hosted.service is not None]
+    
+    def close(self):
+        for hosted in self.loaded():
+            if hosted.executor:
+                hosted.executor.shutdown()
+        self.completions.close()
@@ -0,0 +1,36 @@
+################################################################################
+# Coroutine service that responds after a delay                                #
+################################################################################
+
+import asyncio, logging
+from common.service_bodies import ASYNC_DELAY_REQUEST
+
+################################################################################
+# Functions                                                                    #
+################################################################################
+
+def parse_request_body(request):
+    delay_ms, echo_data = ASYNC_DELAY_REQUEST.decode(request.body_data)
+    
+    # The body is not kept beyond the request.
+    return delay_ms, bytes(echo_data)
+        
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class AsyncDelayService:
+    # Stands in for a service that waits on a backend call. The request body
+    # is a 4 byte delay in milliseconds followed by data that is echoed back.
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.service_counter = 0
+    
+    async def process(self, request):
+        self.service_counter += 1
+        
+        delay_ms, echo_data = parse_request_body(request)
+        
+        await asyncio.sleep(delay_ms / 1000)
+        
+        return echo_data
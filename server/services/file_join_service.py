@@ -2,34 +2,21 @@
 # Service implementations                                                      #
 ################################################################################
 
-import sys, traceback, logging
-
-################################################################################
-# Constants                                                                    #
-################################################################################
+import codecs, logging
+from common.protocol import STATUS_OK
+from common.service_bodies import FILE_JOIN_REQUEST, SEPARATOR, SEPARATOR_DATA
 
 ################################################################################
 # Functions                                                                    #
 ################################################################################
 
 def parse_request_body(request):
-    file_a_length = int.from_bytes(request.body_data[0:4], byteorder='little')
-    file_b_length = int.from_bytes(request.body_data[4:8], byteorder='little')
-    
-    start = 8
-    end = start + file_a_length
-    file_a_data_arr = request.body_data[start:end]
-    file_a_text = file_a_data_arr.decode('utf-8')
+    file_a_data, file_b_data = FILE_JOIN_REQUEST.decode(request.body_data)
     
-    start = end
-    end = start + file_b_length
-    file_b_data_arr = request.body_data[start:end]
-    file_b_text = file_b_data_arr.decode('utf-8')
-    
-    return file_a_text, file_b_text
+    return str(file_a_data, 'utf-8'), str(file_b_data, 'utf-8')
 
 def build_response_body(text_list):
-    result = '^.^'.join(text_list)
+    result = SEPARATOR.join(text_list)
     result_data = result.encode('utf-8')
        
     return result_data
@@ -39,6 +26,9 @@ def build_response_body(text_list):
 ################################################################################
 
 class FileJoinService:
+    # The result depends only on the request body.
+    cacheable = True
+    
     def __init__(self):
         self.logger = logging.getLogger()
         self.service_counter = 0
@@ -51,8 +41,7 @@ class FileJoinService:
         try:
             result_data = self.process_request_message(request, self.service_counter)
         except Exception as ex:
-            self.logger.error(f'[request({request.request_id})] Exception occurred.')
-            self.logger.error(traceback.format_exc())
+            self.logger.exception('[request(%d)] Exception occurred.', request.request_id)
             
             text_list = []
             result_data = build_response_body(text_list)
@@ -65,3 +54,106 @@ class FileJoinService:
         body_data = build_response_body(text_list)
         
         return body_data
+    
+    def process_batch(self, requests):
+        # Same results as process for each request, without the per-request
+        # call chain.
+        self.service_counter += len(requests)
+        
+        results = []
+        for request in requests:
+            try:
+                results.append(build_response_body(parse_request_body(request)))
+            except Exception as ex:
+                self.logger.exception('[request(%d)] Exception occurred.', request.request_id)
+                results.append(build_response_body([]))
+        
+        return results
+    
+    def create_stream(self):
+        self.service_counter += 1
+        
+        return FileJoinStream()
+
+class FileJoinStream:
+    # Streams file_a, the separator and file_b from the request body straight
+    # to the response, so neither the body nor the result is ever held in
+    # memory as a whole. Joining the UTF-8 bytes gives the same result as
+    # joining the decoded text.
+    #
+    # The request is validated like process(): the lengths of file_a and
+    # file_b are checked against the body before anything is sent, and each
+    # file is decoded as it streams past. A request that process() would
+    # answer with an empty result is answered with one here as well; once
+    # part of the result is sent, the server replaces it (see protocol.py).
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.request_id = None
+        self.body_length = 0
+        self.response_length = None
+        self.result = None
+        self.length_data = bytearray()
+        self.file_a_remaining = 0
+        self.file_b_remaining = 0
+        self.separator_sent = False
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+    
+    def on_header(self, request):
+        self.request_id = request.request_id
+        self.body_length = request.body_length
+        return []
+    
+    def on_chunk(self, chunk):
+        output = []
+        
+        try:
+            if self.response_length is None:
+                head = FILE_JOIN_REQUEST.head
+                needed = head.size - len(self.length_data)
+                self.length_data += chunk[:needed]
+                chunk = chunk[needed:]
+                
+                if len(self.length_data) < head.size:
+                    return output
+                
+                file_a_length, file_b_length = head.unpack_from(self.length_data)
+                if head.size + file_a_length + file_b_length > self.body_length:
+                    raise ValueError(f'Body fields of {file_a_length} and {file_b_length} bytes exceed the body of '
+                        f'{self.body_length} bytes')
+                
+                self.file_a_remaining = file_a_length
+                self.file_b_remaining = file_b_length
+                self.response_length = file_a_length + len(SEPARATOR_DATA) + file_b_length
+            
+            if self.file_a_remaining > 0:
+                part = chunk[:self.file_a_remaining]
+                chunk = chunk[len(part):]
+                self.file_a_remaining -= len(part)
+                self.decoder.decode(part, self.file_a_remaining == 0)
+                output.append(part)
+            
+            if self.file_a_remaining == 0 and not self.separator_sent:
+                # file_b is decoded on its own, like in process().
+                self.decoder.reset()
+                output.append(SEPARATOR_DATA)
+                self.separator_sent = True
+            
+            if self.file_b_remaining > 0:
+                part = chunk[:self.file_b_remaining]
+                self.file_b_remaining -= len(part)
+                self.decoder.decode(part, self.file_b_remaining == 0)
+                output.append(part)
+        except Exception as ex:
+            self.logger.exception('[request(%d)] Exception occurred.', self.request_id)
+            self.result = (STATUS_OK, build_response_body([]))
+            return []
+        
+        return output
+    
+    def on_end(self):
+        if self.response_length is None:
+            self.logger.error('[request(%d)] Short body: %d bytes, expected at least %d.', self.request_id,
+                len(self.length_data), FILE_JOIN_REQUEST.head.size)
+            self.result = (STATUS_OK, build_response_body([]))
+        
+        return []
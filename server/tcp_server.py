@@ -2,13 +2,25 @@
 # TCP socket server.                                                           #
 #                                                                              #
 # Features:                                                                    #
-#   1. Using select.                                                           #
+#   1. Using select or selectors (epoll/kqueue) as the event loop engine.      #
 #   2. Single threaded.                                                        #
 #   3. Event driven.                                                           #
+#   4. Listens on a TCP port, a Unix domain socket, or both.                   #
+#   5. Tunable socket options, batched accept and receive sizes that follow    #
+#      the length of the body.                                                 #
+#   6. Optional request tracing and on-demand profiling, see profiling.py.     #
 ################################################################################
 
-import sys, traceback, logging
-import select, socket, queue
+import os, stat, errno, time, traceback, logging, asyncio
+import select, selectors, socket, collections, itertools
+from common.protocol import MESSAGE_HEADER_LENGTH, FLAG_BATCH, FLAG_STREAM, ENCODING_MASK
+from common.protocol import STATUS_OK, STATUS_SERVICE_ERROR, STATUS_BUSY, STATUS_TIMEOUT, STATUS_BODY_TOO_LARGE
+from common.protocol import STATUS_BAD_ENCODING, STATUS_BAD_REQUEST, STATUS_UNKNOWN_SERVICE, STATUS_STREAMED
+from common.protocol import STREAM_TRAILER, TRAILER_REPLACE, parse_batch_body, build_batch_result
+from common.protocol import unpack_request_header, build_response_header, build_response_message
+from common.body_encoding import ENCODING_IDENTITY, DEFAULT_COMPRESS_MIN_LENGTH, DEFAULT_COMPRESS_LEVEL
+from common.body_encoding import BodyEncodingError, choose_encoding, encode_body, decode_body
+from timer_wheel import REASON_IDLE, REASON_HEADER_TIMEOUT, REASON_SLOW_BODY
 
 ################################################################################
 # Constants                                                                    #
@@ -16,196 +28,1711 @@ import select, socket, queue
 
 RECV_BUFSIZE = 4096
 
-REQUEST_MAGIC_NUMBER  = b'TRRQ'
-RESPONSE_MAGIC_NUMBER = b'TRRS'
-MESSAGE_HEADER_LENGTH = 16
+# The rest of a streamed request body is received in chunks of up to this
+# many bytes. Bodies that are not streamed are received into a buffer sized
+# for their frame.
+DEFAULT_MAX_RECV_SIZE = 256 * 1024
 
-STATUS_OK = 0
-STATUS_SERVICE_ERROR = 1
+ENGINE_SELECT    = 'select'
+ENGINE_SELECTORS = 'selectors'
+
+SELECT_TIMEOUT = 1
+
+# Connections the kernel completes and queues before they are accepted. A
+# short queue drops the SYNs of a connect storm and the clients retry after
+# a second or more. The kernel caps it at net.core.somaxconn.
+DEFAULT_BACKLOG = socket.SOMAXCONN
+
+# Connections accepted per wakeup of a listening socket.
+DEFAULT_ACCEPT_BATCH = 64
+
+INET_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+# Maximum number of requests of one connection that are being processed or
+# waiting to be sent. Further frames stay in the receive buffer and reading
+# from the connection pauses until responses complete.
+DEFAULT_MAX_IN_FLIGHT_PER_CONNECTION = 64
+
+# Requests with a larger body get STATUS_BODY_TOO_LARGE and the connection
+# is closed.
+DEFAULT_MAX_BODY_LENGTH = 64 * 1024 * 1024
+
+# Reading from a connection stops while more than the high water mark of
+# responses is waiting to be sent, and resumes below the low water mark.
+DEFAULT_TX_HIGH_WATER = 1024 * 1024
+DEFAULT_TX_LOW_WATER = 256 * 1024
+
+# Receive buffers are pooled in size classes of the receive size
+# (RECV_BUFSIZE by default) times a power of two up to
+# MAX_POOLED_BUFFER_SIZE. Larger buffers are allocated for their frame and
+# freed.
+MAX_POOLED_BUFFER_SIZE = 1024 * 1024
+
+# Bytes of free buffers the pool keeps in each size class.
+DEFAULT_POOL_FREE_BYTES = 4 * 1024 * 1024
+
+# A streamed result replaced after its header was sent is padded with
+# slices of this block.
+STREAM_PADDING = bytes(64 * 1024)
+
+# What a connection is receiving, see FrameReader.partial_frame.
+PARTIAL_HEADER = 'header'
+PARTIAL_BODY   = 'body'
+
+# Maximum number of buffers passed to one sendmsg call.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
 
 ################################################################################
 # Functions                                                                    #
 ################################################################################
 
+def parse_batch_requests(request):
+    # Returns the items of a batch request as requests with the same request
+    # ID, their bodies as views into the batch body.
+    requests = []
+    for body_data in parse_batch_body(request.body_data):
+        item = RequestMessage(request.request_id, len(body_data))
+        item.body_data = body_data
+        requests.append(item)
+    
+    return requests
+
+def call_batch_service(service, request):
+    # Services may implement process_batch(requests), which returns one
+    # result per request, or an exception instance for a failed item.
+    # Otherwise process is called for each item.
+    try:
+        requests = parse_batch_requests(request)
+    except ValueError as ex:
+        return STATUS_BAD_REQUEST, str(ex).encode('utf-8')
+    
+    if not hasattr(service, 'process_batch'):
+        return STATUS_OK, build_batch_result([call_service(service, item) for item in requests])
+    
+    try:
+        results = service.process_batch(requests)
+        if len(results) != len(requests):
+            raise ValueError(f'process_batch returned {len(results)} results for {len(requests)} requests')
+    except Exception as ex:
+        error_data = traceback.format_exc().encode('utf-8')
+        return STATUS_OK, build_batch_result([(STATUS_SERVICE_ERROR, error_data)] * len(requests))
+    
+    return STATUS_OK, build_batch_result([batch_item_result(result_data) for result_data in results])
+
+def batch_item_result(result_data):
+    if isinstance(result_data, Exception):
+        error_text = ''.join(traceback.format_exception(type(result_data), result_data, result_data.__traceback__))
+        return STATUS_SERVICE_ERROR, error_text.encode('utf-8')
+    
+    return STATUS_OK, result_data
+
+def call_service(service, request):
+    if request.batch:
+        return call_batch_service(service, request)
+    
+    status = STATUS_OK
+    result_data = None
+    
+    try:
+        result_data = service.process(request)
+    except Exception as ex:
+        status = STATUS_SERVICE_ERROR
+        result_data = traceback.format_exc().encode('utf-8')
+    
+    if isinstance(result_data, memoryview):
+        # Do not keep a view into the receive buffer.
+        result_data = bytes(result_data)
+    
+    return status, result_data
+
+async def call_async_batch_service(service, request, timeout):
+    try:
+        requests = parse_batch_requests(request)
+    except ValueError as ex:
+        return STATUS_BAD_REQUEST, str(ex).encode('utf-8')
+    
+    if not hasattr(service, 'process_batch'):
+        # The items run concurrently, each with its own timeout.
+        results = await asyncio.gather(*[call_async_service(service, item, timeout) for item in requests])
+        return STATUS_OK, build_batch_result(results)
+    
+    try:
+        results = await asyncio.wait_for(service.process_batch(requests), timeout)
+        if len(results) != len(requests):
+            raise ValueError(f'process_batch returned {len(results)} results for {len(requests)} requests')
+    except asyncio.TimeoutError:
+        return STATUS_OK, build_batch_result([(STATUS_TIMEOUT, b'')] * len(requests))
+    except Exception as ex:
+        error_data = traceback.format_exc().encode('utf-8')
+        return STATUS_OK, build_batch_result([(STATUS_SERVICE_ERROR, error_data)] * len(requests))
+    
+    return STATUS_OK, build_batch_result([batch_item_result(result_data) for result_data in results])
+
+async def call_async_service(service, request, timeout):
+    if request.batch:
+        return await call_async_batch_service(service, request, timeout)
+    
+    status = STATUS_OK
+    result_data = None
+    
+    try:
+        result_data = await asyncio.wait_for(service.process(request), timeout)
+    except asyncio.TimeoutError:
+        status = STATUS_TIMEOUT
+        result_data = b''
+    except Exception as ex:
+        status = STATUS_SERVICE_ERROR
+        result_data = traceback.format_exc().encode('utf-8')
+    
+    return status, result_data
+
+def create_inet_server(host, port, backlog=DEFAULT_BACKLOG, reuse_port=False, socket_options=None):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        # Lets several worker processes listen on the same port.
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if socket_options:
+        socket_options.apply_listener(server)
+    server.setblocking(0)
+    server.bind((host, port))
+    server.listen(backlog)
+    
+    return server
+
+def create_unix_server(path, backlog=DEFAULT_BACKLOG, socket_options=None):
+    # A socket file left behind by a server that did not shut down is
+    # replaced. One that a running server still accepts on is not.
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise OSError(errno.EEXIST, f'Not a socket: {path}')
+        
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            else:
+                raise OSError(errno.EADDRINUSE, f'Socket in use: {path}')
+    
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if socket_options:
+        socket_options.apply_listener(server)
+    server.setblocking(0)
+    server.bind(path)
+    server.listen(backlog)
+    
+    return server
+
+def connection_address(connection):
+    # The peer address for the logs. Clients of a Unix domain socket are
+    # usually unnamed, so they are told apart by their descriptor.
+    address = connection.getpeername()
+    if connection.family in INET_FAMILIES:
+        return address
+    return f'{address or connection.getsockname()}#{connection.fileno()}'
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class SocketOptions:
+    # Options of the listening sockets and of the connections accepted on
+    # them; None keeps the system default. The buffer sizes are set on the
+    # listening socket, so that connections inherit them and their TCP window
+    # scale is chosen for them. defer_accept, in seconds, wakes the server
+    # only once a new connection has sent data. keepalive_idle is the idle
+    # time in seconds before the first probe. TCP options are not set on Unix
+    # domain sockets, and options the platform lacks are skipped.
+    def __init__(self, no_delay=True, rcvbuf=None, sndbuf=None, defer_accept=None, reuse_addr=True,
+            keepalive=False, keepalive_idle=None, keepalive_interval=None, keepalive_count=None):
+        self.no_delay = no_delay
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.defer_accept = defer_accept
+        self.reuse_addr = reuse_addr
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+    
+    def apply_listener(self, server):
+        # Called before the socket is bound.
+        if self.rcvbuf:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        
+        if server.family not in INET_FAMILIES:
+            return
+        
+        if self.reuse_addr and os.name == 'posix':
+            # Lets a restarted server bind while connections of the previous
+            # one are in TIME-WAIT. On Windows it would let two servers bind
+            # the same port.
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.defer_accept and hasattr(socket, 'TCP_DEFER_ACCEPT'):
+            server.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, self.defer_accept)
+    
+    def apply_connection(self, connection):
+        if connection.family not in INET_FAMILIES:
+            return
+        
+        if self.no_delay:
+            # Small responses and the tail of large ones are sent without
+            # waiting for the ACK of the previous segment.
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
+        if self.keepalive:
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for name, value in [('TCP_KEEPIDLE', self.keepalive_idle), ('TCP_KEEPINTVL', self.keepalive_interval),
+                    ('TCP_KEEPCNT', self.keepalive_count)]:
+                if value is not None and hasattr(socket, name):
+                    connection.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
 class TcpServer:
-    def __init__(self, name):
+    # unix_path is a Unix domain socket to listen on besides the TCP port,
+    # or instead of it when run() gets no port. It may also be a listening
+    # socket created with create_unix_server, which pre-forked workers share
+    # because SO_REUSEPORT does not balance Unix domain sockets.
+    #
+    # Up to accept_batch queued connections are accepted per wakeup of a
+    # listening socket, and socket_options are applied to the listening
+    # sockets and the accepted connections.
+    #
+    # The event loop starts and stops the profiles requested from a
+    # profiling.Profiler.
+    def __init__(self, name, engine=ENGINE_SELECTORS, reuse_port=False, backlog=DEFAULT_BACKLOG, unix_path=None,
+            socket_options=None, accept_batch=DEFAULT_ACCEPT_BATCH, profiler=None):
         self.logger = logging.getLogger()
         self.name = name
+        self.engine = engine
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.unix_path = unix_path
+        self.socket_options = socket_options or SocketOptions()
+        self.accept_batch = accept_batch
+        self.profiler = profiler
 
+    def create_servers(self, port):
+        servers = []
+        if port is not None:
+            servers.append(self.create_server('', port))
+        if isinstance(self.unix_path, str):
+            servers.append(create_unix_server(self.unix_path, self.backlog, self.socket_options))
+        elif self.unix_path is not None:
+            servers.append(self.unix_path)
+        
+        if not servers:
+            raise ValueError('No port or Unix domain socket to listen on')
+        return servers
+    
+    def close_servers(self, servers):
+        for server in servers:
+            server.close()
+        
+        # The socket file is removed by the server that created it.
+        if isinstance(self.unix_path, str):
+            os.unlink(self.unix_path)
+    
     def create_server(self, host, port):
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setblocking(0)
-        server.bind((host, port))
-        server.listen(5)
+        return create_inet_server(host, port, self.backlog, self.reuse_port, self.socket_options)
+    
+    def accept_connections(self, server, tracer=None):
+        # The connections queued on a listening socket, up to accept_batch,
+        # so that a connect storm costs one wakeup per batch.
+        started = time.perf_counter() if tracer else None
+        connections = []
+        while len(connections) < self.accept_batch:
+            try:
+                connection, address = server.accept()
+            except (BlockingIOError, InterruptedError):
+                # None left, or taken by another worker sharing the socket.
+                break
+            except ConnectionAbortedError:
+                continue
+            
+            connection.setblocking(0)
+            self.socket_options.apply_connection(connection)
+            connections.append(connection)
         
-        return server        
+        if tracer and connections:
+            tracer.observe_accept(time.perf_counter() - started, len(connections))
+        return connections
         
+    def select_timeout(self, timeouts):
+        # Wakes up in time for the next tick of the timer wheel.
+        if not timeouts:
+            return SELECT_TIMEOUT
+        return min(SELECT_TIMEOUT, max(timeouts.wheel.next_time - time.monotonic(), 0))
+    
     def run(self, port, handler_factory):
+        if self.engine == ENGINE_SELECT:
+            self.run_select(port, handler_factory)
+        elif self.engine == ENGINE_SELECTORS:
+            self.run_selectors(port, handler_factory)
+        else:
+            raise ValueError(f'Unknown engine: {self.engine}')
+        
+    def run_select(self, port, handler_factory):
         rlist = []
         wlist = []
         client_handlers = {}
         
-        server = self.create_server('', port)
-        rlist.append(server)
-        self.logger.info(f'Listening on {server.getsockname()}')
+        servers = self.create_servers(port)
+        rlist.extend(servers)
+        for server in servers:
+            self.logger.info('Listening on %s (engine = %s)', server.getsockname(), ENGINE_SELECT)
+        
+        completions = handler_factory.completions
+        rlist.append(completions.wakeup_socket)
         
+        metrics = handler_factory.metrics
+        timeouts = handler_factory.timeouts
+        tracer = handler_factory.tracer
+        profiler = self.profiler
         shutdownFlag = False
         
-        while rlist:
-            readable, writable, exceptional = select.select(rlist, wlist, rlist, 1)
-            
-            # readable
-            for s in readable:
-                if s is server:
-                    connection, address = s.accept()
-                    self.logger.info(f'new client {address}')
-                    connection.setblocking(0)
-                    rlist.append(connection)
-                    client_handlers[connection] = handler_factory.create(connection)
-                else:
-                    count = client_handlers[s].read_ready()
-                    if count == 0:
-                        self.logger.info(f'close eof client {client_handlers[s].address}')
-                        del client_handlers[s]
-                        rlist.remove(s)
-                        s.close()
+        try:
+            while rlist:
+                readers = [s for s in rlist if s not in client_handlers or client_handlers[s].wants_read()]
+                readable, writable, exceptional = select.select(readers, wlist, rlist, self.select_timeout(timeouts))
+                started = time.perf_counter()
+                
+                # readable
+                for s in readable:
+                    if s in servers:
+                        for connection in self.accept_connections(s, tracer):
+                            rlist.append(connection)
+                            client_handlers[connection] = handler_factory.create(connection)
+                            self.logger.info('new client %s', client_handlers[connection].address)
+                    elif s is completions.wakeup_socket:
+                        for client_handler in completions.wakeup_ready():
+                            if client_handler.broken and not client_handler.closed:
+                                self.logger.info('close broken client %s', client_handler.address)
+                                client_handler.write_ready()
+                                self.close_select(client_handler.connection, rlist, client_handlers)
+                    else:
+                        count = client_handlers[s].read_ready()
+                        if count == 0:
+                            self.logger.info('close eof client %s', client_handlers[s].address)
+                            self.close_select(s, rlist, client_handlers)
+                            
+                            if s in writable:
+                                writable.remove(s)
+                            if s in exceptional:
+                                exceptional.remove(s)
+                        elif count < 0:
+                            shutdownFlag = True
+
+                # writable
+                for s in writable:
+                    if not client_handlers[s].write_ready():
+                        self.logger.info('close failed client %s', client_handlers[s].address)
+                        self.close_select(s, rlist, client_handlers)
                         
-                        if s in writable:
-                            writable.remove(s)
                         if s in exceptional:
                             exceptional.remove(s)
-                    elif count < 0:
-                        shutdownFlag = True
+                
+                # exceptional
+                for s in exceptional:
+                    self.logger.info('close exceptional client %s', client_handlers[s].address)
+                    self.close_select(s, rlist, client_handlers)
+                
+                # timers
+                if timeouts:
+                    for client_handler, reason in timeouts.expire(time.monotonic()):
+                        if reason:
+                            self.logger.info('close %s client %s', reason, client_handler.address)
+                            self.close_select(client_handler.connection, rlist, client_handlers)
+                
+                # build wlist
+                wlist.clear()
+                for connection, client_handler in client_handlers.items():
+                    if client_handler.has_pending_tx():
+                        wlist.append(connection)
+                
+                #print(f'** len(rlist) = {len(rlist):4}, len(wlist) = {len(wlist):4} **')
+                
+                if metrics and (readable or writable or exceptional):
+                    metrics.observe_loop_iteration(time.perf_counter() - started)
+                
+                if profiler:
+                    profiler.poll()
+                
+                if len(wlist) == 0 and shutdownFlag:
+                    break
+        finally:
+            # Close all sockets
+            for s in rlist:
+                if s in client_handlers:
+                    client_handlers[s].close()
+            self.close_servers(servers)
+    
+    def close_select(self, s, rlist, client_handlers):
+        client_handlers.pop(s).close()
+        rlist.remove(s)
 
-            # writable
-            for s in writable:
-                client_handlers[s].write_ready()
-            
-            # exceptional
-            for s in exceptional:
-                self.logger.info(f'close exceptional client {client_handlers[s].address}')
-                del client_handlers[s]
-                rlist.remove(s)
-                s.close()
-            
-            # build wlist
-            wlist.clear()
-            for connection, client_handler in client_handlers.items():
-                if not client_handler.tx_queue.empty():
-                    wlist.append(connection)
-            
-            #print(f'** len(rlist) = {len(rlist):4}, len(wlist) = {len(wlist):4} **')
-            
-            if len(wlist) == 0 and shutdownFlag:
-                break
+    def run_selectors(self, port, handler_factory):
+        # Interest is registered once per socket and only modified when a
+        # handler's tx state changes, so a wakeup costs O(ready sockets)
+        # instead of O(all sockets) and there is no FD_SETSIZE limit.
+        # Responses are sent as soon as they are ready; EVENT_WRITE is only
+        # registered for what the socket did not take.
+        sel = selectors.DefaultSelector()
         
-        # Close all sockets
-        for s in rlist:
-            s.close()
+        servers = self.create_servers(port)
+        for server in servers:
+            sel.register(server, selectors.EVENT_READ)
+            self.logger.info('Listening on %s (engine = %s, selector = %s)', server.getsockname(), ENGINE_SELECTORS, type(sel).__name__)
+        
+        completions = handler_factory.completions
+        sel.register(completions.wakeup_socket, selectors.EVENT_READ, completions)
+        
+        writers = set()
+        # Connections with neither read nor write interest are unregistered
+        # until a completed response gives them something to do.
+        paused = {}
+        metrics = handler_factory.metrics
+        timeouts = handler_factory.timeouts
+        profiler = self.profiler
+        shutdownFlag = False
+        
+        try:
+            while True:
+                ready = sel.select(self.select_timeout(timeouts))
+                started = time.perf_counter()
+                
+                for key, events in ready:
+                    s = key.fileobj
+                    
+                    if s in servers:
+                        self.accept_selectors(sel, s, handler_factory)
+                        continue
+                    
+                    if key.data is completions:
+                        # Responses completed by the executors may have made
+                        # other connections writable.
+                        for client_handler in completions.wakeup_ready():
+                            if client_handler.closed:
+                                continue
+                            
+                            if client_handler.broken:
+                                self.logger.info('close broken client %s', client_handler.address)
+                                client_handler.write_ready()
+                                self.close_selectors(sel, client_handler, writers, paused)
+                            elif client_handler.has_pending_tx() and not client_handler.write_ready():
+                                self.logger.info('close failed client %s', client_handler.address)
+                                self.close_selectors(sel, client_handler, writers, paused)
+                            else:
+                                self.update_interest(sel, client_handler.connection, client_handler, writers, paused)
+                        continue
+                    
+                    client_handler = key.data
+                    
+                    # readable
+                    if events & selectors.EVENT_READ:
+                        count = client_handler.read_ready()
+                        if count == 0:
+                            self.logger.info('close eof client %s', client_handler.address)
+                            self.close_selectors(sel, client_handler, writers, paused)
+                            continue
+                        elif count < 0:
+                            shutdownFlag = True
+                    
+                    # writable, or has responses from the requests just read
+                    if events & selectors.EVENT_WRITE or client_handler.has_pending_tx():
+                        if not client_handler.write_ready():
+                            self.logger.info('close failed client %s', client_handler.address)
+                            self.close_selectors(sel, client_handler, writers, paused)
+                            continue
+                    
+                    self.update_interest(sel, s, client_handler, writers, paused)
+                
+                if timeouts:
+                    self.expire_selectors(sel, timeouts, writers, paused)
+                
+                if metrics and ready:
+                    metrics.observe_loop_iteration(time.perf_counter() - started)
+                
+                if profiler:
+                    profiler.poll()
+                
+                if len(writers) == 0 and shutdownFlag:
+                    break
+        finally:
+            # Close all sockets
+            for key in list(sel.get_map().values()):
+                if key.data is not None and key.data is not completions:
+                    key.data.close()
+            for client_handler in paused.values():
+                client_handler.close()
+            sel.close()
+            self.close_servers(servers)
+    
+    def accept_selectors(self, sel, server, handler_factory):
+        for connection in self.accept_connections(server, handler_factory.tracer):
+            client_handler = handler_factory.create(connection)
+            self.logger.info('new client %s', client_handler.address)
+            sel.register(connection, selectors.EVENT_READ, client_handler)
+        
+    def expire_selectors(self, sel, timeouts, writers, paused):
+        for client_handler, reason in timeouts.expire(time.monotonic()):
+            if reason:
+                self.logger.info('close %s client %s', reason, client_handler.address)
+                self.close_selectors(sel, client_handler, writers, paused)
+            else:
+                self.update_interest(sel, client_handler.connection, client_handler, writers, paused)
+    
+    def close_selectors(self, sel, client_handler, writers, paused):
+        s = client_handler.connection
+        if s in paused:
+            del paused[s]
+        else:
+            sel.unregister(s)
+        writers.discard(s)
+        client_handler.close()
+    
+    def update_interest(self, sel, s, client_handler, writers, paused):
+        # Modify the registration only when the handler's state changed.
+        events = 0
+        if client_handler.wants_read():
+            events |= selectors.EVENT_READ
+        if client_handler.has_pending_tx():
+            events |= selectors.EVENT_WRITE
+        
+        current = 0 if s in paused else sel.get_key(s).events
+        if events == current:
+            return
+        
+        if events == 0:
+            sel.unregister(s)
+            paused[s] = client_handler
+        elif current == 0:
+            del paused[s]
+            sel.register(s, events, client_handler)
+        else:
+            sel.modify(s, events, client_handler)
+        
+        if events & selectors.EVENT_WRITE:
+            writers.add(s)
+        else:
+            writers.discard(s)
 
 class RequestMessage:
-    def __init__(self, request_id, body_length):
+    __slots__ = ('request_id', 'body_length', 'body_data', 'encoding', 'accept_encodings', 'batch',
+        'service_id', 'accept_stream', 'hosted', 'trace')
+    
+    def __init__(self, request_id, body_length, encoding=ENCODING_IDENTITY, accept_encodings=0, batch=False,
+            service_id=0, accept_stream=False):
         self.request_id = request_id
         self.body_length = body_length
         self.body_data = None
+        # Encoding of the body and bit mask of the encodings the client
+        # accepts for the result.
+        self.encoding = encoding
+        self.accept_encodings = accept_encodings
+        # The body holds several requests, see parse_batch_requests.
+        self.batch = batch
+        # The service, looked up in the ServiceRegistry when the request is
+        # admitted.
+        self.service_id = service_id
+        # The client accepts a streamed result, see protocol.py.
+        self.accept_stream = accept_stream
+        self.hosted = None
+        # A profiling.RequestTrace while requests are traced.
+        self.trace = None
+    
+    def __getstate__(self):
+        # Requests are pickled for process pools, without their service and
+        # trace.
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state['hosted'] = None
+        state['trace'] = None
+        return state
+    
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
     
     def create_response(self):
-        return ResponseMessage(self.request_id)
+        return ResponseMessage(self.request_id, self.accept_encodings, self.hosted, self.trace)
         
 class ResponseMessage:
-    def __init__(self, request_id):
+    __slots__ = ('request_id', 'accept_encodings', 'hosted', 'status', 'body_data', 'cache_key', 'start_time',
+        'trace')
+    
+    def __init__(self, request_id, accept_encodings=0, hosted=None, trace=None):
         self.request_id = request_id
+        self.accept_encodings = accept_encodings
+        self.hosted = hosted
+        self.trace = trace
+        self.status = None
+        self.body_data = None
+        self.cache_key = None
+        # Responses are created when the request is dispatched.
+        self.start_time = time.perf_counter()
+    
+    def set_result(self, status, body_data):
+        self.status = status
+        self.body_data = body_data
+        
+    def build_header(self, status, result_length, encoding=ENCODING_IDENTITY):
+        return build_response_header(self.request_id, result_length, status, encoding)
         
     def build_message(self, status, body_data):
-        send_request_id = self.request_id.to_bytes(4, byteorder='little')
+        return build_response_message(self.request_id, status, body_data)
+    
+class ResponseQueue:
+    # Responses of one connection that are not sent yet. When ordered, a
+    # response can be sent only when it and every response before it have
+    # their result. Otherwise each response is sent as soon as it completes
+    # and the client matches it by request ID.
+    __slots__ = ('ordered', 'responses', 'pending')
+    
+    def __init__(self, ordered=True):
+        self.ordered = ordered
+        # Allocated by the first ordered response.
+        self.responses = None
+        self.pending = 0
+        
+    def __len__(self):
+        return self.pending
+    
+    def append(self, response):
+        self.pending += 1
+        if self.ordered:
+            if self.responses is None:
+                self.responses = collections.deque()
+            self.responses.append(response)
+    
+    def pop_ready(self, response):
+        if not self.ordered:
+            self.pending -= 1
+            yield response
+            return
         
-        result_length = len(body_data)
-        send_result_length = result_length.to_bytes(4, byteorder='little')
+        while self.responses and self.responses[0].status is not None:
+            self.pending -= 1
+            yield self.responses.popleft()
+    
+class TxBuffer:
+    # Per-connection output buffer. Headers and bodies are queued as separate
+    # segments and written with scatter-gather sendmsg, so they are never
+    # concatenated. A partially written segment is kept as a memoryview of
+    # its unsent tail.
+    __slots__ = ('segments', 'length', 'sent_total', 'memory_budget', 'metrics')
+    
+    def __init__(self, memory_budget=None, metrics=None):
+        # Allocated when data is queued and dropped once it is all sent.
+        self.segments = None
+        self.length = 0
+        self.sent_total = 0
+        self.memory_budget = memory_budget
+        self.metrics = metrics
+        
+    def append(self, data):
+        if len(data) > 0:
+            if self.segments is None:
+                self.segments = collections.deque()
+            self.segments.append(data)
+            self.length += len(data)
+            if self.memory_budget:
+                self.memory_budget.charge(len(data))
+            if self.metrics:
+                self.metrics.tx_buffered_bytes += len(data)
+    
+    def clear(self):
+        if self.memory_budget:
+            self.memory_budget.release(self.length)
+        if self.metrics:
+            self.metrics.tx_buffered_bytes -= self.length
+        self.segments = None
+        self.length = 0
+    
+    def send_to(self, connection):
+        total = 0
         
-        status = status.to_bytes(1, byteorder='little')
+        while self.segments:
+            iov = list(itertools.islice(self.segments, IOV_MAX))
+            
+            try:
+                if hasattr(connection, 'sendmsg'):
+                    count = connection.sendmsg(iov)
+                else:
+                    count = connection.send(iov[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            
+            total += count
+            self.consume(count)
+            
+            if count < sum(len(segment) for segment in iov):
+                # The kernel send buffer is full.
+                break
         
-        reserved_area = bytes([0, 0, 0])
+        return total
+    
+    def consume(self, count):
+        self.length -= count
+        self.sent_total += count
+        if self.memory_budget:
+            self.memory_budget.release(count)
+        if self.metrics:
+            self.metrics.tx_buffered_bytes -= count
+            self.metrics.bytes_sent += count
         
-        tx_data = (
-            RESPONSE_MAGIC_NUMBER + 
-            send_request_id + 
-            send_result_length +
-            status +            
-            reserved_area + 
-            body_data
-        )
+        while count > 0:
+            segment = self.segments[0]
+            if count >= len(segment):
+                self.segments.popleft()
+                count -= len(segment)
+            else:
+                self.segments[0] = memoryview(segment)[count:]
+                count = 0
         
-        return tx_data
+        if not self.segments:
+            self.segments = None
     
-class ClientHandler:
-    def __init__(self, connection, service):
-        self.logger = logging.getLogger()
-        self.connection = connection
-        self.address = connection.getpeername()
-        self.service = service
-        self.rx_data = []
+class MemoryBudget:
+    # Bytes held in the receive and send buffers of all connections.
+    __slots__ = ('limit', 'used')
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+    
+    @property
+    def exhausted(self):
+        return self.used > self.limit
+    
+    def can_reserve(self, count):
+        return self.used + count <= self.limit
+    
+    def charge(self, count):
+        self.used += count
+    
+    def release(self, count):
+        self.used -= count
+    
+class BufferPool:
+    # Receive buffers shared by all connections of the event loop. A
+    # connection takes a buffer when data arrives and gives it back once the
+    # data is consumed, so idle connections hold none. Each size class keeps
+    # at most max_free_bytes of free buffers.
+    def __init__(self, min_size=RECV_BUFSIZE, max_size=MAX_POOLED_BUFFER_SIZE, max_free_bytes=DEFAULT_POOL_FREE_BYTES):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_free_bytes = max_free_bytes
+        
+        # size -> free buffers of that size
+        self.free = {}
+        size = min_size
+        while size <= max_size:
+            self.free[size] = []
+            size *= 2
+    
+    def acquire(self, length):
+        # A buffer of at least 'length' bytes. Its content is undefined.
+        if length > self.max_size:
+            return bytearray(length)
+        
+        size = self.min_size
+        while size < length:
+            size *= 2
+        
+        free = self.free[size]
+        if free:
+            return free.pop()
+        return bytearray(size)
+    
+    def release(self, buffer):
+        # No view into the buffer may be in use.
+        free = self.free.get(len(buffer))
+        if free is not None and (len(free) + 1) * len(buffer) <= self.max_free_bytes:
+            free.append(buffer)
+    
+class FrameReader:
+    # Receive buffer and TRRQ framing. Data is received with recv_into into
+    # one reusable bytearray, every complete frame in the buffer is returned
+    # with its body as a memoryview into that buffer, and a partial tail is
+    # kept for the next receive.
+    #
+    # The buffer is allocated when data arrives. With a buffer_pool it is
+    # taken from the pool and given back whenever it is empty.
+    #
+    # The free space offered to a receive follows the frame: 'size' bytes
+    # while a header is awaited, the rest of the frame once its header is
+    # parsed, and the rest of a streamed body up to max_recv_size.
+    __slots__ = ('initial_size', 'max_recv_size', 'memory_budget', 'buffer_pool', 'buffer', 'start', 'end',
+        'request', 'body_remaining', 'frame_count')
+    
+    def __init__(self, size=RECV_BUFSIZE, memory_budget=None, buffer_pool=None, max_recv_size=DEFAULT_MAX_RECV_SIZE):
+        self.initial_size = size
+        self.max_recv_size = max_recv_size
+        self.memory_budget = memory_budget
+        self.buffer_pool = buffer_pool
+        self.buffer = b''
+        self.start = 0
+        self.end = 0
+        self.request = None
+        self.body_remaining = 0
+        # Counts consumed headers and streamed bodies, so that a timer can
+        # tell whether the connection made progress.
+        self.frame_count = 0
+    
+    def allocate(self, length):
+        if self.buffer_pool:
+            return self.buffer_pool.acquire(length)
+        return bytearray(length)
+    
+    def set_buffer(self, buffer):
+        if self.memory_budget:
+            self.memory_budget.charge(len(buffer) - len(self.buffer))
+        if self.buffer_pool and self.buffer:
+            self.buffer_pool.release(self.buffer)
+        self.buffer = buffer
+    
+    def close(self):
+        self.set_buffer(b'')
+        
+    def recv_from(self, connection):
+        count = connection.recv_into(self.get_buffer())
+        self.buffer_updated(count)
+        return count
+    
+    def get_buffer(self):
+        # Free space at the end of the buffer to receive into.
+        free = len(self.buffer) - self.end
+        pending = self.end - self.start
+        
+        if self.body_remaining > pending:
+            # A streamed body. The buffer holds at most max_recv_size of it.
+            wanted = max(min(self.body_remaining - pending, self.max_recv_size), self.initial_size)
+            if free < wanted:
+                self.reserve(pending + wanted)
+        elif free == 0:
+            self.reserve(pending + self.initial_size)
+        
+        return memoryview(self.buffer)[self.end:]
+    
+    def buffer_updated(self, count):
+        self.end += count
+    
+    def reserve(self, length):
+        # Make room for 'length' bytes starting at the unconsumed data.
+        pending = self.end - self.start
+        
+        if len(self.buffer) < length:
+            buffer = self.allocate(length)
+            buffer[0:pending] = memoryview(self.buffer)[self.start:self.end]
+            self.set_buffer(buffer)
+        elif self.start > 0:
+            self.buffer[0:pending] = self.buffer[self.start:self.end]
+        
+        self.start = 0
+        self.end = pending
+    
+    def peek_header(self):
+        # The request of the next frame once its header is buffered. The
+        # frame is not consumed.
+        if not self.request and self.end - self.start >= MESSAGE_HEADER_LENGTH:
+            self.request = self.parse_header(self.buffer, self.start)
+        
+        return self.request
+    
+    def next_frame(self, streaming=False):
+        # With streaming, the request is returned as soon as its header is
+        # parsed and the body is read with next_chunk.
+        if not self.peek_header():
+            return None
+        
+        pending = self.end - self.start
+        
+        if streaming:
+            request = self.request
+            self.start += MESSAGE_HEADER_LENGTH
+            self.body_remaining = request.body_length
+            self.request = None
+            self.frame_count += 1
+            return request
+        
+        frame_length = MESSAGE_HEADER_LENGTH + self.request.body_length
+        if pending < frame_length:
+            if self.start + frame_length > len(self.buffer):
+                self.reserve(frame_length)
+            return None
+        
+        request = self.request
+        body_start = self.start + MESSAGE_HEADER_LENGTH
+        request.body_data = memoryview(self.buffer)[body_start:self.start + frame_length]
+        
+        self.start += frame_length
         self.request = None
-        self.tx_queue = queue.Queue()
+        self.frame_count += 1
+        
+        return request
+    
+    def next_chunk(self):
+        # The buffered part of a streamed body as a memoryview, or None when
+        # nothing is buffered. The buffer never grows to hold the body.
+        count = min(self.end - self.start, self.body_remaining)
+        if count == 0:
+            return None
+        
+        chunk = memoryview(self.buffer)[self.start:self.start + count]
+        self.start += count
+        self.body_remaining -= count
+        if self.body_remaining == 0:
+            self.frame_count += 1
+        
+        return chunk
+    
+    def partial_frame(self):
+        # PARTIAL_HEADER or PARTIAL_BODY while a frame is only partly
+        # received, None when the buffer is empty or holds whole frames.
+        if self.body_remaining > 0:
+            return PARTIAL_BODY
+        
+        pending = self.end - self.start
+        if pending == 0:
+            return None
+        if pending < MESSAGE_HEADER_LENGTH:
+            return PARTIAL_HEADER
+        
+        try:
+            request = self.peek_header()
+        except ValueError:
+            # Dispatching the frame fails the connection.
+            return None
+        
+        if pending < MESSAGE_HEADER_LENGTH + request.body_length:
+            return PARTIAL_BODY
+        return None
+    
+    def release(self, request):
+        # The body view must be released before the buffer can be reused.
+        request.body_data.release()
+        request.body_data = None
+        self.reset_if_empty()
+    
+    def release_chunk(self, chunk):
+        chunk.release()
+        self.reset_if_empty()
+    
+    def reset_if_empty(self):
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+            
+            if self.buffer_pool:
+                self.set_buffer(b'')
+            elif len(self.buffer) > self.initial_size:
+                self.set_buffer(bytearray(self.initial_size))
+    
+    def parse_header(self, buffer, offset):
+        # The header is unpacked in place from the receive buffer.
+        magic_number, request_id, body_length, flags, accept_encodings, service_id = unpack_request_header(buffer, offset)
+        
+        return RequestMessage(request_id, body_length, flags & ENCODING_MASK, accept_encodings, (flags & FLAG_BATCH) != 0,
+            service_id, (flags & FLAG_STREAM) != 0)
+        
+class StreamedResponse:
+    # A response that a streaming service produces while the request body is
+    # still being received.
+    __slots__ = ('response', 'stream', 'header_sent', 'sent_length', 'failed')
+    
+    def __init__(self, response):
+        self.response = response
+        self.stream = None
+        self.header_sent = False
+        self.sent_length = 0
+        self.failed = False
+    
+class RequestHandler:
+    # Transport independent part of a connection: dispatches the frames in
+    # the receive buffer to the service, inline or through the executor, and
+    # hands completed responses to send_response() in the configured order.
+    #
+    # Services that implement create_stream() and run inline are streamed
+    # for clients that accept it:
+    # the stream gets on_header(request), on_chunk(data) for each received
+    # part of the body and on_end(). Each returns the response chunks that
+    # are ready. The stream sets response_length before its first chunk,
+    # and may set result to (status, result data) to answer with that
+    # instead; see protocol.py for how the result is replaced once streamed.
+    # Its output is sent as it is produced, so a stream is only opened once
+    # the responses before it are sent; until then the frame stays in the
+    # receive buffer and reading pauses (stream_waiting).
+    #
+    # Each request is routed to its service in the ServiceRegistry. The
+    # settings are taken from the handler factory.
+    #
+    # With a tracer, each request carries a profiling.RequestTrace from its
+    # frame to its response. frame_received is the time of the receive that
+    # brought the first bytes of the next frame.
+    #
+    # There is one handler per connection, so handlers and the objects they
+    # hold declare __slots__ and allocate buffers and queues on first use.
+    __slots__ = ('services', 'max_in_flight', 'max_body_length', 'memory_budget', 'reader', 'responses',
+        'cache', 'metrics', 'compress_min_length', 'compress_level', 'streamed', 'stream_waiting', 'dispatching',
+        'broken',
+        'timeouts', 'timer_deadline', 'last_activity', 'rx_total', 'rx_window_start', 'rx_window_total',
+        'rx_window_frames', 'deadlines', 'tracer', 'frame_received')
+    
+    logger = logging.getLogger()
+    
+    def __init__(self, handler_factory):
+        self.services = handler_factory.services
+        self.max_in_flight = handler_factory.max_in_flight
+        self.max_body_length = handler_factory.max_body_length
+        self.memory_budget = handler_factory.memory_budget
+        self.reader = FrameReader(handler_factory.recv_bufsize, self.memory_budget, handler_factory.buffer_pool,
+            handler_factory.max_recv_size)
+        self.responses = ResponseQueue(handler_factory.ordered_responses)
+        self.cache = handler_factory.response_cache
+        self.metrics = handler_factory.metrics
+        self.compress_min_length = handler_factory.compress_min_length
+        self.compress_level = handler_factory.compress_level
+        self.init_timeouts(handler_factory.timeouts)
+        self.tracer = handler_factory.tracer
+        self.frame_received = None
+        self.streamed = None
+        self.stream_waiting = False
+        self.dispatching = False
+        self.broken = False
+    
+    @property
+    def closed(self):
+        raise NotImplementedError
+    
+    def send_data(self, data):
+        raise NotImplementedError
+    
+    def send_response(self, response):
+        header_data, body_data = self.encode_response(response)
+        self.send_data(header_data)
+        self.send_data(body_data)
+    
+    def encode_response(self, response):
+        # Returns the header and body to send. The result is compressed when
+        # the client accepts an encoding and the result is long enough.
+        encoding = ENCODING_IDENTITY
+        body_data = response.body_data
+        
+        if response.accept_encodings and self.compress_min_length is not None and len(body_data) >= self.compress_min_length:
+            encoding, body_data = encode_body(body_data, choose_encoding(response.accept_encodings), self.compress_level)
+        
+        return response.build_header(response.status, len(body_data), encoding), body_data
+    
+    def flow_paused(self):
+        # True while the peer does not read the responses fast enough.
+        raise NotImplementedError
+    
+    def wants_read(self):
+        return len(self.responses) < self.max_in_flight and not self.stream_waiting and not self.flow_paused()
+    
+    def dispatch_frames(self):
+        self.dispatching = True
+        try:
+            while not self.broken and not self.flow_paused():
+                if self.streamed:
+                    if not self.process_stream():
+                        break
+                    continue
                 
-    def read_ready(self):
+                if len(self.responses) >= self.max_in_flight:
+                    break
+                
+                parse_started = time.perf_counter() if self.tracer else None
+                request = self.reader.peek_header()
+                if not request:
+                    break
+                if not self.admit(request):
+                    continue
+                
+                streaming = self.is_streamed(request)
+                self.stream_waiting = streaming and len(self.responses) > 0
+                if self.stream_waiting:
+                    break
+                
+                request = self.reader.next_frame(streaming)
+                if not request:
+                    break
+                
+                if self.tracer:
+                    self.start_trace(request, parse_started)
+                
+                if streaming:
+                    self.open_stream(request)
+                else:
+                    self.process_request(request)
+            
+            self.reader.reset_if_empty()
+            if self.tracer and self.reader.start == self.reader.end:
+                self.frame_received = None
+        finally:
+            self.dispatching = False
+    
+    def resume_dispatch(self):
+        # Frames held back by the in-flight window or flow control can be
+        # dispatched now.
+        if self.dispatching or self.broken:
+            return
+        
+        try:
+            self.dispatch_frames()
+        except Exception as ex:
+            self.logger.exception('%s Exception occurred.', self.address)
+            self.broken = True
+    
+    def note_read(self):
+        # Called before data is received while requests are traced.
+        if self.frame_received is None:
+            self.frame_received = time.perf_counter()
+    
+    def start_trace(self, request, parse_started):
+        received = self.frame_received if self.frame_received is not None else parse_started
+        request.trace = self.tracer.start(request.body_length, received, parse_started)
+        # The read phase of the next frame in the buffer starts here.
+        self.frame_received = parse_started
+    
+    def finish_trace(self, response):
+        # Called once the response is handed to the transport.
+        self.tracer.finish(response, self.address)
+    
+    def admit(self, request):
+        # Checks the limits before the body of the request is buffered.
+        # Returns False when the request is answered here.
+        if request.body_length > self.max_body_length:
+            self.logger.warning('%s Request body of %d bytes exceeds %d.', self.address, request.body_length, self.max_body_length)
+            response = request.create_response()
+            self.responses.append(response)
+            self.complete(response, STATUS_BODY_TOO_LARGE, b'')
+            
+            # The body is not read, so the framing of the connection cannot
+            # be recovered.
+            self.broken = True
+            return False
+        
+        if request.hosted is None and not self.find_service(request):
+            return False
+        
+        if self.is_streamed(request) or not self.memory_budget:
+            return True
+        
+        growth = MESSAGE_HEADER_LENGTH + request.body_length - len(self.reader.buffer)
+        if growth <= 0 or self.memory_budget.can_reserve(growth):
+            return True
+        
+        # Not enough memory to buffer the body.
+        self.discard_request(request, STATUS_BUSY, b'')
+        return False
+    
+    def find_service(self, request):
+        # Looks the service up, loading it on its first request. Returns
+        # False when the request is answered here.
         try:
-            data = self.connection.recv(RECV_BUFSIZE)
-            if data:
-                self.rx_data += list(data)
+            request.hosted = self.services.get(request.service_id)
+        except Exception as ex:
+            self.logger.exception('%s Service %d failed to load.', self.address, request.service_id)
+            self.discard_request(request, STATUS_SERVICE_ERROR, traceback.format_exc().encode('utf-8'))
+            return False
+        
+        if request.hosted is None:
+            self.discard_request(request, STATUS_UNKNOWN_SERVICE, f'Unknown service ID: {request.service_id}'.encode('utf-8'))
+            return False
+        return True
+    
+    def discard_request(self, request, status, result_data):
+        # Answers the request without processing it. The body is received
+        # and discarded like the rest of the body of a failed stream.
+        response = request.create_response()
+        self.responses.append(response)
+        self.complete(response, status, result_data)
+        
+        self.reader.next_frame(streaming=True)
+        self.streamed = StreamedResponse(response)
+        self.streamed.failed = True
+    
+    def is_streamed(self, request):
+        # Only clients that set FLAG_STREAM read the streamed result framing.
+        # Cached requests are buffered, since the key covers the whole body.
+        # So are compressed and batch requests, which are decoded as a whole.
+        # Streamed results are never compressed, since their length is sent
+        # first.
+        if not request.accept_stream or request.encoding != ENCODING_IDENTITY or request.batch:
+            return False
+        return request.hosted.streaming and not (self.cache and self.cache.accepts(request))
+    
+    def open_stream(self, request):
+        self.streamed = StreamedResponse(request.create_response())
+        
+        try:
+            self.streamed.stream = request.hosted.service.create_stream()
+            self.send_stream_data(self.streamed.stream.on_header(request))
+        except Exception as ex:
+            self.fail_stream()
+    
+    def process_stream(self):
+        # Feeds the buffered part of the body to the stream. Returns False
+        # when more data has to be received.
+        streamed = self.streamed
+        
+        while self.reader.body_remaining > 0:
+            if self.flow_paused():
+                return False
+            
+            chunk = self.reader.next_chunk()
+            if chunk is None:
+                return False
+            
+            try:
+                if not streamed.failed:
+                    self.send_stream_data(streamed.stream.on_chunk(chunk))
+            except Exception as ex:
+                self.fail_stream()
+            finally:
+                self.reader.release_chunk(chunk)
+        
+        try:
+            if not streamed.failed:
+                self.send_stream_data(streamed.stream.on_end())
+            
+            if not streamed.failed:
+                if not streamed.header_sent:
+                    self.send_stream_header()
+                if streamed.sent_length != streamed.stream.response_length:
+                    raise ValueError(f'Stream sent {streamed.sent_length} of {streamed.stream.response_length} bytes')
                 
-                if len(self.rx_data) >= MESSAGE_HEADER_LENGTH:
-                    if not self.request:
-                        self.request = self.parse_header(bytes(self.rx_data[0:MESSAGE_HEADER_LENGTH]))
-                    
-                    if len(self.rx_data) == (MESSAGE_HEADER_LENGTH + self.request.body_length):
-                        self.request.body_data = bytes(self.rx_data[MESSAGE_HEADER_LENGTH:])
-                        response = self.request.create_response()
-                        
-                        status = STATUS_OK
-                        result_data = None
-                        
-                        try:
-                            result_data = self.service.process(self.request)                            
-                        except Exception as ex:
-                            status = STATUS_SERVICE_ERROR
-                            result_data = traceback.format_exc().encode('utf-8')
-                        finally:
-                            tx_data = response.build_message(status, result_data)
-                            self.tx_queue.put(tx_data)
-                            
-                            self.rx_data.clear()
-                            self.request = None
+                self.send_data(STREAM_TRAILER.pack(STATUS_OK, 0, 0))
+                self.observe_response(streamed.response, STATUS_OK)
+        except Exception as ex:
+            self.fail_stream()
+        
+        # A response completed through the queue was traced there.
+        if streamed.response.trace and streamed.response.status is None:
+            streamed.response.trace.completed = time.perf_counter()
+            self.finish_trace(streamed.response)
+        
+        self.streamed = None
+        return True
+    
+    def send_stream_header(self):
+        streamed = self.streamed
+        if streamed.stream.response_length is None:
+            raise ValueError('Stream must set response_length before its first chunk')
+        
+        self.send_data(streamed.response.build_header(STATUS_STREAMED, streamed.stream.response_length))
+        streamed.header_sent = True
+    
+    def send_stream_data(self, output):
+        streamed = self.streamed
+        
+        for data in output or []:
+            if len(data) == 0:
+                continue
+            
+            if isinstance(data, memoryview):
+                # Do not keep a view into the receive buffer.
+                data = bytes(data)
+            
+            if not streamed.header_sent:
+                self.send_stream_header()
+            
+            if streamed.sent_length + len(data) > streamed.stream.response_length:
+                raise ValueError(f'Stream exceeded response_length {streamed.stream.response_length}')
+            
+            streamed.sent_length += len(data)
+            self.send_data(data)
+        
+        if streamed.stream.result is not None:
+            self.replace_stream(*streamed.stream.result)
+    
+    def replace_stream(self, status, result_data):
+        # Answers with this result instead of the streamed one. The rest of
+        # the body is received and discarded.
+        streamed = self.streamed
+        streamed.failed = True
+        
+        if not streamed.header_sent:
+            # Answered through the queue like any other response.
+            self.responses.append(streamed.response)
+            self.complete(streamed.response, status, result_data)
+            return
+        
+        # The streamed result is padded to the length in its header, and
+        # the trailer carries the replacement.
+        self.observe_response(streamed.response, status)
+        padding = streamed.stream.response_length - streamed.sent_length
+        while padding > 0:
+            count = min(padding, len(STREAM_PADDING))
+            self.send_data(memoryview(STREAM_PADDING)[:count])
+            padding -= count
+        
+        self.send_data(STREAM_TRAILER.pack(status, TRAILER_REPLACE, len(result_data)))
+        self.send_data(result_data)
+    
+    def fail_stream(self):
+        if self.streamed.header_sent:
+            self.logger.exception('%s Stream failed after the response header was sent.', self.address)
+        self.replace_stream(STATUS_SERVICE_ERROR, traceback.format_exc().encode('utf-8'))
+    
+    def observe_response(self, response, status):
+        # Requests rejected before their service is known are not observed.
+        if response.hosted and response.hosted.metrics:
+            response.hosted.metrics.observe_response(status, time.perf_counter() - response.start_time)
+    
+    def process_request(self, request):
+        response = request.create_response()
+        self.responses.append(response)
+        
+        if request.encoding != ENCODING_IDENTITY and not self.decode_request(request, response):
+            return
+        
+        if self.cache and self.cache.accepts(request):
+            key = self.cache.make_key(request.hosted.service_id, request.body_data)
+            result_data = self.cache.get(key)
+            if result_data is not None:
+                self.reader.release(request)
+                self.complete(response, STATUS_OK, result_data)
+                return
+            
+            future = self.cache.get_pending(key)
+            if future is not None:
+                # An identical request is being processed.
+                self.reader.release(request)
+                self.wait(future, response)
+                self.track_deadline(response)
+                return
+            
+            response.cache_key = key
+        
+        if not request.hosted.executor:
+            try:
+                status, result_data = call_service(request.hosted.service, request)
+            finally:
+                self.reader.release(request)
+            
+            self.complete(response, status, result_data)
+            return
+        
+        # The receive buffer is reused, so the body is copied for the worker.
+        body_data = bytes(request.body_data)
+        self.reader.release(request)
+        request.body_data = body_data
+        
+        future = self.submit(request, response)
+        if not future:
+            self.complete(response, STATUS_BUSY, b'')
+            return
+        
+        if response.cache_key is not None:
+            self.cache.add_pending(response.cache_key, future)
+        self.track_deadline(response)
+    
+    def init_timeouts(self, timeouts):
+        self.timeouts = timeouts
+        # Earliest deadline this handler is scheduled for in the timer wheel.
+        self.timer_deadline = None
+        self.last_activity = time.monotonic()
+        self.rx_total = 0
+        # While a frame is partly received, the start of the window over
+        # which progress is measured.
+        self.rx_window_start = None
+        self.rx_window_total = 0
+        self.rx_window_frames = 0
+        # (deadline, response) of requests run by the executor, oldest
+        # first. Allocated by the first request with a deadline.
+        self.deadlines = None
+    
+    def start_timer(self):
+        if self.timeouts:
+            self.arm_timer(self.next_deadline(time.monotonic()))
+    
+    def arm_timer(self, deadline):
+        if deadline is not None and (self.timer_deadline is None or deadline < self.timer_deadline):
+            self.timer_deadline = deadline
+            self.timeouts.schedule(self, deadline)
+    
+    def note_received(self, count):
+        # Called after the received data is dispatched.
+        now = time.monotonic()
+        self.last_activity = now
+        self.rx_total += count
+        
+        if self.rx_window_start is None and self.timeouts.header_timeout is not None and self.reader.partial_frame():
+            self.start_rx_window(now)
+            self.arm_timer(now + self.timeouts.header_timeout)
+    
+    def start_rx_window(self, now):
+        self.rx_window_start = now
+        self.rx_window_total = self.rx_total
+        self.rx_window_frames = self.reader.frame_count
+    
+    def next_deadline(self, now):
+        deadlines = []
+        if self.timeouts.idle_timeout is not None:
+            # A connection with requests in flight is not idle.
+            idle_since = now if len(self.responses) else self.last_activity
+            deadlines.append(idle_since + self.timeouts.idle_timeout)
+        if self.rx_window_start is not None:
+            deadlines.append(self.rx_window_start + self.timeouts.header_timeout)
+        if self.deadlines:
+            deadlines.append(self.deadlines[0][0])
+        
+        return min(deadlines) if deadlines else None
+    
+    def check_timeouts(self, now):
+        # Called when the timer expires. Returns the reason to reclaim the
+        # connection, or None after arming the timer again.
+        self.expire_requests(now)
+        
+        timeouts = self.timeouts
+        if self.rx_window_start is not None and now - self.rx_window_start >= timeouts.header_timeout:
+            partial = self.reader.partial_frame()
+            if partial is None:
+                self.rx_window_start = None
+            elif not self.wants_read():
+                # Reading is paused by the server, not the client.
+                self.start_rx_window(now)
+            else:
+                if partial == PARTIAL_HEADER and self.reader.frame_count == self.rx_window_frames:
+                    return REASON_HEADER_TIMEOUT
+                
+                rate = (self.rx_total - self.rx_window_total) / (now - self.rx_window_start)
+                if partial == PARTIAL_BODY and timeouts.body_min_rate and rate < timeouts.body_min_rate:
+                    return REASON_SLOW_BODY
                 
-                return len(data)
+                self.start_rx_window(now)
+        
+        if timeouts.idle_timeout is not None and not len(self.responses) and now - self.last_activity >= timeouts.idle_timeout:
+            return REASON_IDLE
+        
+        self.arm_timer(self.next_deadline(now))
+        return None
+    
+    def track_deadline(self, response):
+        if self.timeouts and self.timeouts.request_deadline is not None:
+            deadline = time.monotonic() + self.timeouts.request_deadline
+            if self.deadlines is None:
+                self.deadlines = collections.deque()
+            self.deadlines.append((deadline, response))
+            self.arm_timer(deadline)
+    
+    def expire_requests(self, now):
+        # Requests past their deadline get STATUS_TIMEOUT. Their results are
+        # dropped when they arrive.
+        while self.deadlines:
+            deadline, response = self.deadlines[0]
+            if response.status is None and deadline > now:
+                break
+            
+            self.deadlines.popleft()
+            if response.status is None:
+                self.logger.warning('%s Request %d missed its deadline.', self.address, response.request_id)
+                self.complete(response, STATUS_TIMEOUT, b'')
+    
+    def decode_request(self, request, response):
+        # Replaces the compressed body with the decoded one. Returns False
+        # when the request is answered here.
+        try:
+            body_data = decode_body(request.body_data, request.encoding, self.max_body_length)
+        except BodyEncodingError as ex:
+            self.reader.release(request)
+            self.complete(response, STATUS_BAD_ENCODING, str(ex).encode('utf-8'))
+            return False
+        
+        self.reader.release(request)
+        request.body_data = memoryview(body_data)
+        request.body_length = len(body_data)
+        request.encoding = ENCODING_IDENTITY
+        return True
+    
+    def submit(self, request, response):
+        # Returns the future of the result, or None when the executor is busy.
+        return request.hosted.executor.submit(request, self, response)
+    
+    def wait(self, future, response):
+        # Completes the response with the result of a submitted future.
+        response.hosted.executor.wait(future, self, response)
+    
+    def complete(self, response, status, result_data):
+        if response.cache_key is not None:
+            self.cache.finish(response.cache_key, status, result_data)
+        
+        if self.closed or response.status is not None:
+            # The connection is gone, or the request was already answered
+            # with STATUS_TIMEOUT at its deadline.
+            return
+        
+        response.set_result(status, result_data)
+        self.observe_response(response, status)
+        if response.trace:
+            response.trace.completed = time.perf_counter()
+        
+        if self.timeouts:
+            self.last_activity = time.monotonic()
+            while self.deadlines and self.deadlines[0][1].status is not None:
+                self.deadlines.popleft()
+        
+        for ready in self.responses.pop_ready(response):
+            self.send_response(ready)
+            if ready.trace:
+                self.finish_trace(ready)
+        
+        self.resume_dispatch()
+    
+class ClientHandler(RequestHandler):
+    __slots__ = ('connection', 'address', 'tx_buffer', 'tx_high_water', 'tx_low_water', 'tx_paused', 'tx_traces')
+    
+    def __init__(self, connection, handler_factory):
+        super().__init__(handler_factory)
+        self.connection = connection
+        self.address = connection_address(connection)
+        self.tx_buffer = TxBuffer(self.memory_budget, self.metrics)
+        self.tx_high_water = handler_factory.tx_high_water
+        self.tx_low_water = handler_factory.tx_low_water
+        self.tx_paused = False
+        # (tx_buffer.sent_total at the end of the response, response) of
+        # traced responses that are not sent yet.
+        self.tx_traces = None
+        
+        if self.metrics:
+            self.metrics.connection_opened()
+        
+        self.start_timer()
+    
+    @property
+    def closed(self):
+        return self.connection.fileno() < 0
+    
+    def close(self):
+        self.reader.close()
+        self.tx_buffer.clear()
+        self.connection.close()
+        
+        if self.metrics:
+            self.metrics.connection_closed()
+    
+    def flow_paused(self):
+        # While the memory budget is exhausted, connections that still have
+        # responses to send stop reading.
+        if self.tx_paused:
+            return True
+        return self.memory_budget is not None and self.memory_budget.exhausted and self.has_pending_tx()
+                
+    def read_ready(self):
+        try:
+            if self.tracer:
+                self.note_read()
+            count = self.reader.recv_from(self.connection)
+            if self.metrics:
+                self.metrics.bytes_received += count
+            if count:
+                self.dispatch_frames()
+                if self.timeouts:
+                    self.note_received(count)
+                
+                # A broken connection is closed like one at EOF, after
+                # sending what can be sent right away.
+                if self.broken:
+                    self.write_ready()
+                    return 0
+                return count
             else:
                 return 0
         except Exception as ex:
-            self.logger.error(f'{self.address} Exception occurred.')
-            self.logger.error(traceback.format_exc())
+            self.logger.exception('%s Exception occurred.', self.address)
             return 0
+    
+    def send_data(self, data):
+        self.tx_buffer.append(data)
+        if self.tx_buffer.length > self.tx_high_water:
+            self.tx_paused = True
+            
+    def has_pending_tx(self):
+        return self.tx_buffer.length > 0
+    
+    def finish_trace(self, response):
+        # The write phase ends when the send buffer drained past the
+        # response.
+        if self.tx_traces is None:
+            self.tx_traces = collections.deque()
+        self.tx_traces.append((self.tx_buffer.sent_total + self.tx_buffer.length, response))
+    
+    def finish_sent_traces(self):
+        sent_total = self.tx_buffer.sent_total
+        while self.tx_traces and self.tx_traces[0][0] <= sent_total:
+            self.tracer.finish(self.tx_traces.popleft()[1], self.address)
             
     def write_ready(self):
+        paused = self.flow_paused()
+        
         try:
-            tx_data = self.tx_queue.get_nowait()
-        except queue.Empty:
-            pass
-        else:
-            self.connection.sendall(tx_data)
-    
-    def parse_header(self, data):
-        magic_number = data[0:4]
-        if magic_number != REQUEST_MAGIC_NUMBER:
-            raise ValueError(f'Illegal magic number: {magic_number.hex()}')
+            count = self.tx_buffer.send_to(self.connection)
+        except OSError as ex:
+            self.logger.error('%s Send failed: %s', self.address, ex)
+            return False
         
-        request_id = int.from_bytes(data[4:8], byteorder='little')
+        if count and self.timeouts:
+            self.last_activity = time.monotonic()
         
-        body_length = int.from_bytes(data[8:12], byteorder='little')
+        if self.tx_traces:
+            self.finish_sent_traces()
         
-        return RequestMessage(request_id, body_length)
+        if self.tx_paused and self.tx_buffer.length <= self.tx_low_water:
+            self.tx_paused = False
+        
+        if paused and not self.flow_paused():
+            self.resume_dispatch()
+            
+            if self.broken:
+                # Closed by the caller after sending what can be sent.
+                self.tx_buffer.send_to(self.connection)
+                return False
+        return True
         
 class ClientHandlerFactory:
-    def __init__(self, service):
-        self.service = service
+    # Settings shared by the handlers of all connections. Requests are
+    # routed to the services of a ServiceRegistry. A memory_limit
+    # bounds the bytes buffered by all connections together. A
+    # response_cache is used for services that declare themselves cacheable.
+    # Metrics are recorded when a metrics object is given. Results of at
+    # least compress_min_length bytes are compressed for clients that accept
+    # it, None turns compression off. Connections are reclaimed and requests
+    # answered with STATUS_TIMEOUT by the given ConnectionTimeouts. Receives
+    # take recv_bufsize bytes while a header is awaited, and up to
+    # max_recv_size of a streamed body. Requests are traced through their
+    # phases by a profiling.RequestTracer when one is given.
+    def __init__(self, services,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT_PER_CONNECTION, ordered_responses=True,
+            max_body_length=DEFAULT_MAX_BODY_LENGTH, tx_high_water=DEFAULT_TX_HIGH_WATER,
+            tx_low_water=DEFAULT_TX_LOW_WATER, memory_limit=None, response_cache=None, metrics=None,
+            compress_min_length=DEFAULT_COMPRESS_MIN_LENGTH, compress_level=DEFAULT_COMPRESS_LEVEL,
+            timeouts=None, recv_bufsize=RECV_BUFSIZE, max_recv_size=DEFAULT_MAX_RECV_SIZE, tracer=None):
+        self.services = services
+        self.completions = services.completions
+        self.max_in_flight = max_in_flight
+        self.ordered_responses = ordered_responses
+        self.max_body_length = max_body_length
+        self.tx_high_water = tx_high_water
+        self.tx_low_water = tx_low_water
+        self.memory_budget = MemoryBudget(memory_limit) if memory_limit else None
+        self.recv_bufsize = recv_bufsize
+        self.max_recv_size = max_recv_size
+        self.buffer_pool = BufferPool(recv_bufsize)
+        self.response_cache = response_cache
+        self.metrics = metrics
+        self.compress_min_length = compress_min_length
+        self.compress_level = compress_level
+        self.timeouts = timeouts
+        self.tracer = tracer
         
     def create(self, connection):
-        return ClientHandler(connection, self.service)
+        return ClientHandler(connection, self)
+    
+    def close(self):
+        self.services.close()
@@ -0,0 +1,132 @@
+################################################################################
+# Timer wheel and connection timeouts.                                         #
+#                                                                              #
+# A hashed timer wheel: a timer goes into the slot of its tick, so adding one  #
+# is O(1) and each tick only looks at one slot. Timers are never cancelled;    #
+# a connection that was active since it armed its timer is simply checked      #
+# and armed again, which keeps the per-event cost at an attribute update.      #
+################################################################################
+
+import time, collections
+
+################################################################################
+# Constants                                                                    #
+################################################################################
+
+DEFAULT_TICK = 1.0
+DEFAULT_SLOT_COUNT = 512
+
+# Connection timeout defaults, in seconds and bytes per second.
+DEFAULT_IDLE_TIMEOUT = 300.0
+DEFAULT_HEADER_TIMEOUT = 10.0
+DEFAULT_BODY_MIN_RATE = 1024
+DEFAULT_REQUEST_DEADLINE = 30.0
+
+# Reasons a connection is reclaimed.
+REASON_IDLE = 'idle'
+REASON_HEADER_TIMEOUT = 'header timeout'
+REASON_SLOW_BODY = 'slow body'
+
+################################################################################
+# Classes                                                                      #
+################################################################################
+
+class TimerWheel:
+    def __init__(self, tick=DEFAULT_TICK, slot_count=DEFAULT_SLOT_COUNT):
+        self.tick = tick
+        # Each slot holds (tick, item) entries. Timers more than one turn of
+        # the wheel away stay in their slot until their tick comes.
+        self.slots = [[] for i in range(slot_count)]
+        self.current_tick = self.to_tick(time.monotonic())
+        self.next_time = (self.current_tick + 1) * tick
+        self.count = 0
+    
+    def __len__(self):
+        return self.count
+    
+    def to_tick(self, when):
+        return int(when / self.tick)
+    
+    def schedule(self, when, item):
+        # The item is returned by the first advance at or after 'when',
+        # rounded up to the next tick.
+        tick = max(self.to_tick(when) + 1, self.current_tick + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+        self.count += 1
+    
+    def advance(self, now):
+        # Returns the items whose time has come.
+        if now < self.next_time:
+            return []
+        
+        target = self.to_tick(now)
+        expired = []
+        
+        # After a long stall every slot is visited once.
+        for tick in range(self.current_tick + 1, min(target, self.current_tick + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            
+            remaining = []
+            for entry in slot:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    remaining.append(entry)
+            self.slots[tick % len(self.slots)] = remaining
+        
+        self.current_tick = target
+        self.next_time = (target + 1) * self.tick
+        self.count -= len(expired)
+        return expired
+
+class ConnectionTimeouts:
+    # Timeout settings shared by all connections and the timer wheel of the
+    # event loop. None turns a timeout off.
+    #   idle_timeout      no data received or sent and no request in flight
+    #   header_timeout    a request header is not complete after this long;
+    #                     also the window over which body_min_rate is measured
+    #   body_min_rate     bytes per second while a request body is received
+    #   request_deadline  requests run by the executor get STATUS_TIMEOUT
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, header_timeout=DEFAULT_HEADER_TIMEOUT,
+            body_min_rate=DEFAULT_BODY_MIN_RATE, request_deadline=DEFAULT_REQUEST_DEADLINE,
+            tick=DEFAULT_TICK, metrics=None):
+        self.idle_timeout = idle_timeout
+        self.header_timeout = header_timeout
+        self.body_min_rate = body_min_rate
+        self.request_deadline = request_deadline
+        self.metrics = metrics
+        self.wheel = TimerWheel(tick)
+        
+        # reason -> connections reclaimed
+        self.reclaimed = collections.Counter()
+    
+    def schedule(self, handler, deadline):
+        self.wheel.schedule(deadline, (handler, deadline))
+    
+    def expire(self, now):
+        # Checks the connections whose timer expired. Returns (handler,
+        # reason) for each of them. The reason is None for connections that
+        # stay open; their timers are armed again, and they may have
+        # responses to send for requests that missed their deadline.
+        expired = self.wheel.advance(now)
+        if not expired:
+            return []
+        
+        checked = {}
+        for handler, deadline in expired:
+            if handler.closed or handler in checked:
+                continue
+            
+            if deadline == handler.timer_deadline:
+                handler.timer_deadline = None
+            
+            reason = handler.check_timeouts(now)
+            if reason:
+                self.reclaimed[reason] += 1
+                if self.metrics:
+                    self.metrics.connection_reclaimed(reason)
+            checked[handler] = reason
+        
+        return checked.items()